@@ -0,0 +1,84 @@
+"""
+Async views of the URL Shortener API, for ASGI deployments.
+
+These are plain Django async views rather than DRF views (which are sync-only),
+mirroring the responses of their counterparts in `api.views`. Key resolution
+runs on the event loop; the database is only reached through the async ORM.
+"""
+from django.conf import settings
+from django.http import JsonResponse
+from django.views import View
+from rest_framework import status
+
+from api.exceptions import ApiCustomException
+from api.mixins import AsyncReplicaReadsMixin
+from api.utils.views_utils import DRF_JSON_DUMPS_PARAMS, conditional_stats_response, redirect_adapted
+from api.views import FetchContentView, MostPopularUrlsView, most_popular_urls_cache, shortened_urls_count_cache
+from shortening.models import OriginalUrlData, UniqueIpHitsCounter
+from shortening.utils.key_resolution_utils import aresolve_original_url
+from shortening.utils.write_behind_utils import click_counter
+
+
+def json_response(value, status_code=status.HTTP_200_OK):
+    """
+    JSON response with the same body as DRF renders.
+    """
+    return JsonResponse(value, safe=False, status=status_code, json_dumps_params=DRF_JSON_DUMPS_PARAMS)
+
+
+class AsyncFetchContentView(AsyncReplicaReadsMixin, View):
+    """
+    Fetch original content via a shortened url.
+
+    Async counterpart of `api.views.FetchContentView`.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        key = kwargs.get("key")
+        url = await aresolve_original_url(key)
+        if url:
+            if click_counter is not None:
+                click_counter.add(key)
+            return redirect_adapted(url)
+        else:
+            return json_response(
+                {"detail": FetchContentView.not_found_detail.format(key=key)},
+                status.HTTP_404_NOT_FOUND,
+            )
+
+
+class AsyncShortenedUrlsCountView(AsyncReplicaReadsMixin, View):
+    """
+    Show how many urls have been shortened.
+
+    Async counterpart of `api.views.ShortenedUrlsCountView`.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        entry = shortened_urls_count_cache.get(request=request)
+        if entry is None:
+            entry = shortened_urls_count_cache.set(await UniqueIpHitsCounter.atotal())
+        return conditional_stats_response(request, entry, settings.STATS_CACHE_TTL, json_response)
+
+
+class AsyncMostPopularUrlsView(AsyncReplicaReadsMixin, View):
+    """
+    Return a list of the 10 most shortened urls.
+
+    Async counterpart of `api.views.MostPopularUrlsView`.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            limit = MostPopularUrlsView.get_limit(request.GET)
+        except ApiCustomException as exc:
+            return json_response({"detail": exc.message}, exc.status)
+
+        entry = most_popular_urls_cache.get(limit, request)
+        if entry is None:
+            entry = most_popular_urls_cache.set([
+                url async for url in OriginalUrlData.objects.order_by(*MostPopularUrlsView.ORDERING).values_list(
+                    "url", flat=True,
+                )[:limit]
+            ], limit)
+        return conditional_stats_response(request, entry, settings.STATS_CACHE_TTL, json_response)
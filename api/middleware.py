@@ -0,0 +1,85 @@
+"""
+Middleware of the URL shortener API.
+"""
+import asyncio
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework import status
+
+from api.utils.views_utils import DRF_JSON_DUMPS_PARAMS, redirect_adapted
+from api.views import FetchContentView
+from shortening.utils.key_resolution_utils import aresolve_original_url, resolve_original_url
+from shortening.utils.write_behind_utils import click_counter
+from url_shortener.db_routers import replica_reads
+from url_shortener.middleware import is_pinned_to_primary
+
+FAST_PATH_METHODS = ("GET", "HEAD")
+
+
+def fast_path_key(request):
+    """
+    Key of the shortened url a request fetches the content of, `None` for other requests.
+    """
+    if request.method not in FAST_PATH_METHODS:
+        return None
+    # Resolved already if metrics are enabled.
+    match = request.resolver_match
+    if match is None:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+    if match.url_name != "fetch-content":
+        return None
+    request.resolver_match = match
+    return match.kwargs["key"]
+
+
+def fetch_content_response(key: str, url):
+    """
+    Response of `FetchContentView` for the key, given the original url it resolved to.
+    """
+    if url:
+        if click_counter is not None:
+            click_counter.add(key)
+        return redirect_adapted(url)
+    return JsonResponse(
+        {"detail": FetchContentView.not_found_detail.format(key=key)},
+        status=status.HTTP_404_NOT_FOUND,
+        json_dumps_params=DRF_JSON_DUMPS_PARAMS,
+    )
+
+
+@sync_and_async_middleware
+def redirect_fast_path_middleware(get_response):
+    """
+    Serve redirects of shortened urls (the hottest route by far) right away,
+    skipping the middleware after this one, DRF's request wrapping, content negotiation
+    and rendering. Responses are the same as `FetchContentView`'s.
+
+    Not used at all unless `REDIRECT_FAST_PATH_ENABLED`.
+    """
+    if not settings.REDIRECT_FAST_PATH_ENABLED:
+        raise MiddlewareNotUsed
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            key = fast_path_key(request)
+            if key is None:
+                return await get_response(request)
+            with replica_reads(not is_pinned_to_primary(request)):
+                url = await aresolve_original_url(key)
+            return fetch_content_response(key, url)
+    else:
+        def middleware(request):
+            key = fast_path_key(request)
+            if key is None:
+                return get_response(request)
+            with replica_reads(not is_pinned_to_primary(request)):
+                url = resolve_original_url(key)
+            return fetch_content_response(key, url)
+    return middleware
@@ -9,6 +9,9 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from api.exceptions import ApiCustomException
+from url_shortener.db_routers import replica_reads
+from url_shortener.metrics import integrity_errors_total
+from url_shortener.middleware import is_pinned_to_primary
 
 
 class HandleAPIExceptionMixin(APIView):
@@ -40,6 +43,7 @@ class HandleAPIExceptionMixin(APIView):
             )
 
         if isinstance(exc, IntegrityError):
+            integrity_errors_total.inc(view=type(self).__name__)
             return Response(
                 {
                     "detail": f"Integrity Error occurred. {repr(exc)}",
@@ -48,3 +52,24 @@ class HandleAPIExceptionMixin(APIView):
             )
 
         return super().handle_exception(exc)
+
+
+class ReplicaReadsMixin:
+    """
+    Mixin to serve reads of a read-only view from a replica (if any is configured),
+    unless the client wrote recently (see `url_shortener.middleware`).
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads(not is_pinned_to_primary(request)):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class AsyncReplicaReadsMixin:
+    """
+    `ReplicaReadsMixin` for async views.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        with replica_reads(not is_pinned_to_primary(request)):
+            return await super().dispatch(request, *args, **kwargs)
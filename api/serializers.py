@@ -1,8 +1,16 @@
 """
 Serializers for URL shortening API.
 """
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
 
+from shortening.models import DailyUrlShorteningRollup, HourlyUrlShorteningRollup
+
+ROLLUPS = {rollup.GRANULARITY: rollup for rollup in (HourlyUrlShorteningRollup, DailyUrlShorteningRollup)}
+
 
 class OriginalUrlDataListSerializer(serializers.ListSerializer):  # NOQA
     """
@@ -33,3 +41,30 @@ class OriginalUrlDataSerializer(serializers.Serializer):  # NOQA
         fields = [
             "url",
         ]
+
+
+class TimeseriesQuerySerializer(serializers.Serializer):  # NOQA
+    """
+    Serializer for `/stats/timeseries/` query parameters.
+
+    The range defaults to the last `DEFAULT_BUCKETS` buckets (until now),
+    and is limited to `STATS_TIMESERIES_MAX_BUCKETS` buckets.
+    """
+    DEFAULT_BUCKETS = 24
+
+    url = serializers.CharField()
+    granularity = serializers.ChoiceField(choices=list(ROLLUPS), default="hour")
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        rollup = ROLLUPS[data["granularity"]]
+        end = data.get("end") or timezone.now()
+        start = rollup.bucket_start(data.get("start") or end - rollup.bucket_interval() * self.DEFAULT_BUCKETS)
+        if start >= end:
+            raise serializers.ValidationError("Expected 'start' to be before 'end'.")
+
+        max_buckets = settings.STATS_TIMESERIES_MAX_BUCKETS
+        if end - start > rollup.bucket_interval() * max_buckets:
+            raise serializers.ValidationError(f"Expected a range of at most {max_buckets} buckets.")
+        return {**data, "rollup": rollup, "start": start, "end": end}
@@ -1,9 +1,20 @@
 """
 URLs for the URL shortener API endpoints.
 """
+from django.conf import settings
 from django.urls import path
 
-from api import views
+from api import async_views, views
+
+# Read-only endpoints get native async views in ASGI deployments.
+if settings.ASYNC_VIEWS_ENABLED:
+    fetch_content_view = async_views.AsyncFetchContentView
+    shortened_urls_count_view = async_views.AsyncShortenedUrlsCountView
+    most_popular_urls_view = async_views.AsyncMostPopularUrlsView
+else:
+    fetch_content_view = views.FetchContentView
+    shortened_urls_count_view = views.ShortenedUrlsCountView
+    most_popular_urls_view = views.MostPopularUrlsView
 
 
 urlpatterns = [
@@ -12,19 +23,29 @@ urlpatterns = [
         views.ShortenUrlView.as_view(),
         name="shorten-url",
     ),
+    path(
+        "shorten_urls/bulk/",
+        views.BulkShortenUrlView.as_view(),
+        name="bulk-shorten-urls",
+    ),
     path(
         "shortened_urls_count/",
-        views.ShortenedUrlsCountView.as_view(),
+        shortened_urls_count_view.as_view(),
         name="shortened-urls-count",
     ),
     path(
         "most_popular_urls/",
-        views.MostPopularUrlsView.as_view(),
+        most_popular_urls_view.as_view(),
         name="most-popular-urls",
     ),
+    path(
+        "stats/timeseries/",
+        views.StatsTimeseriesView.as_view(),
+        name="stats-timeseries",
+    ),
     path(
         "<str:key>/",
-        views.FetchContentView.as_view(),
+        fetch_content_view.as_view(),
         name="fetch-content",
     ),
 ]
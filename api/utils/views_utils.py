@@ -2,7 +2,22 @@
 Utilities for api views.
 """
 
-from django.shortcuts import redirect
+import json
+import threading
+import time
+from collections import namedtuple
+from hashlib import blake2b
+
+from django.conf import settings
+from django.http import HttpResponseRedirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from url_shortener.middleware import is_pinned_to_primary
+
+# Same JSON as DRF renders (compact, non-ASCII characters as is), for responses of plain Django views.
+DRF_JSON_DUMPS_PARAMS = {"separators": (",", ":"), "ensure_ascii": False}
+
+StatsCacheEntry = namedtuple("StatsCacheEntry", ["value", "etag", "expires_at"])
 
 
 def redirect_adapted(url):
@@ -11,6 +26,70 @@ def redirect_adapted(url):
 
     This wrapper is handy for testing and future functionality extensions.
 
+    The status code (`REDIRECT_STATUS_CODE`) and the time browsers and CDNs may cache
+    the redirect for (`REDIRECT_CACHE_MAX_AGE`) are configurable.
+
     NOTE: consider forwarding gracefully, i.e. checking if the website exists before forwarding.
     """
-    return redirect(url)
+    response = HttpResponseRedirect(url)
+    response.status_code = settings.REDIRECT_STATUS_CODE
+    if settings.REDIRECT_CACHE_MAX_AGE:
+        patch_cache_control(response, public=True, max_age=settings.REDIRECT_CACHE_MAX_AGE)
+    return response
+
+
+class StatsCache:
+    """
+    Per-process cache of stats values, with their HTTP validator.
+
+    The `ETag` of a value is a digest of it, so it is the same in all processes.
+    No `Last-Modified` is sent: the time a process first got a value differs between
+    processes, so a client could be told a value it never got is not modified.
+    Values are recomputed at most every `ttl` seconds, so repeated (or conditional)
+    requests in the meantime are answered without a database query, except for clients
+    pinned to the primary (see `READ_YOUR_WRITES_WINDOW`), which get fresh values including their writes.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key=None, request=None):
+        """
+        Get the cached entry for the key, or `None` if it is missing or expired,
+        or if the request is pinned to the primary.
+        """
+        if request is not None and is_pinned_to_primary(request):
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() >= entry.expires_at:
+            return None
+        return entry
+
+    def set(self, value, key=None) -> StatsCacheEntry:
+        """
+        Cache a freshly computed (JSON serializable) value for the key; return its entry.
+        """
+        etag = '"{}"'.format(blake2b(json.dumps(value).encode(), digest_size=8).hexdigest())
+        entry = StatsCacheEntry(value=value, etag=etag, expires_at=time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def conditional_stats_response(request, entry: StatsCacheEntry, ttl: float, response_factory):
+    """
+    `304 Not Modified` if the client has the cached value already, its response otherwise,
+    with its validator and caching headers (not to be reused by clients pinned to the primary).
+    """
+    response = get_conditional_response(request, etag=entry.etag)
+    if response is None:
+        response = response_factory(entry.value)
+    response["ETag"] = entry.etag
+    patch_cache_control(response, public=True, max_age=0 if is_pinned_to_primary(request) else int(ttl))
+    return response
@@ -1,23 +1,29 @@
 """
 Views logic of the URL Shortener API.
 """
-from django.db.models import Sum
-from api.utils.views_utils import redirect_adapted
+from django.conf import settings
+from api.utils.views_utils import StatsCache, conditional_stats_response, redirect_adapted
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from api.mixins import HandleAPIExceptionMixin
-from api.serializers import OriginalUrlDataSerializer
-from shortening.constants import ZERO
-from shortening.models import ClientData, OriginalUrlData, ShortenedUrlData, UrlShorteningRequest
-from shortening.utils.url_shortening_utils import create_shortened_url
+from api.exceptions import ApiCustomException
+from api.mixins import HandleAPIExceptionMixin, ReplicaReadsMixin
+from api.serializers import OriginalUrlDataSerializer, TimeseriesQuerySerializer
+from shortening.models import OriginalUrlData, RollupWatermark, UniqueIpHitsCounter
+from shortening.utils.bulk_shortening_utils import shorten_url, shorten_urls
+from shortening.utils.url_shortening_utils import add_default_scheme, create_shortened_url, url_digest
 from shortening.utils.client_data_utils import get_client_ip
+from shortening.utils.key_resolution_utils import resolve_original_url
+from shortening.utils.write_behind_utils import click_counter
 
 # NOTE: introduce logging
 
+shortened_urls_count_cache = StatsCache(ttl=settings.STATS_CACHE_TTL)
+most_popular_urls_cache = StatsCache(ttl=settings.STATS_CACHE_TTL)  # by limit
 
-class FetchContentView(HandleAPIExceptionMixin, APIView):
+
+class FetchContentView(ReplicaReadsMixin, HandleAPIExceptionMixin, APIView):
     """
     Fetch original content via a shortened url.
 
@@ -31,15 +37,18 @@ class FetchContentView(HandleAPIExceptionMixin, APIView):
         ```
     """
 
+    not_found_detail = "Shortened url with key '{key}' is not found."
+
     def get(self, request, *args, **kwargs):
         key = kwargs.get("key")
-        shortened_url_data = ShortenedUrlData.objects.filter(key=key).first()
-        if shortened_url_data:
-            url = shortened_url_data.original_url_data.url
+        url = resolve_original_url(key)
+        if url:
+            if click_counter is not None:
+                click_counter.add(key)
             return redirect_adapted(url)
         else:
             return Response(
-                {"detail": f"Shortened url with key '{key}' is not found."},
+                {"detail": self.not_found_detail.format(key=key)},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
@@ -75,48 +84,94 @@ class ShortenUrlView(HandleAPIExceptionMixin, APIView):
     """
 
     def post(self, request, format=None):
-        # NOTE: consider omitting trailing slash, for "https://google.com" and "https://google.com/"
-        #  to be considered the same url.
-
-        # NOTE: also, regardless of protocol, urls could be considered the same,
-        #  e.g. "https://google.com" and "http://google.com"
-
-        # NOTE: and now, both concerns combined: protocol and trailing slash; both to be considered the same:
-        #  "https://google.com" and "http://google.com/"
+        # Urls differing by protocol or trailing slash only, e.g. "https://google.com" and "http://google.com/",
+        #  are considered the same url (see `canonicalize_url`); the first one shortened is kept,
+        #  upgraded to https when an https variant is shortened (see `is_https_url`).
 
         original_url = self.request.data.get("url")
 
         # NOTE: move it to the serializer (figure out a way to make validate() or validate_url() work).
-        if '://' not in original_url:
-            original_url = 'http://' + original_url
+        original_url = add_default_scheme(original_url)
 
-        key = ShortenedUrlData.create_unique_random_key()
-        shortened_url = create_shortened_url(key=key)
         server_serializer = OriginalUrlDataSerializer(data={
             "url": original_url,
         })
 
         if server_serializer.is_valid():
-            original_url_data, created_od = OriginalUrlData.objects.get_or_create(url=original_url)
-            shortened_url_data = ShortenedUrlData.objects.create(original_url_data=original_url_data, key=key)
+            key = shorten_url(original_url, get_client_ip(request))
+            shortened_url = create_shortened_url(key=key)
+            return Response({'shortened_url': shortened_url}, status=status.HTTP_201_CREATED)
+        else:
+            return Response(server_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-            client_ip = get_client_ip(request)
-            client_data, created_cd = ClientData.objects.get_or_create(client_ip=client_ip)
 
-            OriginalUrlData.increment_unique_ip_count(original_url, client_ip, original_url_data)
+class BulkShortenUrlView(HandleAPIExceptionMixin, APIView):
+    """
+    Shorten many urls at once.
 
-            _ = UrlShorteningRequest.objects.create(
-                client_data=client_data,
-                original_url_data=original_url_data,
-                shortened_url_data=shortened_url_data,
-            )
+    URL: `/shorten_urls/bulk/`
 
-            return Response({'shortened_url': shortened_url}, status=status.HTTP_201_CREATED)
-        else:
-            return Response(server_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    POST parameters example:
+        ```
+        [
+            {"url": "www.helloworld.com"},
+            {"url": "www.example_1111.com"}
+        ]
+        ```
 
+    POST response example (status 201). Results follow the order of the provided urls:
+        ```
+        [
+            {
+                "url": "www.helloworld.com",
+                "shortened_url": "http://www.your_service.com/OUOYFY48"
+            },
+            {
+                "url": "www.example_1111.com",
+                "errors": {"url": ["Enter a valid URL."]}
+            }
+        ]
+        ```
 
-class ShortenedUrlsCountView(HandleAPIExceptionMixin, APIView):
+    POST response example (status 400). Use case: no valid url provided; same body as above.
+
+    POST response example (status 400). Use case: not a list, or too many urls provided:
+        ```
+        {"detail": "Expected a list of at most 10000 items."}
+        ```
+    """
+
+    def post(self, request, format=None):
+        items = request.data
+        max_urls = settings.BULK_SHORTEN_MAX_URLS
+        if not isinstance(items, list) or len(items) > max_urls:
+            raise ApiCustomException(f"Expected a list of at most {max_urls} items.")
+
+        items = [
+            {**item, "url": add_default_scheme(item["url"])}
+            if isinstance(item, dict) and isinstance(item.get("url"), str) else item
+            for item in items
+        ]
+        server_serializer = OriginalUrlDataSerializer(data=items, many=True)
+        server_serializer.is_valid()
+        errors = server_serializer.errors if server_serializer.errors else [{}] * len(items)
+
+        valid_urls = [item["url"] for item, item_errors in zip(items, errors) if not item_errors]
+        keys = iter(shorten_urls(valid_urls, get_client_ip(request)) if valid_urls else [])
+
+        results = []
+        for item, item_errors in zip(request.data, errors):
+            url = item.get("url") if isinstance(item, dict) else item
+            if item_errors:
+                results.append({"url": url, "errors": item_errors})
+            else:
+                results.append({"url": url, "shortened_url": create_shortened_url(key=next(keys))})
+
+        response_status = status.HTTP_201_CREATED if valid_urls else status.HTTP_400_BAD_REQUEST
+        return Response(results, status=response_status)
+
+
+class ShortenedUrlsCountView(ReplicaReadsMixin, HandleAPIExceptionMixin, APIView):
     """
     Show how many urls have been shortened.
 
@@ -132,19 +187,29 @@ class ShortenedUrlsCountView(HandleAPIExceptionMixin, APIView):
         ```
         3
         ```
+
+    GET response example (status 304): no content, if the `If-None-Match`
+    request header matches the `ETag` of the current count.
+
+    NOTE: the count is computed at most every `STATS_CACHE_TTL` seconds per worker,
+    except for clients that wrote recently (pinned to the primary), which always get a fresh count.
     """
 
     def get(self, request, *args, **kwargs):
-        count = OriginalUrlData.objects.aggregate(
-            Sum("unique_ip_hits")
-        ).get("unique_ip_hits__sum") or ZERO
-        return Response(count, status=status.HTTP_200_OK)
+        entry = shortened_urls_count_cache.get(request=request)
+        if entry is None:
+            entry = shortened_urls_count_cache.set(UniqueIpHitsCounter.total())
+        return conditional_stats_response(
+            request, entry, settings.STATS_CACHE_TTL, lambda count: Response(count, status=status.HTTP_200_OK),
+        )
 
 
-class MostPopularUrlsView(HandleAPIExceptionMixin, generics.ListAPIView):
+class MostPopularUrlsView(ReplicaReadsMixin, HandleAPIExceptionMixin, generics.ListAPIView):
     """
     Return a list of the 10 most shortened urls.
 
+    URL: `/most_popular_urls/`, optionally with a `limit` query parameter, e.g. `/most_popular_urls/?limit=20`.
+
     NOTE: could be an empty list, if no requests were made to shorten an url.
 
     GET response example (status 200). Use case: if John made a request to shorten www.google.com,
@@ -157,11 +222,122 @@ class MostPopularUrlsView(HandleAPIExceptionMixin, generics.ListAPIView):
             ]
             ```
 
+    GET response example (status 400). Use case: invalid limit provided:
+        ```
+        {"detail": "Expected 'limit' to be an integer between 1 and 100."}
+        ```
+
     NOTE: Same prerequisite here. If Bob makes 20 requests from the same IP to shorten the same url,
     then the number of shortened urls count should only increase by one,
     i.e. in this case, the count increases by the number of unique urls provided from Bob's IP.
+
+    NOTE: urls equally popular are listed in the order they were first shortened.
+
+    NOTE: supports conditional requests and caching the same way as `ShortenedUrlsCountView`.
     """
 
     LIMIT = 10
+    # Matches the `original_url_popularity_idx` index.
+    ORDERING = ("-unique_ip_hits", "id")
     serializer_class = OriginalUrlDataSerializer
-    queryset = OriginalUrlData.objects.all().order_by("-unique_ip_hits")[:LIMIT]
+
+    def get_queryset(self):
+        limit = self.get_limit(self.request.query_params)
+        return OriginalUrlData.objects.only("url").order_by(*self.ORDERING)[:limit]
+
+    def list(self, request, *args, **kwargs):
+        limit = self.get_limit(request.query_params)
+        entry = most_popular_urls_cache.get(limit, request)
+        if entry is None:
+            entry = most_popular_urls_cache.set(self.get_serializer(self.get_queryset(), many=True).data, limit)
+        return conditional_stats_response(
+            request, entry, settings.STATS_CACHE_TTL, lambda urls: Response(urls, status=status.HTTP_200_OK),
+        )
+
+    @classmethod
+    def get_limit(cls, query_params) -> int:
+        """
+        Validated number of urls to list.
+        """
+        max_limit = settings.MOST_POPULAR_URLS_MAX_LIMIT
+        try:
+            limit = int(query_params.get("limit", cls.LIMIT))
+        except ValueError:
+            limit = None
+        if limit is None or not 1 <= limit <= max_limit:
+            raise ApiCustomException(f"Expected 'limit' to be an integer between 1 and {max_limit}.")
+        return limit
+
+
+class StatsTimeseriesView(ReplicaReadsMixin, HandleAPIExceptionMixin, APIView):
+    """
+    Show shortening requests of an url over time, per hour or per day.
+
+    URL: `/stats/timeseries/?url=<url>`, optionally with `granularity` ('hour' or 'day'),
+    `start` and `end` (ISO 8601 datetimes) query parameters,
+    e.g. `/stats/timeseries/?url=www.google.com&granularity=day&start=2022-10-01T00:00:00Z`.
+    The range defaults to the last 24 buckets.
+
+    NOTE: served from rollups only (see `manage.py update_rollups`), so the cost of a request
+    depends on the number of buckets rather than on the number of requests.
+    Buckets without requests are omitted; buckets from `complete_until` on are not rolled up yet.
+
+    GET response example (status 200):
+        ```
+        {
+            "url": "https://www.google.com",
+            "granularity": "hour",
+            "start": "2022-10-04T00:00:00Z",
+            "end": "2022-10-05T00:00:00Z",
+            "complete_until": "2022-10-04T15:00:00Z",
+            "buckets": [
+                {"start": "2022-10-04T09:00:00Z", "requests": 3, "unique_clients": 2},
+                {"start": "2022-10-04T14:00:00Z", "requests": 1, "unique_clients": 1}
+            ]
+        }
+        ```
+
+    GET response example (status 400). Use case: too large a range provided:
+        ```
+        {"non_field_errors": ["Expected a range of at most 1000 buckets."]}
+        ```
+
+    GET response example (status 404):
+        ```
+        {"detail": "Url 'www.google.com' has never been shortened."}
+        ```
+    """
+
+    not_found_detail = "Url '{url}' has never been shortened."
+
+    def get(self, request, *args, **kwargs):
+        query_serializer = TimeseriesQuerySerializer(data=request.query_params)
+        if not query_serializer.is_valid():
+            return Response(query_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        query = query_serializer.validated_data
+        rollup = query["rollup"]
+
+        original_url_data = OriginalUrlData.objects.only("url").filter(
+            url_digest=url_digest(add_default_scheme(query["url"])),
+        ).first()
+        if original_url_data is None:
+            raise ApiCustomException(self.not_found_detail.format(url=query["url"]), status.HTTP_404_NOT_FOUND)
+
+        buckets = rollup.objects.filter(
+            original_url_data=original_url_data, bucket__gte=query["start"], bucket__lt=query["end"],
+        ).order_by("bucket").values_list("bucket", "requests", "unique_clients")
+        complete_until = RollupWatermark.objects.filter(granularity=rollup.GRANULARITY).values_list(
+            "closed_until", flat=True,
+        ).first()
+
+        return Response({
+            "url": original_url_data.url,
+            "granularity": rollup.GRANULARITY,
+            "start": query["start"],
+            "end": query["end"],
+            "complete_until": complete_until,
+            "buckets": [
+                {"start": bucket, "requests": requests, "unique_clients": unique_clients}
+                for bucket, requests, unique_clients in buckets
+            ],
+        }, status=status.HTTP_200_OK)
@@ -1,25 +1,241 @@
 """
 URL shortener load tests.
+
+Mixed workload (`MixedWorkloadUser`): each user shortens a few seed urls on start, then redirects
+(Zipf-distributed over all seed keys: a few keys get most of the traffic), shortens new and already
+shortened urls, and reads stats, with configurable weights. With `LOCUST_TRACE_PATH` set, a JSONL trace
+of requests is replayed instead (`TraceReplayUser`), each line being e.g.:
+    {"method": "GET", "path": "/AbCdEfGh/", "offset": 0.25}
+    {"method": "POST", "path": "/shorten_url/", "json": {"url": "https://www.example.com"}, "offset": 0.3}
+("offset": seconds since the start of the trace, used to pace the replay with `LOCUST_TRACE_SPEED`).
+
+When a run ends, p50/p95/p99 latencies, failure ratios and throughput per endpoint are written
+to `LOCUST_REPORT_PATH` and checked against the SLOs of `LOCUST_SLOS_PATH`;
+the run exits with code 1 if any is not met (see README).
 """
-from locust import HttpUser, task
+import bisect
+import itertools
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from os import getenv
 
+import gevent
+from locust import HttpUser, between, constant, events, task
+from locust.exception import StopUser
+from locust.runners import WorkerRunner
 
-class UrlShorteningUser(HttpUser):
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-    @task
+# Seed urls shortened by each user on start, whose keys are redirected to.
+SEED_KEYS = int(getenv("LOCUST_SEED_KEYS", "20"))
+# Exponent of the Zipf distribution of redirects over seed keys (0 for uniform).
+ZIPF_EXPONENT = float(getenv("LOCUST_ZIPF_EXPONENT", "1.1"))
+# Relative weights of redirects (reads), shortenings (writes) and stats requests.
+REDIRECT_WEIGHT = int(getenv("LOCUST_REDIRECT_WEIGHT", "20"))
+SHORTEN_WEIGHT = int(getenv("LOCUST_SHORTEN_WEIGHT", "2"))
+STATS_WEIGHT = int(getenv("LOCUST_STATS_WEIGHT", "1"))
+# Fraction of shortenings of urls shortened already (by any user).
+REPEAT_URL_RATIO = float(getenv("LOCUST_REPEAT_URL_RATIO", "0.3"))
+MIN_WAIT = float(getenv("LOCUST_MIN_WAIT", "0.1"))  # seconds
+MAX_WAIT = float(getenv("LOCUST_MAX_WAIT", "1"))  # seconds
+
+TRACE_PATH = getenv("LOCUST_TRACE_PATH", "")
+# Replay speed relative to the trace offsets (2 for twice as fast), 0 to replay as fast as possible.
+TRACE_SPEED = float(getenv("LOCUST_TRACE_SPEED", "0"))
+# Replay the trace again once done, rather than stopping the run.
+TRACE_LOOP = getenv("LOCUST_TRACE_LOOP") == "true"
+
+SLOS_PATH = getenv("LOCUST_SLOS_PATH", os.path.join(BASE_DIR, "config", "locust", "slos.json"))
+REPORT_PATH = getenv("LOCUST_REPORT_PATH", "locust_report.json")
+
+REDIRECT_NAME = "/[key]/"
+STATS_PATHS = ("/shortened_urls_count/", "/most_popular_urls/")
+API_PATHS = ("/shorten_url/", "/shorten_urls/bulk/", "/stats/timeseries/") + STATS_PATHS
+
+logger = logging.getLogger(__name__)
+
+
+class ZipfKeys:
+    """
+    Keys shared by all users of a locust process, drawn with Zipf-distributed probabilities:
+    the n-th key added is drawn with a probability proportional to `1 / n ** exponent`.
+    """
+
+    def __init__(self, exponent: float):
+        self.exponent = exponent
+        self.keys = []
+        self.cumulative_weights = []
+
+    def add(self, key: str):
+        weight = 1 / (len(self.keys) + 1) ** self.exponent
+        self.keys.append(key)
+        self.cumulative_weights.append((self.cumulative_weights[-1] if self.cumulative_weights else 0) + weight)
+
+    def draw(self):
+        if not self.keys:
+            return None
+        point = random.random() * self.cumulative_weights[-1]
+        return self.keys[bisect.bisect_right(self.cumulative_weights, point)]
+
+
+seed_keys = ZipfKeys(ZIPF_EXPONENT)
+shortened_urls = []
+
+
+def new_url() -> str:
+    return f"https://load-test.example/{uuid.uuid4().hex}"
+
+
+def key_of(response):
+    """
+    Key of the shortened url of a shortening response, if it succeeded.
+    """
+    if response.status_code != 201:
+        return None
+    return response.json()["shortened_url"].rstrip("/").rsplit("/", 1)[-1]
+
+
+class MixedWorkloadUser(HttpUser):
+    """
+    Redirects, shortenings (of new and repeat urls) and stats requests.
+    """
+
+    abstract = bool(TRACE_PATH)
+    wait_time = between(MIN_WAIT, MAX_WAIT)
+
+    def on_start(self):
+        for _ in range(SEED_KEYS):
+            url = new_url()
+            key = key_of(self.client.post("/shorten_url/", json={"url": url}, name="/shorten_url/ (seed)"))
+            if key:
+                seed_keys.add(key)
+                shortened_urls.append(url)
+
+    @task(REDIRECT_WEIGHT)
+    def redirect(self):
+        key = seed_keys.draw()
+        if key:
+            # The original urls are not fetched: only the redirects are measured.
+            self.client.get(f"/{key}/", name=REDIRECT_NAME, allow_redirects=False)
+
+    @task(SHORTEN_WEIGHT)
     def shorten_url(self):
-        self.client.post("/shorten_url/", data={"url": "https://google.com"})
-
-    # @task
-    # def shorten_url_fetch_content(self):
-    #     url_key = "nonnonn0"  # 404 -> failure on locust ui
-    #     for i in range(10):
-    #         self.client.get(f"/{url_key}/")
-
-    # @task
-    # def shortened_urls_count(self):
-    #     self.client.get("/shortened_urls_count/")
-    #
-    # @task
-    # def most_popular_urls(self):
-    #     self.client.get("/most_popular_urls/")
+        repeat = shortened_urls and random.random() < REPEAT_URL_RATIO
+        url = random.choice(shortened_urls) if repeat else new_url()
+        self.client.post("/shorten_url/", json={"url": url})
+        if not repeat:
+            shortened_urls.append(url)
+
+    @task(STATS_WEIGHT)
+    def stats(self):
+        self.client.get(random.choice(STATS_PATHS))
+
+
+def load_trace(path: str) -> list:
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+class TraceReplayUser(HttpUser):
+    """
+    Replay of the requests of a trace (`LOCUST_TRACE_PATH`), shared by all users of a locust process.
+    """
+
+    abstract = not TRACE_PATH
+    wait_time = constant(0)
+    records = None
+    started_at = None
+    # Users still replaying: the run is quit once the last one is done with the trace.
+    replaying = 0
+
+    def on_start(self):
+        cls = type(self)
+        if cls.records is None:
+            trace = load_trace(TRACE_PATH)
+            cls.records = itertools.cycle(trace) if TRACE_LOOP else iter(trace)
+            cls.started_at = time.monotonic()
+        cls.replaying += 1
+
+    @task
+    def replay(self):
+        record = next(self.records, None)
+        if record is None:
+            cls = type(self)
+            cls.replaying -= 1
+            if not cls.replaying:
+                logger.info("The trace has been replayed.")
+                # Not quit from this user's greenlet, which the runner kills while stopping users.
+                gevent.spawn(self.environment.runner.quit)
+            raise StopUser()
+        if TRACE_SPEED and "offset" in record:
+            delay = self.started_at + record["offset"] / TRACE_SPEED - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        path = record["path"]
+        self.client.request(
+            record.get("method", "GET"),
+            path,
+            json=record.get("json"),
+            name=path.split("?")[0] if path.split("?")[0] in API_PATHS else REDIRECT_NAME,
+            allow_redirects=False,
+        )
+
+
+def endpoint_report(entry) -> dict:
+    return {
+        "requests": entry.num_requests,
+        "failures": entry.num_failures,
+        "failure_ratio": entry.fail_ratio,
+        "p50": entry.get_response_time_percentile(0.5),
+        "p95": entry.get_response_time_percentile(0.95),
+        "p99": entry.get_response_time_percentile(0.99),
+        "rps": entry.total_rps,
+    }
+
+
+def slo_violations(endpoints: dict, slos: dict) -> list:
+    """
+    SLOs not met: latencies (milliseconds) over `p50`/`p95`/`p99`, a failure ratio over
+    `max_failure_ratio`, or a throughput under `min_rps`.
+    """
+    violations = []
+    for name, slo in slos.items():
+        report = endpoints.get(name)
+        if report is None or not report["requests"]:
+            continue
+        for percentile in ("p50", "p95", "p99"):
+            if percentile in slo and report[percentile] > slo[percentile]:
+                violations.append(f"{name}: {percentile} {report[percentile]:.0f} ms > {slo[percentile]} ms")
+        if "max_failure_ratio" in slo and report["failure_ratio"] > slo["max_failure_ratio"]:
+            violations.append(
+                f"{name}: failure ratio {report['failure_ratio']:.4f} > {slo['max_failure_ratio']}"
+            )
+        if "min_rps" in slo and report["rps"] < slo["min_rps"]:
+            violations.append(f"{name}: {report['rps']:.1f} requests/s < {slo['min_rps']}")
+    return violations
+
+
+@events.quitting.add_listener
+def report_slos(environment, **kwargs):
+    """
+    Write per-endpoint latencies and throughput, and fail the run if SLOs are not met.
+    """
+    if isinstance(environment.runner, WorkerRunner):
+        return  # Reported by the master, with the stats of all workers.
+
+    stats = environment.runner.stats
+    endpoints = {name: endpoint_report(entry) for (name, _), entry in stats.entries.items()}
+    endpoints[stats.total.name] = endpoint_report(stats.total)
+    with open(SLOS_PATH) as slos_file:
+        violations = slo_violations(endpoints, json.load(slos_file))
+
+    with open(REPORT_PATH, "w") as report_file:
+        json.dump({"endpoints": endpoints, "slo_violations": violations}, report_file, indent=2)
+    for violation in violations:
+        logger.error("SLO not met: %s", violation)
+    if violations:
+        environment.process_exit_code = 1
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ShorteningConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shortening'
+
+    def ready(self):
+        from shortening import signals  # NOQA
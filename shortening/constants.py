@@ -1,8 +1,15 @@
 """
 Various constants used for URLs shortening.
 """
+import string
 
 # Expected length of a shortened URL's key
 KEY_LENGTH = 8
 
+# Characters a shortened URL's key is made of
+KEY_ALPHABET = string.ascii_uppercase + string.digits
+
+# Postgres sequence numbering keys issued by the block key allocator
+KEY_SEQUENCE_NAME = "shortened_url_key_seq"
+
 ZERO = 0
@@ -0,0 +1,73 @@
+"""
+Compare CPU time per redirect served by the fast path middleware and by `FetchContentView`.
+"""
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, transaction
+from django.test import RequestFactory, override_settings
+
+from shortening.utils.bulk_shortening_utils import shorten_url
+
+# Requests of a mode are timed after its first few (imports, caches and connections warmed up).
+WARMUP_REQUESTS = 100
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve redirects of an existing key and 404s of a missing key through the whole WSGI stack, "
+        "with and without the redirect fast path, and compare CPU time per request. Keys resolve from "
+        "the in-process cache after their first request, so this measures the framework overhead. "
+        "The shortened url is created in a transaction which is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=10000, help="Requests per key and mode.")
+
+    def handle(self, *args, **options):
+        # As in Django's test client: the transaction must survive requests.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+        try:
+            with transaction.atomic():
+                key = shorten_url("https://benchmark.example/landing", "127.0.0.1")
+                results = {
+                    (label, enabled): self.time_requests(f"/{path_key}/", enabled, options["requests"])
+                    for label, path_key in (("redirect", key), ("not found", "NONEXIST"))
+                    for enabled in (False, True)
+                }
+                transaction.set_rollback(True)
+        finally:
+            for signal in (request_started, request_finished):
+                signal.connect(close_old_connections)
+
+        self.stdout.write(f"{options['requests']} requests per key and mode, CPU time per request:")
+        for label in ("redirect", "not found"):
+            view_seconds, fast_path_seconds = results[label, False], results[label, True]
+            self.stdout.write(
+                f"{label}: view {view_seconds * 10 ** 6:.0f} µs, fast path {fast_path_seconds * 10 ** 6:.0f} µs "
+                f"({view_seconds / fast_path_seconds:.1f}x)."
+            )
+
+    @staticmethod
+    def time_requests(path: str, fast_path_enabled: bool, requests: int) -> float:
+        """
+        CPU seconds per request to the path.
+        """
+        with override_settings(REDIRECT_FAST_PATH_ENABLED=fast_path_enabled):
+            handler = WSGIHandler()
+        request_factory = RequestFactory()
+        environs = [request_factory.get(path).environ for _ in range(WARMUP_REQUESTS + requests)]
+
+        def start_response(status, headers):
+            pass
+
+        for index, environ in enumerate(environs):
+            if index == WARMUP_REQUESTS:
+                started_at = time.process_time()
+            response = handler(environ, start_response)
+            b"".join(response)
+            response.close()
+        return (time.process_time() - started_at) / requests
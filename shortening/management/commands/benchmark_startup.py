@@ -0,0 +1,89 @@
+"""
+Compare worker startup time and per-request overhead of the settings profiles.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+PROFILES = ("full", "api")
+
+# Run in a fresh interpreter per profile and run: boots the WSGI application like a gunicorn worker,
+# then serves a first request and more requests (of the stats endpoint, cached after the first one).
+WORKER_SCRIPT = """
+import io, json, os, sys, time
+
+started_at = time.perf_counter()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "url_shortener.settings")
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+loaded_at = time.perf_counter()
+
+def request(path):
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": path, "SCRIPT_NAME": "", "QUERY_STRING": "",
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(), "wsgi.errors": sys.stderr,
+    }
+    statuses = []
+    response = application(environ, lambda status, headers: statuses.append(status))
+    b"".join(response)
+    response.close()
+    return statuses[0]
+
+status = request("/shortened_urls_count/")
+first_response_at = time.perf_counter()
+cpu_started_at = time.process_time()
+for _ in range(int(sys.argv[1])):
+    request("/shortened_urls_count/")
+print(json.dumps({
+    "status": status,
+    "load": loaded_at - started_at,
+    "first_request": first_response_at - loaded_at,
+    "request_cpu": (time.process_time() - cpu_started_at) / int(sys.argv[1]),
+}))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Boot the WSGI application in fresh processes with each settings profile (see SETTINGS_PROFILE), "
+        "and compare median times to import and set it up, to serve the first request "
+        "(url and view imports, database connection) and CPU time per subsequent request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Processes per profile.")
+        parser.add_argument("--requests", type=int, default=1000, help="Requests per process after the first.")
+
+    def handle(self, *args, **options):
+        for profile in PROFILES:
+            runs = [self.run_worker(profile, options["requests"]) for _ in range(options["runs"])]
+            load, first_request, request_cpu = (
+                statistics.median(run[measure] for run in runs)
+                for measure in ("load", "first_request", "request_cpu")
+            )
+            self.stdout.write(
+                f"{profile}: load {load * 1000:.0f} ms, first request {first_request * 1000:.0f} ms, "
+                f"{request_cpu * 10 ** 6:.0f} µs CPU per request."
+            )
+
+    @staticmethod
+    def run_worker(profile: str, requests: int) -> dict:
+        process = subprocess.run(
+            [sys.executable, "-c", WORKER_SCRIPT, str(requests)],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "SETTINGS_PROFILE": profile},
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode:
+            raise CommandError(f"The {profile} worker failed:\n{process.stderr}")
+        run = json.loads(process.stdout.splitlines()[-1])
+        if run["status"] != "200 OK":
+            raise CommandError(f"The {profile} worker responded {run['status']}:\n{process.stderr}")
+        return run
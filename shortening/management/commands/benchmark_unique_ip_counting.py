@@ -0,0 +1,109 @@
+"""
+Compare exact and approximate unique-ip counting of original urls.
+"""
+import ipaddress
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+
+from shortening.models import ClientData, OriginalUrlData
+from shortening.utils.hyperloglog_utils import HyperLogLog, precision_for_error_rate
+from shortening.utils.url_shortening_utils import url_digest
+
+# Clients get addresses from the range reserved for benchmarks (RFC 2544).
+BENCHMARK_NETWORK = ipaddress.ip_network("198.18.0.0/15")
+
+
+class Command(BaseCommand):
+    help = (
+        "Count the same synthetic (url, client) pairs in the 'exact' and 'approximate' modes, "
+        "and report storage, write cost and estimation error. "
+        "Everything is done in a transaction which is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--urls", type=int, default=100)
+        parser.add_argument("--clients", type=int, default=20000)
+        parser.add_argument("--requests", type=int, default=100000)
+        parser.add_argument("--batch-size", type=int, default=1, help="Pairs counted per call.")
+        parser.add_argument("--error-rate", type=float, default=settings.UNIQUE_IP_SKETCH_ERROR_RATE)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        precision = precision_for_error_rate(options["error_rate"])
+
+        with transaction.atomic():
+            client_data_ids = self.create_clients(options["clients"])
+            # Skewed popularity: a few urls get most requests.
+            requests = [
+                (int(options["urls"] * rng.random() ** 3), rng.choice(client_data_ids))
+                for _ in range(options["requests"])
+            ]
+            expected_counts = {}
+            for url_index, client_data_id in set(requests):
+                expected_counts[url_index] = expected_counts.get(url_index, 0) + 1
+
+            for mode in ("exact", "approximate"):
+                url_ids = [
+                    original_url_data.id for original_url_data in OriginalUrlData.objects.bulk_create(
+                        OriginalUrlData(url=url, url_digest=url_digest(url))
+                        for url in (f"https://{mode}-{index}.benchmark.example/" for index in range(options["urls"]))
+                    )
+                ]
+                size_before = self.relation_size("original_url_client")
+                started_at = time.perf_counter()
+                for start in range(0, len(requests), options["batch_size"]):
+                    batch = requests[start:start + options["batch_size"]]
+                    original_url_data_ids = [url_ids[url_index] for url_index, _ in batch]
+                    client_ids = [client_data_id for _, client_data_id in batch]
+                    if mode == "exact":
+                        OriginalUrlData.record_unique_clients(original_url_data_ids, client_ids)
+                    else:
+                        OriginalUrlData.sketch_unique_clients(original_url_data_ids, client_ids, precision)
+                elapsed = time.perf_counter() - started_at
+
+                if mode == "exact":
+                    storage = self.relation_size("original_url_client") - size_before
+                else:
+                    storage = OriginalUrlData.objects.filter(id__in=url_ids).aggregate(
+                        size=Sum(Length("unique_ip_sketch")),
+                    )["size"] or 0
+                counts = dict(OriginalUrlData.objects.filter(id__in=url_ids).values_list("id", "unique_ip_hits"))
+                errors = [
+                    abs(counts[url_ids[url_index]] - expected) / expected
+                    for url_index, expected in expected_counts.items()
+                ]
+                self.stdout.write(
+                    f"{mode}: {storage} bytes of storage, "
+                    f"{elapsed / len(requests) * 1000:.3f} ms per request, "
+                    f"mean error {sum(errors) / len(errors):.2%}, max error {max(errors):.2%}."
+                )
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{len(expected_counts)} urls, {sum(expected_counts.values())} unique (url, client) pairs; "
+            f"sketch precision {precision}, standard error {HyperLogLog(precision).standard_error:.2%}."
+        )
+
+    @staticmethod
+    def create_clients(count):
+        clients = ClientData.objects.bulk_create(
+            (ClientData(client_ip=str(BENCHMARK_NETWORK[index])) for index in range(count)),
+            ignore_conflicts=True,
+        )
+        return list(ClientData.objects.filter(
+            client_ip__in=[client.client_ip for client in clients],
+        ).values_list("id", flat=True))
+
+    @staticmethod
+    def relation_size(table):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            return cursor.fetchone()[0]
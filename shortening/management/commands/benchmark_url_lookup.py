@@ -0,0 +1,98 @@
+"""
+Compare original url lookups by raw url and by url digest.
+"""
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from shortening.models import OriginalUrlData
+from shortening.utils.url_shortening_utils import url_digest
+
+# Indexes a unique `URLField` gets on PostgreSQL, as `OriginalUrlData.url` had.
+URL_INDEXES_SQL = [
+    "CREATE UNIQUE INDEX benchmark_url_idx ON original_url_data (url)",
+    "CREATE INDEX benchmark_url_like_idx ON original_url_data (url varchar_pattern_ops)",
+]
+
+INDEX_SIZE_SQL = "SELECT pg_relation_size(%s::regclass)"
+
+DIGEST_INDEX_NAME_SQL = """
+    SELECT indexname FROM pg_indexes
+    WHERE tablename = 'original_url_data' AND indexdef LIKE '%%(url_digest)%%'
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Insert synthetic urls, then compare index sizes and lookup latency of the raw url indexes "
+        "(as before url digests) and of the url digest index. "
+        "Everything is done in a transaction which is rolled back; "
+        "writes to original urls are blocked meanwhile, so do not run it against a live database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--urls", type=int, default=100000)
+        parser.add_argument("--url-length", type=int, default=180, help="Length of synthetic tracking urls.")
+        parser.add_argument("--lookups", type=int, default=10000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        urls = [self.create_url(rng, index, options["url_length"]) for index in range(options["urls"])]
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            OriginalUrlData.objects.bulk_create(
+                (OriginalUrlData(url=url, url_digest=url_digest(url)) for url in urls),
+                batch_size=5000,
+            )
+            for sql in URL_INDEXES_SQL:
+                cursor.execute(sql)
+            cursor.execute(DIGEST_INDEX_NAME_SQL)
+            digest_index = cursor.fetchone()[0]
+            # Rebuilt for its size to be comparable with the indexes built at once.
+            cursor.execute(f"REINDEX INDEX {digest_index}")
+            cursor.execute("ANALYZE original_url_data")
+
+            url_index_size = 0
+            for index in ("benchmark_url_idx", "benchmark_url_like_idx"):
+                cursor.execute(INDEX_SIZE_SQL, [index])
+                url_index_size += cursor.fetchone()[0]
+            cursor.execute(INDEX_SIZE_SQL, [digest_index])
+            digest_index_size = cursor.fetchone()[0]
+
+            lookups = [rng.choice(urls) for _ in range(options["lookups"])]
+            url_lookup_seconds = self.time_lookups(
+                cursor, "SELECT id FROM original_url_data WHERE url = %s", lookups, lambda url: url,
+            )
+            digest_lookup_seconds = self.time_lookups(
+                cursor, "SELECT id FROM original_url_data WHERE url_digest = %s", lookups, url_digest,
+            )
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"{options['urls']} urls of {options['url_length']} characters, {options['lookups']} lookups."
+        )
+        self.stdout.write(
+            f"url: {url_index_size / 2 ** 20:.1f} MiB of indexes, "
+            f"{url_lookup_seconds / len(lookups) * 10 ** 6:.0f} µs per lookup."
+        )
+        self.stdout.write(
+            f"url digest: {digest_index_size / 2 ** 20:.1f} MiB of indexes, "
+            f"{digest_lookup_seconds / len(lookups) * 10 ** 6:.0f} µs per lookup (digest included)."
+        )
+
+    @staticmethod
+    def create_url(rng, index, length):
+        url = f"https://benchmark-{index}.example/landing?utm_source=newsletter&ref="
+        return url + "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=max(length - len(url), 0)))
+
+    @staticmethod
+    def time_lookups(cursor, sql, urls, lookup_value):
+        started_at = time.perf_counter()
+        for url in urls:
+            cursor.execute(sql, [lookup_value(url)])
+            cursor.fetchone()
+        return time.perf_counter() - started_at
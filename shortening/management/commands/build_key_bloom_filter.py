@@ -0,0 +1,50 @@
+"""
+Build the Bloom filter of existing shortened url keys and save it to disk.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shortening.utils.key_resolution_utils import KeyBloomFilter
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the Bloom filter of existing keys from a full scan and save it, "
+        "so workers load it instead of scanning the table on startup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=settings.KEY_BLOOM_FILTER_PATH,
+            help="Filter file path (defaults to the KEY_BLOOM_FILTER_PATH setting).",
+        )
+        parser.add_argument(
+            "--capacity",
+            type=int,
+            default=settings.KEY_BLOOM_FILTER_CAPACITY,
+            help="Expected number of keys; the actual number of keys is used if larger.",
+        )
+        parser.add_argument(
+            "--false-positive-rate",
+            type=float,
+            default=settings.KEY_BLOOM_FILTER_FALSE_POSITIVE_RATE,
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not path:
+            raise CommandError("Filter path is not configured; provide --path or set KEY_BLOOM_FILTER_PATH.")
+
+        bloom_filter = KeyBloomFilter(
+            capacity=options["capacity"],
+            false_positive_rate=options["false_positive_rate"],
+        ).rebuild()
+        bloom_filter.dump(path)
+
+        stats = bloom_filter.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved {stats['count']} keys into '{path}': {stats['memory_bytes']} bytes, "
+            f"{stats['hash_count']} hash functions, "
+            f"estimated false positive rate {stats['estimated_false_positive_rate']:.4%}."
+        ))
@@ -0,0 +1,47 @@
+"""
+Build unique-ip sketches of original urls from recorded shortening requests.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shortening.models import OriginalUrlData, UrlShorteningRequest
+from shortening.utils.hyperloglog_utils import precision_for_error_rate
+
+
+class Command(BaseCommand):
+    help = (
+        "Add all recorded (url, client) pairs to the unique-ip sketches of original urls, "
+        "e.g. when switching to the 'approximate' unique-ip counting mode. "
+        "Adding pairs is idempotent, so the command can safely be re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=settings.UNIQUE_IP_SKETCH_ERROR_RATE,
+            help="Standard error of sketches (defaults to the UNIQUE_IP_SKETCH_ERROR_RATE setting).",
+        )
+        parser.add_argument("--batch-size", type=int, default=50000)
+
+    def handle(self, *args, **options):
+        precision = precision_for_error_rate(options["error_rate"])
+        pairs = UrlShorteningRequest.objects.values_list(
+            "original_url_data_id", "client_data_id",
+        ).distinct().order_by("original_url_data_id", "client_data_id")
+
+        batch, count = [], 0
+        for pair in pairs.iterator(chunk_size=options["batch_size"]):
+            batch.append(pair)
+            if len(batch) >= options["batch_size"]:
+                OriginalUrlData.sketch_unique_clients(*zip(*batch), precision)
+                count += len(batch)
+                batch = []
+        if batch:
+            OriginalUrlData.sketch_unique_clients(*zip(*batch), precision)
+            count += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {count} (url, client) pairs to sketches of precision {precision} "
+            f"({1 << precision} bytes per url)."
+        ))
@@ -0,0 +1,60 @@
+"""
+Export shortened url keys and their original urls into a redirect snapshot file.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.db.models.functions import Collate
+
+from shortening.models import ShortenedUrlData
+from shortening.utils.snapshot_utils import DELTA_SUFFIX, SnapshotFile, SnapshotFormatError, write_snapshot
+
+CHUNK_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the key -> original url mapping into a memory-mapped redirect snapshot. "
+        "Use --delta to only export keys created since the last full export."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default=settings.REDIRECT_SNAPSHOT_PATH,
+            help="Snapshot file path (defaults to the REDIRECT_SNAPSHOT_PATH setting).",
+        )
+        parser.add_argument(
+            "--delta",
+            action="store_true",
+            help="Export keys created after the full snapshot into '<path>.delta'.",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not path:
+            raise CommandError("Snapshot path is not configured; provide --path or set REDIRECT_SNAPSHOT_PATH.")
+
+        queryset = ShortenedUrlData.objects.all()
+        if options["delta"]:
+            try:
+                base_watermark = SnapshotFile(path).watermark
+            except (OSError, SnapshotFormatError):
+                raise CommandError(f"No full snapshot found at '{path}'; run a full export first.")
+            queryset = queryset.filter(id__gt=base_watermark)
+            target = path + DELTA_SUFFIX
+        else:
+            target = path
+
+        # Fix the upper bound first, so rows inserted during the export
+        # are left to the next delta instead of being half-exported.
+        watermark = queryset.aggregate(Max("id")).get("id__max") or 0
+        if options["delta"]:
+            watermark = max(watermark, base_watermark)
+        rows = queryset.filter(id__lte=watermark).order_by(
+            # Bytewise order, as expected by the snapshot binary search.
+            Collate("key", "C"),
+        ).values_list("key", "original_url_data__url").iterator(chunk_size=CHUNK_SIZE)
+
+        count = write_snapshot(target, rows, watermark)
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} keys into '{target}' (watermark: {watermark})."))
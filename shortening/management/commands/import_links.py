@@ -0,0 +1,312 @@
+"""
+Import link dumps (JSONL or CSV) into the shortening tables.
+"""
+import csv
+import io
+import ipaddress
+import itertools
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import URLValidator
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from shortening.models import ImportCheckpoint, OriginalUrlData, ShortenedUrlData, UniqueIpHitsCounter
+from shortening.utils.url_shortening_utils import add_default_scheme, url_digest
+
+STAGING_TABLE = "import_links_staging"
+
+OPTIONAL_FIELDS = ("key", "client_ip", "created_at")
+
+CREATE_STAGING_TABLE_SQL = f"""
+    CREATE TEMPORARY TABLE IF NOT EXISTS {STAGING_TABLE} (
+        url text NOT NULL,
+        key text NOT NULL,
+        client_ip inet,
+        created_at timestamptz,
+        url_digest uuid NOT NULL
+    ) ON COMMIT DELETE ROWS
+"""
+
+MERGE_ORIGINAL_URLS_SQL = f"""
+    INSERT INTO original_url_data (url, url_digest, unique_ip_hits, created_at, updated_at)
+    SELECT DISTINCT ON (url_digest) url, url_digest, 0, COALESCE(created_at, now()), now()
+    FROM {STAGING_TABLE}
+    ORDER BY url_digest, url ~* '^https:' DESC, created_at
+    ON CONFLICT (url_digest) DO UPDATE SET url = excluded.url, updated_at = excluded.updated_at
+    WHERE original_url_data.url !~* '^https:' AND excluded.url ~* '^https:'
+"""
+
+MERGE_CLIENTS_SQL = f"""
+    INSERT INTO client_data (client_ip, created_at, updated_at)
+    SELECT DISTINCT client_ip, now(), now()
+    FROM {STAGING_TABLE}
+    WHERE client_ip IS NOT NULL
+    ON CONFLICT (client_ip) DO NOTHING
+"""
+
+# Requests are only recorded for keys inserted by this very statement,
+# so re-importing records with keys (e.g. from another dump) does not duplicate them.
+# Records with keys taken already (or repeated in the batch) are not imported; some of those keys are returned.
+MERGE_SHORTENED_URLS_AND_REQUESTS_SQL = f"""
+    WITH staged AS (
+        SELECT DISTINCT ON (key) key, url_digest, client_ip, COALESCE(created_at, now()) AS created_at
+        FROM {STAGING_TABLE}
+        ORDER BY key
+    ),
+    shortened AS (
+        INSERT INTO shortened_url_data (key, original_url_data_id, created_at, updated_at)
+        SELECT staged.key, original_url_data.id, staged.created_at, now()
+        FROM staged
+        JOIN original_url_data ON original_url_data.url_digest = staged.url_digest
+        ON CONFLICT (key) DO NOTHING
+        RETURNING id, key, original_url_data_id
+    ),
+    requests AS (
+        INSERT INTO url_shortening_request (
+            client_data_id, original_url_data_id, shortened_url_data_id, created_at, updated_at
+        )
+        SELECT client_data.id, shortened.original_url_data_id, shortened.id, staged.created_at, now()
+        FROM shortened
+        JOIN staged ON staged.key = shortened.key
+        JOIN client_data ON client_data.client_ip = staged.client_ip
+        RETURNING original_url_data_id, client_data_id
+    ){{unique_ip_counts}}
+    SELECT (SELECT count(*) FROM shortened), (SELECT count(*) FROM requests), ARRAY(
+        SELECT staged.key FROM staged WHERE staged.key NOT IN (SELECT key FROM shortened) ORDER BY staged.key LIMIT %s
+    )
+"""
+
+# Keys of records not imported for a key conflict reported per batch.
+CONFLICTING_KEYS_REPORTED = 10
+
+# Exact unique-ip accounting of requests recorded by the statement above:
+# only (url, client) pairs it records first are counted, in url counts and the global counter.
+EXACT_UNIQUE_IP_COUNTS_SQL = """,
+    new_pairs AS (
+        INSERT INTO original_url_client (original_url_data_id, client_data_id)
+        SELECT DISTINCT original_url_data_id, client_data_id
+        FROM requests
+        ORDER BY original_url_data_id, client_data_id
+        ON CONFLICT DO NOTHING
+        RETURNING original_url_data_id
+    ),
+    deltas AS (
+        UPDATE original_url_data
+        SET unique_ip_hits = unique_ip_hits + hits.count, updated_at = now()
+        FROM (
+            SELECT original_url_data_id, count(*) AS count FROM new_pairs GROUP BY original_url_data_id
+        ) AS hits
+        WHERE original_url_data.id = hits.original_url_data_id
+        RETURNING hits.count AS delta
+    ),
+    counted AS (
+        INSERT INTO unique_ip_hits_counter (shard, value)
+        SELECT %s, sum(delta) FROM deltas HAVING sum(delta) <> 0
+        ON CONFLICT (shard) DO UPDATE SET value = unique_ip_hits_counter.value + excluded.value
+    )
+"""
+
+# In the approximate unique-ip counting mode, requests of staged keys are added to url sketches,
+# which is idempotent: a re-imported batch does not change them.
+STAGED_REQUESTS_SQL = f"""
+    SELECT url_shortening_request.original_url_data_id, url_shortening_request.client_data_id
+    FROM url_shortening_request
+    JOIN shortened_url_data ON shortened_url_data.id = url_shortening_request.shortened_url_data_id
+    JOIN {STAGING_TABLE} ON {STAGING_TABLE}.key = shortened_url_data.key
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a JSONL or CSV dump of links into the database, batch by batch, through COPY. "
+        "Records provide 'url' and optionally 'key', 'client_ip' and 'created_at' (strings). "
+        "Progress is checkpointed with each batch (in the database, by file path); re-run the command to resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to a .jsonl or .csv file.")
+        parser.add_argument(
+            "--format",
+            choices=["jsonl", "csv"],
+            help="Input format (defaults to the file extension).",
+        )
+        parser.add_argument("--batch-size", type=int, default=50000)
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore an existing checkpoint and import the file from the beginning.",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Importing links requires PostgreSQL.")
+
+        path = options["path"]
+        input_format = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if input_format not in ("jsonl", "csv"):
+            raise CommandError(f"Cannot tell the format of '{path}'; provide --format.")
+
+        self.url_max_length = OriginalUrlData._meta.get_field("url").max_length
+        self.key_max_length = ShortenedUrlData._meta.get_field("key").max_length
+        self.validate_url = URLValidator()
+
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(path=os.path.realpath(path))
+        if options["restart"]:
+            checkpoint.records = checkpoint.skipped = checkpoint.conflicts = 0
+            checkpoint.shortened = checkpoint.requests = 0
+            checkpoint.save()
+        elif checkpoint.records:
+            self.stdout.write(f"Resuming from record {checkpoint.records}.")
+
+        started_at = time.monotonic()
+        records_at_start = checkpoint.records
+        with open(path, newline="", encoding="utf-8") as file:
+            records = itertools.islice(self.read_records(file, input_format), checkpoint.records, None)
+            for batch_records in self.batches(records, options["batch_size"]):
+                batch = self.prepare(batch_records)
+                # The checkpoint is committed along with the batch: records without a key
+                # never get a second one generated when the import is resumed.
+                with transaction.atomic():
+                    shortened, requests, conflicting_keys = self.merge(batch)
+                    checkpoint.records += len(batch_records)
+                    checkpoint.skipped += len(batch_records) - len(batch)
+                    conflicts = len(batch) - shortened
+                    checkpoint.conflicts += conflicts
+                    checkpoint.shortened += shortened
+                    checkpoint.requests += requests
+                    checkpoint.save()
+
+                if conflicts:
+                    # Keys repeated in the batch are not listed.
+                    self.stderr.write(
+                        f"{conflicts} records not imported, their keys exist already: "
+                        f"{', '.join(conflicting_keys + (['...'] if conflicts > len(conflicting_keys) else []))}"
+                    )
+                elapsed = time.monotonic() - started_at
+                self.stdout.write(
+                    f"{checkpoint.records} records read, {checkpoint.shortened} keys and "
+                    f"{checkpoint.requests} requests imported, {checkpoint.skipped} records skipped, "
+                    f"{checkpoint.conflicts} with existing keys; "
+                    f"{(checkpoint.records - records_at_start) / elapsed:.0f} records/s."
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported '{path}': {checkpoint.shortened} keys, {checkpoint.requests} requests, "
+            f"{checkpoint.skipped} records skipped, {checkpoint.conflicts} with existing keys."
+        ))
+
+    @staticmethod
+    def read_records(file, input_format):
+        """
+        Yield records of the file, one per non-blank JSONL line (`None` if invalid) or per CSV row.
+
+        Streams the file, so memory use is bounded by the batch size.
+        """
+        if input_format == "csv":
+            # Quoted fields may span several lines.
+            yield from csv.DictReader(file)
+            return
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield None
+
+    @staticmethod
+    def batches(records, batch_size):
+        """
+        Yield lists of up to `batch_size` records.
+        """
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def prepare(self, records):
+        """
+        Validate records; return rows to stage, generating missing keys.
+
+        Records that are not objects, lack a url or have non-string fields are skipped.
+        """
+        rows = []
+        for record in records:
+            if not isinstance(record, dict) or not isinstance(record.get("url"), str):
+                continue
+            if any(not isinstance(record.get(field), (str, type(None))) for field in OPTIONAL_FIELDS):
+                continue
+            url = add_default_scheme(record["url"].strip())
+            key = record.get("key") or None
+            if len(url) > self.url_max_length or (key and len(key) > self.key_max_length):
+                continue
+            try:
+                self.validate_url(url)
+            except ValidationError:
+                continue
+            rows.append([url, key, self.parse_client_ip(record), self.parse_created_at(record), url_digest(url)])
+
+        missing_keys = [row for row in rows if row[1] is None]
+        for row, key in zip(missing_keys, ShortenedUrlData.create_unique_random_keys(len(missing_keys))):
+            row[1] = key
+        return rows
+
+    @staticmethod
+    def parse_client_ip(record):
+        try:
+            return str(ipaddress.ip_address(record.get("client_ip")))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_created_at(record):
+        try:
+            created_at = parse_datetime(record.get("created_at") or "")
+        except ValueError:
+            return None
+        return created_at.isoformat() if created_at else None
+
+    @staticmethod
+    def merge(rows):
+        """
+        COPY rows into the staging table and merge them set-wise, in the caller's transaction.
+
+        Return the number of imported keys and requests, and some keys of records not imported for a key conflict.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(["" if value is None else value for value in row])
+        buffer.seek(0)
+
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING_TABLE_SQL)
+            cursor.cursor.copy_expert(
+                f"COPY {STAGING_TABLE} (url, key, client_ip, created_at, url_digest) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+            cursor.execute(MERGE_ORIGINAL_URLS_SQL)
+            cursor.execute(MERGE_CLIENTS_SQL)
+            approximate = settings.UNIQUE_IP_COUNTING_MODE == "approximate"
+            cursor.execute(
+                MERGE_SHORTENED_URLS_AND_REQUESTS_SQL.format(
+                    unique_ip_counts="" if approximate else EXACT_UNIQUE_IP_COUNTS_SQL.rstrip(),
+                ),
+                [CONFLICTING_KEYS_REPORTED] if approximate
+                else [UniqueIpHitsCounter.random_shard(), CONFLICTING_KEYS_REPORTED],
+            )
+            shortened, requests, conflicting_keys = cursor.fetchone()
+            if approximate:
+                cursor.execute(STAGED_REQUESTS_SQL)
+                pairs = cursor.fetchall()
+                if pairs:
+                    OriginalUrlData.sketch_unique_clients(*zip(*pairs))
+        return shortened, requests, conflicting_keys
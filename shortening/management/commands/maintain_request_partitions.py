@@ -0,0 +1,77 @@
+"""
+Create upcoming monthly partitions of shortening requests, and drop partitions past the retention.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from shortening.utils.partition_utils import create_partition, detach_partition, get_partitions, month_start
+
+# Partitions of at least this many months after the current one are kept, so that a missed run
+# (or one failing until someone steps in) does not leave requests in the default partition,
+# from which creating their partition has to move them.
+MIN_MONTHS_AHEAD = 2
+
+
+class Command(BaseCommand):
+    help = (
+        "Create monthly partitions of shortening requests up to a number of months ahead, "
+        "and drop partitions entirely older than the retention period (whole partitions, "
+        "without row-level deletes). Run it at least monthly, e.g. daily from cron: "
+        "requests of months without a partition are kept in the default partition until it is created."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--months-ahead",
+            type=int,
+            default=settings.REQUEST_PARTITIONS_MONTHS_AHEAD,
+            help=f"Months to create partitions for after the current one, at least {MIN_MONTHS_AHEAD} "
+                 "(defaults to the REQUEST_PARTITIONS_MONTHS_AHEAD setting).",
+        )
+        parser.add_argument(
+            "--retention-months",
+            type=int,
+            default=settings.REQUEST_RETENTION_MONTHS,
+            help="Months of requests to keep before the current one, 0 to keep all "
+                 "(defaults to the REQUEST_RETENTION_MONTHS setting).",
+        )
+        parser.add_argument(
+            "--detach-only",
+            action="store_true",
+            help="Keep expired partitions as standalone tables (e.g. to archive them) instead of dropping them.",
+        )
+
+    def handle(self, *args, **options):
+        if options["months_ahead"] < 0 or options["retention_months"] < 0:
+            raise CommandError("Expected non-negative numbers of months.")
+        if options["months_ahead"] < MIN_MONTHS_AHEAD:
+            raise CommandError(f"Expected partitions at least {MIN_MONTHS_AHEAD} months ahead.")
+
+        now = timezone.now()
+        # Partitions cannot be detached concurrently in a transaction, e.g. in tests.
+        concurrently = not connection.in_atomic_block
+        with connection.cursor() as cursor:
+            partitions = get_partitions(cursor)
+
+            # Without any partition left (e.g. all detached), partitions start from the current month.
+            month = partitions[-1][2] if partitions else month_start(now)
+            until = month_start(now, options["months_ahead"] + 1)
+            while month < until:
+                self.stdout.write(f"Created partition {create_partition(cursor, month)}.")
+                month = month_start(month, 1)
+
+            if options["retention_months"]:
+                cutoff = month_start(now, -options["retention_months"])
+                for name, _, upper in get_partitions(cursor):
+                    if upper > cutoff:
+                        break
+                    detach_partition(cursor, name, concurrently=concurrently)
+                    if options["detach_only"]:
+                        self.stdout.write(f"Detached partition {name}.")
+                    else:
+                        cursor.execute(f"DROP TABLE {name}")
+                        self.stdout.write(f"Dropped partition {name}.")
+
+        self.stdout.write(self.style.SUCCESS("Partitions are up to date."))
@@ -0,0 +1,49 @@
+"""
+Verify the global unique-ip hits counter against the sum of per-url counts, and repair drift.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Sum
+
+from shortening.constants import ZERO
+from shortening.models import OriginalUrlData, UniqueIpHitsCounter
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the global unique-ip hits counter with the sum of unique-ip hits of all original urls, "
+        "and reset the counter to that sum if they differ. "
+        "Increments wait for the command, so the comparison is exact."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the counter; exit with an error if it drifted.",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Blocks counter increments (and the unique-ip count updates made along with them)
+            # until the end of the transaction; reads go on.
+            with connection.cursor() as cursor:
+                cursor.execute(f"LOCK TABLE {UniqueIpHitsCounter._meta.db_table} IN EXCLUSIVE MODE")
+
+            counted = UniqueIpHitsCounter.total()
+            expected = OriginalUrlData.objects.aggregate(
+                Sum("unique_ip_hits")
+            ).get("unique_ip_hits__sum") or ZERO
+            drift = counted - expected
+            if not drift:
+                self.stdout.write(self.style.SUCCESS(f"Counter is consistent: {counted}."))
+                return
+            if options["check"]:
+                raise CommandError(f"Counter drifted by {drift}: {counted} counted, {expected} expected.")
+
+            UniqueIpHitsCounter.objects.all().delete()
+            UniqueIpHitsCounter.objects.create(shard=0, value=expected)
+
+        self.stdout.write(self.style.WARNING(
+            f"Counter drifted by {drift}: reset from {counted} to {expected}."
+        ))
@@ -0,0 +1,265 @@
+"""
+Benchmark the shortening and redirect hot paths, and compare results with a stored baseline.
+"""
+import json
+import random
+import statistics
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections, connection, transaction
+from django.test import Client, RequestFactory
+
+from api.serializers import OriginalUrlDataSerializer
+from api.views import most_popular_urls_cache, shortened_urls_count_cache
+from shortening.utils.bulk_shortening_utils import shorten_urls
+from shortening.utils.client_data_utils import get_client_ip
+from shortening.utils.key_resolution_utils import key_resolution_cache
+from shortening.utils.url_shortening_utils import create_random_key, create_shortened_url
+
+DEFAULT_BASELINE = settings.BASE_DIR / "config" / "benchmarks" / "baseline.json"
+
+# Queries per request of each endpoint, with cold caches.
+QUERY_BUDGETS = {
+    "shorten_url": 1,
+    "fetch_content": 1,
+    "shortened_urls_count": 1,
+    "most_popular_urls": 1,
+}
+
+# Extra queries of known paths taken by a few requests only, per endpoint: no request may run more
+# queries than its budget and these, and requests typically run within the budget.
+QUERY_ALLOWANCES = {
+    "shorten_url": {
+        # Every `KEY_ALLOCATION_BLOCK_SIZE` keys: a block of sequence numbers, and its check for collisions.
+        "key block allocation": 2,
+    },
+}
+
+# Calls of a benchmark are timed after its first few (imports, caches and connections warmed up).
+WARMUP_CALLS = 10
+
+# Dataset urls are shortened in batches, each by another client.
+DATASET_BATCH_SIZE = 1000
+# The first urls are shortened again by more clients, to make some more popular than others.
+POPULAR_URLS = 100
+POPULAR_URLS_CLIENTS = 10
+
+
+class Command(BaseCommand):
+    help = (
+        "Run micro-benchmarks of key and url helpers, and benchmarks of the API views with cold caches "
+        "against a synthetic dataset (created in a transaction which is rolled back). "
+        "Write the results as JSON, then fail if a request exceeds the query budget of its endpoint "
+        "(besides allowances for known extra paths), or if a benchmark "
+        "regressed compared to the baseline (its median time by more than the tolerance, or its queries). "
+        "Do not run it against a live database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--urls", type=int, default=10000, help="Shortened urls of the dataset.")
+        parser.add_argument("--micro-iterations", type=int, default=2000, help="Calls per round.")
+        parser.add_argument("--view-iterations", type=int, default=100, help="Requests per round.")
+        parser.add_argument("--rounds", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default="benchmark_results.json", help="Path to write results to.")
+        parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="Path of the baseline results.")
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.5,
+            help="Fraction by which a median time may exceed the baseline's.",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Store the results as the baseline (e.g. on the reference machine, after a deliberate change).",
+        )
+
+    def handle(self, *args, **options):
+        self.rounds = options["rounds"]
+        rng = random.Random(options["seed"])
+        results = self.run_micro_benchmarks(options["micro_iterations"])
+
+        # As in Django's test client: the transaction must survive requests.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+        try:
+            with transaction.atomic():
+                keys = self.create_dataset(options["urls"])
+                results.update(self.run_view_benchmarks(rng, keys, options["view_iterations"]))
+                transaction.set_rollback(True)
+        finally:
+            for signal in (request_started, request_finished):
+                signal.connect(close_old_connections)
+            key_resolution_cache.clear()
+            shortened_urls_count_cache.clear()
+            most_popular_urls_cache.clear()
+
+        report = {"urls": options["urls"], "results": results}
+        with open(options["output"], "w") as output:
+            json.dump(report, output, indent=2)
+        for name, result in results.items():
+            queries = f", {result['queries']} queries (at most {result['max_queries']})" if "queries" in result else ""
+            self.stdout.write(
+                f"{name}: median {result['median_us']:.1f} µs, p95 {result['p95_us']:.1f} µs{queries}."
+            )
+
+        failures = []
+        for name, budget in QUERY_BUDGETS.items():
+            allowances = QUERY_ALLOWANCES.get(name, {})
+            if results[name]["queries"] > budget:
+                failures.append(
+                    f"{name} typically ran {results[name]['queries']} queries, over its budget of {budget}."
+                )
+            if results[name]["max_queries"] > budget + sum(allowances.values()):
+                allowed = "".join(f", +{queries} for {path}" for path, queries in allowances.items())
+                failures.append(
+                    f"{name} ran up to {results[name]['max_queries']} queries, over its budget of {budget}{allowed}."
+                )
+        failures += self.compare_with_baseline(report, options["baseline"], options["tolerance"])
+
+        if options["save_baseline"]:
+            with open(options["baseline"], "w") as baseline:
+                json.dump(report, baseline, indent=2)
+            self.stdout.write(f"Results stored as the baseline ({options['baseline']}).")
+        if failures:
+            raise CommandError("\n".join(failures))
+        self.stdout.write(self.style.SUCCESS(f"No regressions. Results written to {options['output']}."))
+
+    def run_micro_benchmarks(self, iterations: int) -> dict:
+        request = RequestFactory().get("/", HTTP_X_FORWARDED_FOR="203.0.113.7, 10.0.0.1")
+        return {
+            "create_random_key": self.measure(create_random_key, iterations),
+            "create_shortened_url": self.measure(lambda: create_shortened_url(key="AbCdEfGh"), iterations),
+            "get_client_ip": self.measure(lambda: get_client_ip(request), iterations),
+            "original_url_serializer": self.measure(
+                lambda: OriginalUrlDataSerializer(data={"url": "https://www.example.com/path?query=1"}).is_valid(),
+                iterations,
+            ),
+        }
+
+    def run_view_benchmarks(self, rng, keys: list, iterations: int) -> dict:
+        client = Client()
+        new_urls = (f"https://new-{index}.benchmark.example/" for index in range(10 ** 9))
+
+        def view_call(method, path, expected_status, data=None):
+            """
+            Request the path (and data) of a call, with cold caches.
+            """
+            def call():
+                key_resolution_cache.clear()
+                shortened_urls_count_cache.clear()
+                most_popular_urls_cache.clear()
+                kwargs = {"data": data(), "content_type": "application/json"} if data else {}
+                response = method(path(), **kwargs)
+                if response.status_code != expected_status:
+                    raise CommandError(f"{response.request['PATH_INFO']} responded {response.status_code}.")
+            return call
+
+        return {
+            name: self.measure(call, iterations, count_queries=True)
+            for name, call in (
+                ("shorten_url", view_call(
+                    client.post, lambda: "/shorten_url/", 201, data=lambda: {"url": next(new_urls)},
+                )),
+                ("fetch_content", view_call(
+                    client.get, lambda: f"/{rng.choice(keys)}/", settings.REDIRECT_STATUS_CODE,
+                )),
+                ("shortened_urls_count", view_call(client.get, lambda: "/shortened_urls_count/", 200)),
+                ("most_popular_urls", view_call(client.get, lambda: "/most_popular_urls/", 200)),
+            )
+        }
+
+    @staticmethod
+    def create_dataset(urls: int) -> list:
+        """
+        Shorten synthetic urls (with the bulk path); return their keys.
+        """
+        keys = []
+        for start in range(0, urls, DATASET_BATCH_SIZE):
+            batch = [
+                f"https://benchmark-{index}.example/landing"
+                for index in range(start, min(start + DATASET_BATCH_SIZE, urls))
+            ]
+            batch_index = start // DATASET_BATCH_SIZE
+            keys += shorten_urls(batch, f"10.1.{batch_index // 256}.{batch_index % 256}")
+        popular = [f"https://benchmark-{index}.example/landing" for index in range(min(POPULAR_URLS, urls))]
+        for client in range(POPULAR_URLS_CLIENTS):
+            shorten_urls(popular[:len(popular) * (client + 1) // POPULAR_URLS_CLIENTS], f"10.2.0.{client}")
+        return keys
+
+    def measure(self, call, iterations: int, count_queries: bool = False) -> dict:
+        """
+        Time calls in rounds; with `count_queries`, also count queries per call (typically, and at most:
+        e.g. shortening sometimes allocates a block of keys too).
+
+        The median of the fastest round is reported (and compared with the baseline):
+        slower rounds were most likely slowed down by something else running.
+        """
+        round_medians = []
+        timings = []
+        queries = []
+        query_counts = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        for _ in range(self.rounds):
+            round_timings = []
+            for index in range(WARMUP_CALLS + iterations):
+                queries.clear()
+                with connection.execute_wrapper(count_query) if count_queries else nullcontext():
+                    started_at = time.perf_counter()
+                    call()
+                    elapsed = time.perf_counter() - started_at
+                if index >= WARMUP_CALLS:
+                    round_timings.append(elapsed)
+                    query_counts.append(len(queries))
+            round_medians.append(statistics.median(round_timings))
+            timings += round_timings
+
+        timings.sort()
+        result = {
+            "iterations": iterations * self.rounds,
+            "median_us": min(round_medians) * 10 ** 6,
+            "mean_us": statistics.fmean(timings) * 10 ** 6,
+            "p95_us": timings[int(len(timings) * 0.95)] * 10 ** 6,
+        }
+        if count_queries:
+            result["queries"] = statistics.median_low(query_counts)
+            result["max_queries"] = max(query_counts)
+        return result
+
+    def compare_with_baseline(self, report: dict, path: str, tolerance: float) -> list:
+        """
+        Regressions of the results compared to the baseline, if any is stored.
+        """
+        try:
+            with open(path) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            self.stdout.write(self.style.WARNING(f"No baseline at {path}, nothing to compare with."))
+            return []
+        if baseline["urls"] != report["urls"]:
+            self.stdout.write(self.style.WARNING(
+                f"The baseline has a dataset of {baseline['urls']} urls: view times may not be comparable."
+            ))
+
+        regressions = []
+        for name, result in report["results"].items():
+            expected = baseline["results"].get(name)
+            if expected is None:
+                continue
+            if result["median_us"] > expected["median_us"] * (1 + tolerance):
+                regressions.append(
+                    f"{name} regressed: median {result['median_us']:.1f} µs, "
+                    f"baseline {expected['median_us']:.1f} µs."
+                )
+            if result.get("queries", 0) > expected.get("queries", 0):
+                regressions.append(f"{name} runs {result['queries']} queries, baseline {expected['queries']}.")
+        return regressions
@@ -0,0 +1,80 @@
+"""
+Roll shortening requests up into hourly and daily buckets, incrementally.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from shortening.models import (
+    DailyUrlShorteningRollup,
+    HourlyUrlShorteningRollup,
+    RollupWatermark,
+    UrlShorteningRequest,
+)
+
+# Buckets are rolled up (and progress is saved) at most a day at a time.
+SLICE = timedelta(days=1)
+
+
+class Command(BaseCommand):
+    help = (
+        "Roll up shortening requests of buckets ended since the last run (per original url: "
+        "number of requests and of unique clients), as well as buckets rolled up already "
+        "which got new requests since then (e.g. imported or committed late ones). Run it e.g. every few minutes; "
+        "the first run rolls up all existing requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lag",
+            type=float,
+            default=settings.ROLLUPS_LAG,
+            help=(
+                "Seconds after which ended buckets are rolled up, and written requests are considered "
+                "committed (defaults to the ROLLUPS_LAG setting)."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # Requests with ids after the watermarks are rolled up again by every run, if their buckets are closed already.
+        # Ids are allocated before rows are committed: requests written less than `lag` ago may still be followed
+        # by requests with lower ids (committed later), so the watermarks never move past them.
+        after_id = RollupWatermark.objects.aggregate(Min("last_request_id"))["last_request_id__min"] or 0
+        requests = UrlShorteningRequest.objects.filter(id__gt=after_id)
+        last_request_id = requests.aggregate(Max("id"))["id__max"] or after_id
+        first_unsettled_id = requests.filter(
+            updated_at__gte=now - timedelta(seconds=options["lag"]),
+        ).aggregate(Min("id"))["id__min"]
+        settled_request_id = last_request_id
+        if first_unsettled_id is not None:
+            settled_request_id = requests.filter(id__lt=first_unsettled_id).aggregate(Max("id"))["id__max"] or after_id
+
+        for rollup in (HourlyUrlShorteningRollup, DailyUrlShorteningRollup):
+            watermark = RollupWatermark.objects.filter(granularity=rollup.GRANULARITY).first()
+            if watermark is None:
+                first_created_at = UrlShorteningRequest.objects.aggregate(Min("created_at"))["created_at__min"]
+                watermark = RollupWatermark(
+                    granularity=rollup.GRANULARITY,
+                    closed_until=rollup.bucket_start(first_created_at or now),
+                )
+            else:
+                rollup.roll_up_late_requests(watermark.last_request_id, last_request_id, watermark.closed_until)
+
+            close_until = rollup.bucket_start(now - timedelta(seconds=options["lag"]))
+            while watermark.closed_until < close_until:
+                end = min(watermark.closed_until + SLICE, close_until)
+                with transaction.atomic():
+                    rollup.roll_up(watermark.closed_until, end)
+                    watermark.closed_until = end
+                    watermark.save()
+
+            watermark.last_request_id = max(watermark.last_request_id, settled_request_id)
+            watermark.save()
+            self.stdout.write(f"Rollups by {rollup.GRANULARITY} closed until {watermark.closed_until}.")
+
+        self.stdout.write(self.style.SUCCESS("Rollups are up to date."))
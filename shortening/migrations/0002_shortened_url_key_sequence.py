@@ -0,0 +1,20 @@
+from django.db import migrations
+
+from shortening.constants import KEY_ALPHABET, KEY_LENGTH, KEY_SEQUENCE_NAME
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=(
+                f"CREATE SEQUENCE {KEY_SEQUENCE_NAME} "
+                f"MINVALUE 0 MAXVALUE {len(KEY_ALPHABET) ** KEY_LENGTH - 1} START WITH 0;"
+            ),
+            reverse_sql=f"DROP SEQUENCE {KEY_SEQUENCE_NAME};",
+        ),
+    ]
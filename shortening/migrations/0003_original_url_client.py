@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0002_shortened_url_key_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OriginalUrlClient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_data', models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, to='shortening.clientdata')),
+                ('original_url_data', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.RESTRICT, to='shortening.originalurldata')),
+            ],
+            options={
+                'db_table': 'original_url_client',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='originalurlclient',
+            constraint=models.UniqueConstraint(fields=('original_url_data', 'client_data'), name='original_url_client_unique'),
+        ),
+        # Backfill pairs from existing requests, and align unique-ip counts with them
+        # (the former read-modify-write accounting could lose concurrent increments).
+        migrations.RunSQL(
+            sql=[
+                """
+                INSERT INTO original_url_client (original_url_data_id, client_data_id)
+                SELECT DISTINCT original_url_data_id, client_data_id
+                FROM url_shortening_request
+                ON CONFLICT DO NOTHING;
+                """,
+                """
+                UPDATE original_url_data
+                SET unique_ip_hits = hits.count, updated_at = now()
+                FROM (
+                    SELECT original_url_data_id, count(*) AS count
+                    FROM original_url_client
+                    GROUP BY original_url_data_id
+                ) AS hits
+                WHERE original_url_data.id = hits.original_url_data_id
+                    AND original_url_data.unique_ip_hits <> hits.count;
+                """,
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 02:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0003_original_url_client'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='originalurldata',
+            name='unique_ip_sketch',
+            field=models.BinaryField(null=True),
+        ),
+    ]
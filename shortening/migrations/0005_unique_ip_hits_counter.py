@@ -0,0 +1,30 @@
+# Generated by Django 4.1.2 on 2026-10-18 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0004_original_url_data_unique_ip_sketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueIpHitsCounter',
+            fields=[
+                ('shard', models.SmallIntegerField(primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'unique_ip_hits_counter',
+            },
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO unique_ip_hits_counter (shard, value)
+                SELECT 0, COALESCE(sum(unique_ip_hits), 0) FROM original_url_data;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
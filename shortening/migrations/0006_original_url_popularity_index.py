@@ -0,0 +1,20 @@
+# Generated by Django 4.1.2 on 2026-10-18 02:13
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The index is built without locking writes to the table.
+    atomic = False
+
+    dependencies = [
+        ('shortening', '0005_unique_ip_hits_counter'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='originalurldata',
+            index=models.Index(fields=['-unique_ip_hits', 'id'], name='original_url_popularity_idx'),
+        ),
+    ]
@@ -0,0 +1,236 @@
+import math
+import uuid
+from hashlib import blake2b
+from urllib.parse import urlsplit, urlunsplit
+
+from django.db import migrations, models
+
+CHUNK_SIZE = 10000
+
+# Canonicalization, digests and sketch merging as of this migration, frozen:
+# the backfill must not change meaning when the application code does.
+WEB_SCHEME_PORTS = {"http": "80", "https": "443"}
+SKETCH_RANK_WEIGHTS = [2.0 ** -rank for rank in range(65)]
+
+
+def canonicalize_url(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    userinfo, at, host = parts.netloc.rpartition("@")
+    host = host.lower()
+    if scheme in WEB_SCHEME_PORTS:
+        host = host.removesuffix(f":{WEB_SCHEME_PORTS[scheme]}")
+        scheme = ""
+    return urlunsplit((scheme, f"{userinfo}{at}{host}", parts.path.rstrip("/"), parts.query, parts.fragment))
+
+
+def url_digest(url):
+    return uuid.UUID(bytes=blake2b(canonicalize_url(url).encode(), digest_size=16).digest())
+
+
+def fold_sketch(registers, precision):
+    """
+    Registers of a HyperLogLog sketch folded to a lower (or the same) precision.
+    """
+    shift = len(registers).bit_length() - 1 - precision
+    if not shift:
+        return bytearray(registers)
+    folded = bytearray(1 << precision)
+    for index, rank in enumerate(registers):
+        if not rank:
+            continue
+        dropped = index & ((1 << shift) - 1)
+        new_rank = shift - dropped.bit_length() + 1 if dropped else rank + shift
+        folded[index >> shift] = max(folded[index >> shift], new_rank)
+    return folded
+
+
+def merge_sketches(registers, other):
+    precision = min(len(registers), len(other)).bit_length() - 1
+    return bytearray(map(max, fold_sketch(registers, precision), fold_sketch(other, precision)))
+
+
+def estimate_sketch(registers):
+    size = len(registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+    estimate = alpha * size * size / sum(map(SKETCH_RANK_WEIGHTS.__getitem__, registers))
+    zeros = registers.count(0)
+    if estimate <= 2.5 * size and zeros:
+        estimate = size * math.log(size / zeros)
+    return round(estimate)
+
+
+def backfill_url_digests(apps, schema_editor):
+    """
+    Set digests of existing original urls, chunk by chunk, then merge urls now considered the same
+    into the oldest one (upgraded to an https variant, if any), batch by batch.
+
+    Merges are not undone when the migration is reversed: merged urls are the same urls.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        last_id = 0
+        while True:
+            cursor.execute(
+                "SELECT id, url FROM original_url_data WHERE id > %s ORDER BY id LIMIT %s",
+                [last_id, CHUNK_SIZE],
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            cursor.execute(
+                """
+                UPDATE original_url_data SET url_digest = digests.url_digest
+                FROM unnest(%s::bigint[], %s::uuid[]) AS digests (id, url_digest)
+                WHERE original_url_data.id = digests.id
+                """,
+                [[id_ for id_, _ in rows], [str(url_digest(url)) for _, url in rows]],
+            )
+
+        cursor.execute(
+            """
+            CREATE TEMPORARY TABLE original_url_merges ON COMMIT DROP AS
+            SELECT id AS merged_id, kept_id FROM (
+                SELECT id, min(id) OVER (PARTITION BY url_digest) AS kept_id FROM original_url_data
+            ) AS urls
+            WHERE id <> kept_id
+            """
+        )
+        cursor.execute("CREATE INDEX ON original_url_merges (merged_id)")
+        last_id = 0
+        while True:
+            cursor.execute(
+                """
+                SELECT merged_id, kept_id FROM original_url_merges
+                WHERE merged_id > %s ORDER BY merged_id LIMIT %s
+                """,
+                [last_id, CHUNK_SIZE],
+            )
+            merges = cursor.fetchall()
+            if not merges:
+                break
+            last_id = merges[-1][0]
+            merge_original_urls(cursor, dict(merges))
+
+        cursor.execute("DELETE FROM unique_ip_hits_counter")
+        cursor.execute("""
+            INSERT INTO unique_ip_hits_counter (shard, value)
+            SELECT 0, COALESCE(sum(unique_ip_hits), 0) FROM original_url_data
+        """)
+        # Check deferred foreign keys now, as the table is altered next in this transaction.
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+
+def merge_original_urls(cursor, merged_ids):
+    """
+    Merge original urls into the ones they are the same as, given as `{merged id: kept id}`.
+    """
+    merges = [list(merged_ids), list(merged_ids.values())]
+    # Redirects must not be downgraded to http when an https variant was shortened too.
+    cursor.execute(
+        """
+        SELECT DISTINCT ON (merges.kept_id) merges.kept_id, merged.url
+        FROM unnest(%s::bigint[], %s::bigint[]) AS merges (merged_id, kept_id)
+        JOIN original_url_data AS merged ON merged.id = merges.merged_id
+        WHERE merged.url ~* '^https:'
+        ORDER BY merges.kept_id, merges.merged_id
+        """,
+        merges,
+    )
+    https_urls = cursor.fetchall()
+    for table in ("shortened_url_data", "url_shortening_request"):
+        cursor.execute(
+            f"""
+            UPDATE {table} SET original_url_data_id = merges.kept_id
+            FROM unnest(%s::bigint[], %s::bigint[]) AS merges (merged_id, kept_id)
+            WHERE {table}.original_url_data_id = merges.merged_id
+            """,
+            merges,
+        )
+    cursor.execute(
+        """
+        INSERT INTO original_url_client (original_url_data_id, client_data_id)
+        SELECT merges.kept_id, original_url_client.client_data_id
+        FROM original_url_client
+        JOIN unnest(%s::bigint[], %s::bigint[]) AS merges (merged_id, kept_id)
+            ON original_url_client.original_url_data_id = merges.merged_id
+        ON CONFLICT DO NOTHING
+        """,
+        merges,
+    )
+    cursor.execute("DELETE FROM original_url_client WHERE original_url_data_id = ANY(%s::bigint[])", merges[:1])
+
+    # Unique-ip counts of kept urls: the estimate of their merged sketches if any,
+    # the number of their clients otherwise.
+    kept_ids = set(merged_ids.values())
+    cursor.execute(
+        """
+        SELECT id, unique_ip_sketch FROM original_url_data
+        WHERE id = ANY(%s::bigint[]) AND unique_ip_sketch IS NOT NULL
+        """,
+        [[*merged_ids, *kept_ids]],
+    )
+    sketches = {}
+    for original_url_data_id, sketch in cursor.fetchall():
+        kept_id = merged_ids.get(original_url_data_id, original_url_data_id)
+        sketches[kept_id] = merge_sketches(sketches[kept_id], sketch) if kept_id in sketches else bytearray(sketch)
+    cursor.execute(
+        """
+        UPDATE original_url_data SET unique_ip_hits = (
+            SELECT count(*) FROM original_url_client
+            WHERE original_url_client.original_url_data_id = original_url_data.id
+        )
+        WHERE id = ANY(%s::bigint[])
+        """,
+        [list(kept_ids - set(sketches))],
+    )
+    if sketches:
+        cursor.execute(
+            """
+            UPDATE original_url_data SET unique_ip_sketch = sketches.sketch, unique_ip_hits = sketches.hits
+            FROM unnest(%s::bigint[], %s::bytea[], %s::integer[]) AS sketches (id, sketch, hits)
+            WHERE original_url_data.id = sketches.id
+            """,
+            [
+                list(sketches),
+                [bytes(sketch) for sketch in sketches.values()],
+                [estimate_sketch(sketch) for sketch in sketches.values()],
+            ],
+        )
+
+    cursor.execute("DELETE FROM original_url_data WHERE id = ANY(%s::bigint[])", merges[:1])
+    if https_urls:
+        cursor.execute(
+            """
+            UPDATE original_url_data SET url = https.url
+            FROM unnest(%s::bigint[], %s::text[]) AS https (id, url)
+            WHERE original_url_data.id = https.id AND original_url_data.url !~* '^https:'
+            """,
+            [list(column) for column in zip(*https_urls)],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0006_original_url_popularity_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='originalurldata',
+            name='url_digest',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_url_digests, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='originalurldata',
+            name='url_digest',
+            field=models.UUIDField(editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='originalurldata',
+            name='url',
+            field=models.URLField(),
+        ),
+    ]
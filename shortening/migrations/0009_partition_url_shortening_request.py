@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.db import migrations, transaction
+from django.utils import timezone
+
+from shortening.utils.partition_utils import LEGACY_PARTITION, PARTITIONED_TABLE, create_partition, month_start
+
+CREATE_PARTITIONED_TABLE_SQL = f"""
+    CREATE TABLE {PARTITIONED_TABLE} (
+        id bigint NOT NULL DEFAULT nextval('{PARTITIONED_TABLE}_id_seq'),
+        created_at timestamp with time zone NOT NULL,
+        updated_at timestamp with time zone NOT NULL,
+        client_data_id bigint NOT NULL
+            REFERENCES client_data (id) DEFERRABLE INITIALLY DEFERRED,
+        original_url_data_id bigint NOT NULL
+            REFERENCES original_url_data (id) DEFERRABLE INITIALLY DEFERRED,
+        shortened_url_data_id bigint NOT NULL
+            REFERENCES shortened_url_data (id) DEFERRABLE INITIALLY DEFERRED,
+        -- The partition key must be part of the primary key.
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+"""
+
+
+def partition_requests(apps, schema_editor):
+    """
+    Turn `url_shortening_request` into a table partitioned by month of `created_at`.
+
+    The existing table becomes the partition of everything created before the first monthly one
+    (until it is dropped by the retention policy). Its rows are neither copied nor scanned
+    under a lock: the index and the check needed to attach it are built beforehand,
+    without blocking writes.
+    """
+    # Rows created until the swap must fit the check, hence a month of margin.
+    boundary = month_start(timezone.now(), 2)
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE UNIQUE INDEX CONCURRENTLY {LEGACY_PARTITION}_pkey ON {PARTITIONED_TABLE} (id, created_at)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {PARTITIONED_TABLE} ADD CONSTRAINT {LEGACY_PARTITION}_pkey UNIQUE "
+            f"USING INDEX {LEGACY_PARTITION}_pkey"
+        )
+        cursor.execute(
+            f"ALTER TABLE {PARTITIONED_TABLE} ADD CONSTRAINT {LEGACY_PARTITION}_bounds "
+            f"CHECK (created_at < %s) NOT VALID",
+            [boundary],
+        )
+        cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} VALIDATE CONSTRAINT {LEGACY_PARTITION}_bounds")
+
+        with transaction.atomic(using=schema_editor.connection.alias):
+            cursor.execute(f"LOCK TABLE {PARTITIONED_TABLE} IN ACCESS EXCLUSIVE MODE")
+            # Partitions cannot have identity columns: ids come from a plain sequence from now on.
+            cursor.execute(f"SELECT nextval(pg_get_serial_sequence('{PARTITIONED_TABLE}', 'id'))")
+            next_id = cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} ALTER COLUMN id DROP IDENTITY")
+            cursor.execute(f"ALTER TABLE {PARTITIONED_TABLE} RENAME TO {LEGACY_PARTITION}")
+            cursor.execute(
+                f"ALTER TABLE {LEGACY_PARTITION} RENAME CONSTRAINT {PARTITIONED_TABLE}_pkey TO {LEGACY_PARTITION}_id_key"
+            )
+            cursor.execute(f"CREATE SEQUENCE {PARTITIONED_TABLE}_id_seq START WITH %s", [next_id])
+
+            cursor.execute(CREATE_PARTITIONED_TABLE_SQL)
+            cursor.execute(f"ALTER SEQUENCE {PARTITIONED_TABLE}_id_seq OWNED BY {PARTITIONED_TABLE}.id")
+            for column in ("client_data_id", "original_url_data_id", "shortened_url_data_id"):
+                cursor.execute(f"CREATE INDEX {PARTITIONED_TABLE}_{column}_idx ON {PARTITIONED_TABLE} ({column})")
+
+            # Existing indexes and foreign keys of the legacy table are reused, and the check proves its bounds.
+            cursor.execute(
+                f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {LEGACY_PARTITION} "
+                f"FOR VALUES FROM (MINVALUE) TO (%s)",
+                [boundary],
+            )
+            cursor.execute(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT {LEGACY_PARTITION}_bounds")
+
+            for months in range(settings.REQUEST_PARTITIONS_MONTHS_AHEAD):
+                create_partition(cursor, month_start(boundary, months))
+
+
+class Migration(migrations.Migration):
+    # Indexes and checks of the existing table are built without locking writes to it.
+    atomic = False
+
+    dependencies = [
+        ('shortening', '0008_shorten_url_function'),
+    ]
+
+    operations = [
+        # Irreversible: the partitioned table is kept when migrating backwards
+        # (turning it back into a plain table would copy all requests under a lock).
+        migrations.RunPython(partition_requests, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.1.2 on 2026-10-18 02:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0009_partition_url_shortening_request'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('granularity', models.CharField(max_length=8, primary_key=True, serialize=False)),
+                ('closed_until', models.DateTimeField()),
+                ('last_request_id', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'rollup_watermark',
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyUrlShorteningRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('requests', models.BigIntegerField()),
+                ('unique_clients', models.BigIntegerField()),
+                ('original_url_data', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.RESTRICT, to='shortening.originalurldata')),
+            ],
+            options={
+                'db_table': 'url_shortening_hourly_rollup',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyUrlShorteningRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('requests', models.BigIntegerField()),
+                ('unique_clients', models.BigIntegerField()),
+                ('original_url_data', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.RESTRICT, to='shortening.originalurldata')),
+            ],
+            options={
+                'db_table': 'url_shortening_daily_rollup',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='hourlyurlshorteningrollup',
+            constraint=models.UniqueConstraint(fields=('original_url_data', 'bucket'), name='url_shortening_hourly_rollup_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyurlshorteningrollup',
+            constraint=models.UniqueConstraint(fields=('original_url_data', 'bucket'), name='url_shortening_daily_rollup_unique'),
+        ),
+    ]
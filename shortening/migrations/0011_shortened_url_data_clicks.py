@@ -0,0 +1,23 @@
+# Generated by Django 4.1.2 on 2026-10-18 02:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0010_url_shortening_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shortenedurldata',
+            name='clicks',
+            field=models.BigIntegerField(default=0),
+        ),
+        # Keys are also inserted by raw SQL (`shorten_url`, `import_links`) not listing the column.
+        migrations.RunSQL(
+            sql="ALTER TABLE shortened_url_data ALTER COLUMN clicks SET DEFAULT 0",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
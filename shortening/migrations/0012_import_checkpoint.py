@@ -0,0 +1,26 @@
+# Generated by Django 4.1.2 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0011_shortened_url_data_clicks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('path', models.CharField(max_length=1024, primary_key=True, serialize=False)),
+                ('records', models.BigIntegerField(default=0)),
+                ('skipped', models.BigIntegerField(default=0)),
+                ('shortened', models.BigIntegerField(default=0)),
+                ('requests', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'import_checkpoint',
+            },
+        ),
+    ]
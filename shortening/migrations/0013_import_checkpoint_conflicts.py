@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0012_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='conflicts',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+from shortening.utils.partition_utils import DEFAULT_PARTITION, PARTITIONED_TABLE
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0013_import_checkpoint_conflicts'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARTITIONED_TABLE} DEFAULT",
+            # Requests in the default partition would be lost otherwise: create their partitions first.
+            reverse_sql=f"""
+                DO $$ BEGIN
+                    IF EXISTS (SELECT FROM {DEFAULT_PARTITION}) THEN
+                        RAISE EXCEPTION 'Requests are left in {DEFAULT_PARTITION}.';
+                    END IF;
+                END $$;
+                DROP TABLE {DEFAULT_PARTITION};
+            """,
+        ),
+    ]
@@ -0,0 +1,101 @@
+import importlib
+
+from django.db import migrations
+
+initial_function = importlib.import_module("shortening.migrations.0008_shorten_url_function")
+
+DROP_SHORTEN_URL_FUNCTION_SQL = "DROP FUNCTION shorten_url(text, uuid, text, inet, boolean, boolean, smallint);"
+
+# Same as the initial function, also telling whether the stored url was upgraded to https,
+# so that the caller forgets what it knows about keys of the url (see `invalidate_original_urls`).
+CREATE_SHORTEN_URL_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION shorten_url(
+        p_url text,
+        p_url_digest uuid,
+        p_key text,
+        p_client_ip inet,
+        p_record_request boolean,
+        p_count_unique_ip boolean,
+        p_counter_shard smallint
+    ) RETURNS TABLE (
+        original_url_data_id bigint, client_data_id bigint, shortened_url_data_id bigint, url_upgraded boolean
+    )
+    LANGUAGE plpgsql AS $$
+    #variable_conflict use_column
+    DECLARE
+        v_original_url_data_id bigint;
+        v_client_data_id bigint;
+        v_shortened_url_data_id bigint;
+        v_url_upgraded boolean := false;
+    BEGIN
+        SELECT id INTO v_original_url_data_id FROM original_url_data WHERE url_digest = p_url_digest;
+        IF NOT FOUND THEN
+            INSERT INTO original_url_data (url, url_digest, unique_ip_hits, created_at, updated_at)
+            VALUES (p_url, p_url_digest, 0, now(), now())
+            ON CONFLICT (url_digest) DO NOTHING
+            RETURNING id INTO v_original_url_data_id;
+            IF NOT FOUND THEN
+                SELECT id INTO v_original_url_data_id FROM original_url_data WHERE url_digest = p_url_digest;
+            END IF;
+        END IF;
+        IF p_url ~* '^https:' THEN
+            -- An https variant upgrades a stored http url (see `is_https_url`).
+            UPDATE original_url_data SET url = p_url, updated_at = now()
+            WHERE id = v_original_url_data_id AND url !~* '^https:';
+            v_url_upgraded := FOUND;
+        END IF;
+
+        SELECT id INTO v_client_data_id FROM client_data WHERE client_ip IS NOT DISTINCT FROM p_client_ip;
+        IF NOT FOUND THEN
+            INSERT INTO client_data (client_ip, created_at, updated_at)
+            VALUES (p_client_ip, now(), now())
+            ON CONFLICT (client_ip) DO NOTHING
+            RETURNING id INTO v_client_data_id;
+            IF NOT FOUND THEN
+                SELECT id INTO v_client_data_id FROM client_data WHERE client_ip IS NOT DISTINCT FROM p_client_ip;
+            END IF;
+        END IF;
+
+        INSERT INTO shortened_url_data (key, original_url_data_id, created_at, updated_at)
+        VALUES (p_key, v_original_url_data_id, now(), now())
+        RETURNING id INTO v_shortened_url_data_id;
+
+        IF p_record_request THEN
+            -- Same accounting as `OriginalUrlData.record_unique_clients`, for a single pair.
+            IF p_count_unique_ip THEN
+                INSERT INTO original_url_client (original_url_data_id, client_data_id)
+                VALUES (v_original_url_data_id, v_client_data_id)
+                ON CONFLICT DO NOTHING;
+                IF FOUND THEN
+                    UPDATE original_url_data SET unique_ip_hits = unique_ip_hits + 1, updated_at = now()
+                    WHERE id = v_original_url_data_id;
+                    INSERT INTO unique_ip_hits_counter (shard, value) VALUES (p_counter_shard, 1)
+                    ON CONFLICT (shard) DO UPDATE SET value = unique_ip_hits_counter.value + 1;
+                END IF;
+            END IF;
+
+            INSERT INTO url_shortening_request (
+                client_data_id, original_url_data_id, shortened_url_data_id, created_at, updated_at
+            )
+            VALUES (v_client_data_id, v_original_url_data_id, v_shortened_url_data_id, now(), now());
+        END IF;
+
+        RETURN QUERY SELECT v_original_url_data_id, v_client_data_id, v_shortened_url_data_id, v_url_upgraded;
+    END;
+    $$
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shortening', '0014_url_shortening_request_default_partition'),
+    ]
+
+    operations = [
+        # The result type changes, so the function cannot just be replaced.
+        migrations.RunSQL(
+            sql=[DROP_SHORTEN_URL_FUNCTION_SQL, CREATE_SHORTEN_URL_FUNCTION_SQL],
+            reverse_sql=[DROP_SHORTEN_URL_FUNCTION_SQL, initial_function.CREATE_SHORTEN_URL_FUNCTION_SQL],
+        ),
+    ]
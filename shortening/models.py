@@ -1,14 +1,94 @@
 """
 URL shortener shortening layer.
 """
-from django.db import models
+import random
+from datetime import datetime, timedelta, timezone
 
-from shortening.constants import KEY_LENGTH
-from shortening.utils.url_shortening_utils import create_random_key
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Sum
+
+from shortening.constants import KEY_LENGTH, ZERO
+from shortening.utils.hyperloglog_utils import HyperLogLog, precision_for_error_rate
+from shortening.utils.key_allocation_utils import key_allocator
+from shortening.utils.url_shortening_utils import create_random_key, url_digest
+from shortening.utils.write_behind_utils import unique_ip_sketch_buffer
+from url_shortener.metrics import key_generation_retries_total
 
 
 # NOTE: consider putting indexes to url and url key
 
+# Adds the sum of `delta` values of a `deltas` CTE to a shard of the global unique-ip hits counter.
+INCREMENT_UNIQUE_IP_HITS_COUNTER_SQL = """
+    INSERT INTO unique_ip_hits_counter (shard, value)
+    SELECT %s, sum(delta) FROM deltas HAVING sum(delta) <> 0
+    ON CONFLICT (shard) DO UPDATE SET value = unique_ip_hits_counter.value + excluded.value
+"""
+
+# Records (original url, client) pairs and increments unique-ip counts of the urls of newly recorded pairs,
+# as well as the global counter. Pairs are inserted in a stable order, so concurrent batches do not deadlock.
+INCREMENT_UNIQUE_IP_COUNTS_SQL = """
+    WITH new_pairs AS (
+        INSERT INTO original_url_client (original_url_data_id, client_data_id)
+        SELECT DISTINCT original_url_data_id, client_data_id
+        FROM unnest(%s::bigint[], %s::bigint[]) AS pairs (original_url_data_id, client_data_id)
+        ORDER BY original_url_data_id, client_data_id
+        ON CONFLICT DO NOTHING
+        RETURNING original_url_data_id
+    ),
+    deltas AS (
+        UPDATE original_url_data
+        SET unique_ip_hits = unique_ip_hits + hits.count, updated_at = now()
+        FROM (
+            SELECT original_url_data_id, count(*) AS count FROM new_pairs GROUP BY original_url_data_id
+        ) AS hits
+        WHERE original_url_data.id = hits.original_url_data_id
+        RETURNING hits.count AS delta
+    )
+""" + INCREMENT_UNIQUE_IP_HITS_COUNTER_SQL
+
+# Sets sketches and unique-ip counts of original urls, and adds the count changes to the global counter.
+UPDATE_UNIQUE_IP_SKETCHES_SQL = """
+    WITH deltas AS (
+        UPDATE original_url_data
+        SET unique_ip_sketch = sketches.sketch, unique_ip_hits = sketches.hits, updated_at = now()
+        FROM unnest(%s::bigint[], %s::bytea[], %s::integer[]) AS sketches (id, sketch, hits)
+        JOIN original_url_data AS previous ON previous.id = sketches.id
+        WHERE original_url_data.id = sketches.id
+        RETURNING sketches.hits - previous.unique_ip_hits AS delta
+    )
+""" + INCREMENT_UNIQUE_IP_HITS_COUNTER_SQL
+
+# Sets rollups of a time range to the requests and unique clients of its buckets, per original url.
+ROLL_UP_REQUESTS_SQL = """
+    INSERT INTO {table} (original_url_data_id, bucket, requests, unique_clients)
+    SELECT original_url_data_id, date_trunc(%s, created_at, 'UTC'), count(*), count(DISTINCT client_data_id)
+    FROM url_shortening_request
+    WHERE created_at >= %s AND created_at < %s
+    GROUP BY 1, 2
+    ON CONFLICT (original_url_data_id, bucket) DO UPDATE
+    SET requests = excluded.requests, unique_clients = excluded.unique_clients
+"""
+
+# Recomputes rollups of buckets (before a watermark) that got requests in a range of request ids,
+# e.g. imported or written behind after their buckets were rolled up.
+ROLL_UP_LATE_REQUESTS_SQL = """
+    WITH late AS (
+        SELECT DISTINCT original_url_data_id, date_trunc(%(granularity)s, created_at, 'UTC') AS bucket
+        FROM url_shortening_request
+        WHERE id > %(after_id)s AND id <= %(until_id)s AND created_at < %(closed_until)s
+    )
+    INSERT INTO {table} (original_url_data_id, bucket, requests, unique_clients)
+    SELECT late.original_url_data_id, late.bucket, count(*), count(DISTINCT url_shortening_request.client_data_id)
+    FROM late
+    JOIN url_shortening_request ON url_shortening_request.original_url_data_id = late.original_url_data_id
+        AND url_shortening_request.created_at >= late.bucket
+        AND url_shortening_request.created_at < late.bucket + %(interval)s::interval
+    GROUP BY 1, 2
+    ON CONFLICT (original_url_data_id, bucket) DO UPDATE
+    SET requests = excluded.requests, unique_clients = excluded.unique_clients
+"""
+
 
 class CommonInfo(models.Model):
     """
@@ -27,24 +107,126 @@ class OriginalUrlData(CommonInfo):
     Original URL to be shortened.
     """
 
-    url = models.URLField(unique=True)
+    url = models.URLField()
+    # Digest of the canonical url, carrying the uniqueness of urls (see `url_digest`); set on save.
+    # Look urls up by it rather than by `url`, which has no index.
+    url_digest = models.UUIDField(unique=True, editable=False)
     unique_ip_hits = models.IntegerField(default=0)
+    # HyperLogLog registers of clients, in the 'approximate' unique-ip counting mode.
+    unique_ip_sketch = models.BinaryField(null=True, editable=False)
 
     class Meta:
         db_table = "original_url_data"
+        indexes = [
+            # Serves the most popular urls with an index scan of `limit` entries, rather than a sort.
+            models.Index(fields=["-unique_ip_hits", "id"], name="original_url_popularity_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.url_digest = url_digest(self.url)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def increment_unique_ip_count(original_url_data, client_data):
+        """
+        Increment unique-ip count for the original url, if the client requests it for the first time.
+        """
+        OriginalUrlData.increment_unique_ip_counts([original_url_data.id], [client_data.id])
+
+    @staticmethod
+    def increment_unique_ip_counts(original_url_data_ids, client_data_ids):
+        """
+        Increment unique-ip counts for pairs of original urls and clients requesting them.
+
+        Bulk counterpart of `increment_unique_ip_count`; see `record_unique_clients`
+        and `UniqueIpSketchBuffer` for the 'exact' and 'approximate' counting modes.
+        """
+        if settings.UNIQUE_IP_COUNTING_MODE == "approximate":
+            unique_ip_sketch_buffer.add(original_url_data_ids, client_data_ids)
+        else:
+            OriginalUrlData.record_unique_clients(original_url_data_ids, client_data_ids)
+
+    @staticmethod
+    def record_unique_clients(original_url_data_ids, client_data_ids):
+        """
+        Exactly count pairs of original urls and clients requesting them, in a single query.
+
+        Pairs are recorded in `OriginalUrlClient`, and only the ones inserted
+        by this very query are counted, so concurrent calls never count a client twice.
+        `UniqueIpHitsCounter` is incremented by the same query.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(INCREMENT_UNIQUE_IP_COUNTS_SQL, [
+                list(original_url_data_ids), list(client_data_ids), UniqueIpHitsCounter.random_shard(),
+            ])
+
+    @staticmethod
+    def sketch_unique_clients(original_url_data_ids, client_data_ids, precision: int = None):
+        """
+        Approximately count pairs of original urls and clients requesting them, at once.
+
+        Clients are added to the stored sketches of the urls (of the given precision at most,
+        by default the one of `UNIQUE_IP_SKETCH_ERROR_RATE`).
+        """
+        if precision is None:
+            precision = precision_for_error_rate(settings.UNIQUE_IP_SKETCH_ERROR_RATE)
+        client_data_ids_by_url = {}
+        for original_url_data_id, client_data_id in zip(original_url_data_ids, client_data_ids):
+            client_data_ids_by_url.setdefault(original_url_data_id, []).append(client_data_id)
+
+        def update(original_url_data_id, sketch):
+            changed = sketch is None or sketch.precision > precision
+            sketch = HyperLogLog(precision) if sketch is None else sketch.fold(min(sketch.precision, precision))
+            for client_data_id in client_data_ids_by_url[original_url_data_id]:
+                changed = sketch.add(client_data_id) or changed
+            return sketch if changed else None
+
+        OriginalUrlData._update_unique_ip_sketches(client_data_ids_by_url, update)
+
+    @staticmethod
+    def merge_unique_ip_sketches(sketches: dict):
+        """
+        Merge sketches of clients into the ones of original urls, given as `{original_url_data_id: sketch}`.
+
+        Since merging is lossless, sketches may be built separately before being merged,
+        e.g. per worker by `UniqueIpSketchBuffer`.
+        """
+        def update(original_url_data_id, sketch):
+            if sketch is None:
+                return sketches[original_url_data_id]
+            merged = sketch.merge(sketches[original_url_data_id])
+            return merged if merged.registers != sketch.registers else None
+
+        OriginalUrlData._update_unique_ip_sketches(sketches, update)
 
     @staticmethod
-    def increment_unique_ip_count(original_url, client_ip, original_url_data):
+    def _update_unique_ip_sketches(original_url_data_ids, update):
         """
-        Increment unique-ip count for the original url.
+        Update stored sketches of original urls with `update(original_url_data_id, sketch or None)`.
+
+        `update` returns the new sketch, or `None` if it is unchanged. Unique-ip counts are set
+        to the estimates of new sketches. Rows are only written when their sketch changes,
+        which gets rare as urls get popular.
         """
-        if not UrlShorteningRequest.objects.filter(
-            original_url_data__url=original_url,
-            client_data__client_ip=client_ip,
-        ).exists():
-            current_unique_ip_hits_count = original_url_data.unique_ip_hits
-            original_url_data.unique_ip_hits = current_unique_ip_hits_count + 1
-            original_url_data.save()
+        with transaction.atomic(savepoint=False):
+            stored_sketches = OriginalUrlData.objects.filter(
+                id__in=original_url_data_ids,
+            ).order_by("id").select_for_update().values_list("id", "unique_ip_sketch")
+
+            updated = []
+            for original_url_data_id, stored_sketch in stored_sketches:
+                sketch = update(
+                    original_url_data_id,
+                    HyperLogLog.from_bytes(stored_sketch) if stored_sketch is not None else None,
+                )
+                if sketch is not None:
+                    updated.append((original_url_data_id, bytes(sketch), sketch.estimate()))
+
+            if updated:
+                with connection.cursor() as cursor:
+                    cursor.execute(UPDATE_UNIQUE_IP_SKETCHES_SQL, [
+                        *(list(column) for column in zip(*updated)), UniqueIpHitsCounter.random_shard(),
+                    ])
 
 
 class ShortenedUrlData(CommonInfo):
@@ -56,6 +238,8 @@ class ShortenedUrlData(CommonInfo):
 
     key = models.CharField(unique=True, max_length=15)
     original_url_data = models.ForeignKey(OriginalUrlData, on_delete=models.RESTRICT)
+    # Number of redirects via the key, added up by `ClickCounter` flushes.
+    clicks = models.BigIntegerField(default=0)
 
     class Meta:
         db_table = "shortened_url_data"
@@ -64,12 +248,39 @@ class ShortenedUrlData(CommonInfo):
     def create_unique_random_key(length: int = KEY_LENGTH) -> str:
         """
         Create a random key, ensuring its uniqueness.
+
+        With the 'block' allocation strategy, keys are unique by construction
+        and no uniqueness check is needed.
         """
+        if settings.KEY_ALLOCATION_STRATEGY == "block" and length == KEY_LENGTH:
+            return key_allocator.allocate()
+
         key = create_random_key(length)
         while ShortenedUrlData.objects.filter(key=key).exists():
+            key_generation_retries_total.inc()
             key = create_random_key(length)
         return key
 
+    @staticmethod
+    def create_unique_random_keys(count: int, length: int = KEY_LENGTH) -> list:
+        """
+        Create many random keys, ensuring their uniqueness.
+
+        Bulk counterpart of `create_unique_random_key`, checking uniqueness
+        with one query per round of candidate keys, rather than one query per key.
+        """
+        if settings.KEY_ALLOCATION_STRATEGY == "block" and length == KEY_LENGTH:
+            return [key_allocator.allocate() for _ in range(count)]
+
+        keys = set()
+        while len(keys) < count:
+            candidates = {create_random_key(length) for _ in range(count - len(keys))} - keys
+            taken = set(ShortenedUrlData.objects.filter(key__in=candidates).values_list("key", flat=True))
+            if taken:
+                key_generation_retries_total.inc(len(taken))
+            keys |= candidates - taken
+        return list(keys)
+
 
 class ClientData(CommonInfo):
     """
@@ -93,3 +304,158 @@ class UrlShorteningRequest(CommonInfo):
 
     class Meta:
         db_table = "url_shortening_request"
+
+
+class OriginalUrlClient(models.Model):
+    """
+    Clients who ever requested to shorten an original URL, one row per (url, client) pair.
+
+    Backs `OriginalUrlData.unique_ip_hits` accounting.
+    """
+
+    # The unique constraint's index covers lookups by the original url.
+    original_url_data = models.ForeignKey(OriginalUrlData, on_delete=models.RESTRICT, db_index=False)
+    client_data = models.ForeignKey(ClientData, on_delete=models.RESTRICT)
+
+    class Meta:
+        db_table = "original_url_client"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["original_url_data", "client_data"],
+                name="original_url_client_unique",
+            ),
+        ]
+
+
+class UniqueIpHitsCounter(models.Model):
+    """
+    Sum of `OriginalUrlData.unique_ip_hits`, maintained along with them.
+
+    The sum is split across shards, incremented at random, so concurrent increments
+    rarely wait for the same row; reading the total only sums a few rows.
+    """
+
+    shard = models.SmallIntegerField(primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "unique_ip_hits_counter"
+
+    @staticmethod
+    def random_shard() -> int:
+        return random.randrange(settings.UNIQUE_IP_HITS_COUNTER_SHARDS)
+
+    @staticmethod
+    def total() -> int:
+        return UniqueIpHitsCounter.objects.aggregate(Sum("value")).get("value__sum") or ZERO
+
+    @staticmethod
+    async def atotal() -> int:
+        return (await UniqueIpHitsCounter.objects.aaggregate(Sum("value"))).get("value__sum") or ZERO
+
+
+class UrlShorteningRollup(models.Model):
+    """
+    Shortening requests of an original URL per time bucket, pre-aggregated from `UrlShorteningRequest`
+    by `manage.py update_rollups`.
+
+    Rollups are kept when requests expire (see `manage.py maintain_request_partitions`).
+    """
+
+    GRANULARITY = None  # Define in every subclass: 'hour' or 'day'
+
+    # The unique constraint's index covers lookups by the original url.
+    original_url_data = models.ForeignKey(OriginalUrlData, on_delete=models.RESTRICT, db_index=False)
+    # Start of the bucket.
+    bucket = models.DateTimeField()
+    requests = models.BigIntegerField()
+    unique_clients = models.BigIntegerField()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def bucket_interval(cls) -> timedelta:
+        return timedelta(**{f"{cls.GRANULARITY}s": 1})
+
+    @classmethod
+    def bucket_start(cls, moment: datetime) -> datetime:
+        moment = moment.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        return moment.replace(hour=0) if cls.GRANULARITY == "day" else moment
+
+    @classmethod
+    def roll_up(cls, start: datetime, end: datetime):
+        """
+        Roll up requests of whole buckets from `start` until `end`.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(ROLL_UP_REQUESTS_SQL.format(table=cls._meta.db_table), [cls.GRANULARITY, start, end])
+
+    @classmethod
+    def roll_up_late_requests(cls, after_id: int, until_id: int, closed_until: datetime):
+        """
+        Roll up again buckets before `closed_until` which got requests with ids in (`after_id`, `until_id`].
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(ROLL_UP_LATE_REQUESTS_SQL.format(table=cls._meta.db_table), {
+                "granularity": cls.GRANULARITY,
+                "after_id": after_id,
+                "until_id": until_id,
+                "closed_until": closed_until,
+                "interval": f"1 {cls.GRANULARITY}",
+            })
+
+
+class HourlyUrlShorteningRollup(UrlShorteningRollup):
+    GRANULARITY = "hour"
+
+    class Meta:
+        db_table = "url_shortening_hourly_rollup"
+        constraints = [
+            models.UniqueConstraint(fields=["original_url_data", "bucket"], name="url_shortening_hourly_rollup_unique"),
+        ]
+
+
+class DailyUrlShorteningRollup(UrlShorteningRollup):
+    GRANULARITY = "day"
+
+    class Meta:
+        db_table = "url_shortening_daily_rollup"
+        constraints = [
+            models.UniqueConstraint(fields=["original_url_data", "bucket"], name="url_shortening_daily_rollup_unique"),
+        ]
+
+
+class RollupWatermark(models.Model):
+    """
+    Progress of `manage.py update_rollups`, per rollup granularity.
+    """
+
+    granularity = models.CharField(primary_key=True, max_length=8)
+    # Buckets before this moment are rolled up.
+    closed_until = models.DateTimeField()
+    # Requests with greater ids may belong to buckets rolled up before they were written.
+    last_request_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "rollup_watermark"
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Progress of `manage.py import_links`, per imported file.
+
+    Saved in the transaction of each imported batch, so a resumed import never imports a batch twice.
+    """
+
+    path = models.CharField(primary_key=True, max_length=1024)
+    # Records of the file read so far (imported or skipped).
+    records = models.BigIntegerField(default=0)
+    skipped = models.BigIntegerField(default=0)
+    # Records not imported as their key exists already.
+    conflicts = models.BigIntegerField(default=0)
+    shortened = models.BigIntegerField(default=0)
+    requests = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = "import_checkpoint"
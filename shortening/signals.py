@@ -0,0 +1,24 @@
+"""
+Signal handlers of the shortening layer.
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from shortening.models import ShortenedUrlData
+from shortening.utils.key_resolution_utils import invalidate_key, register_key
+
+
+@receiver(post_save, sender=ShortenedUrlData)
+def register_shortened_url_key(sender, instance, **kwargs):
+    """
+    Keep key resolution caches consistent with saved `ShortenedUrlData` rows.
+    """
+    register_key(instance.key)
+
+
+@receiver(post_delete, sender=ShortenedUrlData)
+def invalidate_shortened_url_key(sender, instance, **kwargs):
+    """
+    Keep key resolution caches consistent with deleted `ShortenedUrlData` rows.
+    """
+    invalidate_key(instance.key)
@@ -0,0 +1,135 @@
+"""
+Bloom filter utilities.
+"""
+
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+
+BLOOM_FILTER_MAGIC = b"UBLM"
+BLOOM_FILTER_VERSION = 1
+
+# Magic, version, size in bits, hash functions count, capacity, false positive rate, items count, watermark.
+HEADER_FORMAT = struct.Struct("<4sHQHQdQQ")
+
+
+class BloomFilterFormatError(Exception):
+    """
+    Raised when a file is not a valid serialized Bloom filter.
+    """
+
+
+class BloomFilter:
+    """
+    Thread-safe Bloom filter of strings.
+
+    Answers "definitely not added" or "probably added"; the probability of a wrong
+    "probably added" stays around `false_positive_rate` for up to `capacity` items.
+    Items cannot be removed.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        self.capacity = max(capacity, 1)
+        self.false_positive_rate = false_positive_rate
+        self.size = math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        # Arbitrary marker of what has been added, e.g. the last added row id.
+        self.watermark = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item: str):
+        """
+        Add the item to the filter.
+        """
+        positions = self._positions(item)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Size of the bit array, in bytes.
+        """
+        return len(self._bits)
+
+    @property
+    def estimated_false_positive_rate(self) -> float:
+        """
+        False positive rate expected with the current number of items.
+        """
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+    def stats(self) -> dict:
+        """
+        Filter properties, e.g. for logging or monitoring.
+        """
+        return {
+            "count": self.count,
+            "capacity": self.capacity,
+            "hash_count": self.hash_count,
+            "memory_bytes": self.memory_bytes,
+            "false_positive_rate": self.false_positive_rate,
+            "estimated_false_positive_rate": self.estimated_false_positive_rate,
+        }
+
+    def dump(self, path: str):
+        """
+        Serialize the filter into a file, atomically replacing it.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as file:
+            try:
+                with self._lock:
+                    file.write(HEADER_FORMAT.pack(
+                        BLOOM_FILTER_MAGIC, BLOOM_FILTER_VERSION, self.size, self.hash_count,
+                        self.capacity, self.false_positive_rate, self.count, self.watermark,
+                    ))
+                    file.write(self._bits)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.chmod(file.name, 0o644)
+        os.replace(file.name, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """
+        Deserialize a filter from a file written by `dump`.
+        """
+        with open(path, "rb") as file:
+            header = file.read(HEADER_FORMAT.size)
+            bits = file.read()
+        if len(header) < HEADER_FORMAT.size:
+            raise BloomFilterFormatError(f"'{path}' is too short to be a Bloom filter.")
+
+        magic, version, size, hash_count, capacity, false_positive_rate, count, watermark = HEADER_FORMAT.unpack(header)
+        if magic != BLOOM_FILTER_MAGIC or version != BLOOM_FILTER_VERSION or len(bits) != (size + 7) // 8:
+            raise BloomFilterFormatError(f"'{path}' is not a compatible Bloom filter.")
+
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.capacity = capacity
+        bloom_filter.false_positive_rate = false_positive_rate
+        bloom_filter.size = size
+        bloom_filter.hash_count = hash_count
+        bloom_filter.count = count
+        bloom_filter.watermark = watermark
+        bloom_filter._bits = bytearray(bits)
+        bloom_filter._lock = threading.Lock()
+        return bloom_filter
@@ -0,0 +1,132 @@
+"""
+Utilities to write shortened urls, one or many at once.
+"""
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from shortening.models import ClientData, OriginalUrlData, ShortenedUrlData, UniqueIpHitsCounter, UrlShorteningRequest
+from shortening.utils.key_resolution_utils import invalidate_original_urls, register_key
+from shortening.utils.url_shortening_utils import is_https_url, url_digest
+from shortening.utils.write_behind_utils import audit_record_buffer
+
+# Calls the `shorten_url` database function (see the `0008_shorten_url_function` migration).
+SHORTEN_URL_SQL = "SELECT * FROM shorten_url(%s, %s::uuid, %s, %s::inet, %s, %s, %s::smallint)"
+
+
+def shorten_url(url: str, client_ip) -> str:
+    """
+    Shorten an (already validated) url on behalf of a client.
+
+    Return the created key.
+
+    Original url and client rows are found or created, and the shortened url, the request
+    and its unique-ip accounting are written, in a single round trip to the database
+    (plus a query for keys to invalidate, when the url upgrades a stored http url to https).
+    Concurrent requests for the same url or from the same client never conflict.
+    """
+    key = ShortenedUrlData.create_unique_random_key()
+    approximate = settings.UNIQUE_IP_COUNTING_MODE == "approximate"
+    with connection.cursor() as cursor:
+        cursor.execute(SHORTEN_URL_SQL, [
+            url,
+            str(url_digest(url)),
+            key,
+            client_ip,
+            audit_record_buffer is None,
+            not approximate,
+            UniqueIpHitsCounter.random_shard(),
+        ])
+        original_url_data_id, client_data_id, shortened_url_data_id, url_upgraded = cursor.fetchone()
+
+    if audit_record_buffer is not None:
+        # Unique-ip accounting happens when buffered records are written.
+        audit_record_buffer.put(client_data_id, original_url_data_id, shortened_url_data_id)
+    elif approximate:
+        OriginalUrlData.increment_unique_ip_counts([original_url_data_id], [client_data_id])
+
+    # No `post_save` signal is sent.
+    register_key(key)
+    if url_upgraded:
+        invalidate_original_urls([original_url_data_id])
+    return key
+
+
+def shorten_urls(urls: list, client_ip) -> list:
+    """
+    Shorten (already validated) urls on behalf of a client.
+
+    Return the created keys, in the order of `urls`.
+
+    Issues a small, constant number of queries regardless of the number of urls:
+    one `IN` query resolves existing original urls, rows are inserted with
+    `bulk_create` (and http urls upgraded to https with `bulk_update`, then their keys
+    invalidated), and unique-ip counts are updated in a single statement.
+    """
+    keys = ShortenedUrlData.create_unique_random_keys(len(urls))
+
+    with transaction.atomic():
+        digests = {url: url_digest(url) for url in urls}
+        # Urls considered the same share a single original url: the first one given, or its first https variant.
+        unique_urls = {}
+        for url, digest in digests.items():
+            if digest not in unique_urls or is_https_url(url) and not is_https_url(unique_urls[digest]):
+                unique_urls[digest] = url
+        stored_urls = {
+            digest: (original_url_data_id, url)
+            for digest, original_url_data_id, url in OriginalUrlData.objects.filter(
+                url_digest__in=unique_urls,
+            ).values_list("url_digest", "id", "url")
+        }
+        missing_urls = [url for digest, url in unique_urls.items() if digest not in stored_urls]
+        if missing_urls:
+            # Concurrent requests may create some of the urls in the meantime.
+            OriginalUrlData.objects.bulk_create(
+                [OriginalUrlData(url=url, url_digest=digests[url]) for url in missing_urls],
+                ignore_conflicts=True,
+            )
+            stored_urls.update(
+                (digest, (original_url_data_id, url))
+                for digest, original_url_data_id, url in OriginalUrlData.objects.filter(
+                    url_digest__in=[digests[url] for url in missing_urls],
+                ).values_list("url_digest", "id", "url")
+            )
+        upgraded_urls = [
+            OriginalUrlData(id=original_url_data_id, url=unique_urls[digest], updated_at=timezone.now())
+            for digest, (original_url_data_id, url) in stored_urls.items()
+            if is_https_url(unique_urls[digest]) and not is_https_url(url)
+        ]
+        if upgraded_urls:
+            OriginalUrlData.objects.bulk_update(upgraded_urls, ["url", "updated_at"])
+        original_url_data_ids = {digest: stored_url[0] for digest, stored_url in stored_urls.items()}
+
+        client_data, _ = ClientData.objects.get_or_create(client_ip=client_ip)
+        if audit_record_buffer is None:
+            unique_ids = set(original_url_data_ids.values())
+            OriginalUrlData.increment_unique_ip_counts(unique_ids, [client_data.id] * len(unique_ids))
+
+        shortened_urls_data = ShortenedUrlData.objects.bulk_create([
+            ShortenedUrlData(key=key, original_url_data_id=original_url_data_ids[digests[url]])
+            for key, url in zip(keys, urls)
+        ])
+        if audit_record_buffer is None:
+            UrlShorteningRequest.objects.bulk_create([
+                UrlShorteningRequest(
+                    client_data=client_data,
+                    original_url_data_id=shortened_url_data.original_url_data_id,
+                    shortened_url_data=shortened_url_data,
+                )
+                for shortened_url_data in shortened_urls_data
+            ])
+
+    if audit_record_buffer is not None:
+        # Buffered records (and their unique-ip accounting) must only refer to committed rows.
+        for shortened_url_data in shortened_urls_data:
+            audit_record_buffer.put(client_data.id, shortened_url_data.original_url_data_id, shortened_url_data.id)
+
+    # `bulk_create` sends no `post_save` signals.
+    for key in keys:
+        register_key(key)
+    if upgraded_urls:
+        invalidate_original_urls([original_url_data.id for original_url_data in upgraded_urls])
+    return keys
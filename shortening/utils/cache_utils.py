@@ -0,0 +1,158 @@
+"""
+In-process caching utilities.
+"""
+
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# Returned by `KeyResolutionCache.get` when a key has no (fresh) cache entry.
+# Kept distinct from `None`, which is a cached "key does not exist" answer.
+NOT_CACHED = object()
+
+# Upper bound of a single frequency sketch counter (4-bit counters, as in TinyLFU).
+MAX_FREQUENCY = 15
+
+# Odd 64-bit multipliers deriving one independent-enough counter index per sketch row.
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+HASH_MASK = (1 << 64) - 1
+
+# Translation table halving every byte, to age all counters of a sketch row at once.
+HALVING_TABLE = bytes(value >> 1 for value in range(256))
+
+
+class FrequencySketch:
+    """
+    Count-min sketch estimating how often a key has been accessed recently.
+
+    Counters are periodically halved ("aged"), so the sketch reflects
+    recent popularity rather than all-time popularity.
+    """
+
+    def __init__(self, capacity: int):
+        width_bits = max(capacity, 64).bit_length()
+        self._shift = 64 - width_bits
+        self._table = [array("B", bytes(1 << width_bits)) for _ in SKETCH_SEEDS]
+        self._sample_size = 10 * max(capacity, 64)
+        self._additions = 0
+
+    def _indexes(self, key):
+        key_hash = hash(key) & HASH_MASK
+        return [((key_hash * seed) & HASH_MASK) >> self._shift for seed in SKETCH_SEEDS]
+
+    def increment(self, key):
+        """
+        Record an access to the key.
+        """
+        for row, index in zip(self._table, self._indexes(key)):
+            if row[index] < MAX_FREQUENCY:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def frequency(self, key) -> int:
+        """
+        Estimated recent access frequency of the key.
+        """
+        return min(row[index] for row, index in zip(self._table, self._indexes(key)))
+
+    def _reset(self):
+        # Translated in C rather than counter by counter: the cache lock is held meanwhile.
+        self._table = [array("B", row.tobytes().translate(HALVING_TABLE)) for row in self._table]
+        self._additions //= 2
+
+
+class KeyResolutionCache:
+    """
+    Bounded, thread-safe LRU cache with TTL and TinyLFU admission.
+
+    Maps a shortened url key to its original url. `None` values are cached
+    as well ("negative caching"), with their own, usually shorter, TTL.
+
+    When the cache is full, a new entry is only admitted if it has been
+    requested more often recently than the least recently used entry,
+    so one-off lookups (e.g. scrapers) cannot flush hot keys out of the cache.
+
+    NOTE: the cache is per process; invalidations are not propagated
+     to other workers, the TTL bounds their staleness.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._sketch = FrequencySketch(max_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+
+    def get(self, key):
+        """
+        Get the cached original url for the key, or `NOT_CACHED`.
+        """
+        if not self.max_size:
+            return NOT_CACHED
+        with self._lock:
+            self._sketch.increment(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return NOT_CACHED
+
+    def set(self, key, value):
+        """
+        Cache the original url (or `None` for a non-existing key) for the key.
+        """
+        if not self.max_size:
+            return
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                victim = next(iter(self._entries))
+                if self._sketch.frequency(key) <= self._sketch.frequency(victim):
+                    self.rejections += 1
+                    return
+                del self._entries[victim]
+                self.evictions += 1
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+
+    def invalidate(self, key):
+        """
+        Drop the cache entry for the key, if any.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drop all cache entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Cache counters, e.g. for logging or monitoring (see `key_resolution_utils.collect_metrics`).
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rejections": self.rejections,
+            }
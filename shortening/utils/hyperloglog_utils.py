@@ -0,0 +1,114 @@
+"""
+HyperLogLog sketches estimating numbers of distinct values.
+"""
+
+import math
+from hashlib import blake2b
+
+HASH_BITS = 64
+
+# Register value -> its weight in the harmonic mean of the estimate.
+RANK_WEIGHTS = [2.0 ** -rank for rank in range(HASH_BITS + 1)]
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+def precision_for_error_rate(error_rate: float) -> int:
+    """
+    Smallest precision whose standard error (1.04 / sqrt(2 ** precision)) is at most `error_rate`.
+    """
+    precision = math.ceil(math.log2((1.04 / error_rate) ** 2))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog sketch: `2 ** precision` one-byte registers.
+
+    Sketches of the same values are mergeable: the union of two sets is estimated by
+    the register-wise maximum of their sketches, so sketches built separately
+    (e.g. per worker) can be combined without any loss. Sketches of different
+    precisions are merged at the lower one.
+    """
+
+    def __init__(self, precision: int, registers: bytes = None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"Precision must be between {MIN_PRECISION} and {MAX_PRECISION}.")
+        self.precision = precision
+        self.registers = bytearray(registers if registers is not None else 1 << precision)
+        if len(self.registers) != 1 << precision:
+            raise ValueError(f"A sketch of precision {precision} has {1 << precision} registers.")
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Load a sketch serialized by `bytes()`.
+        """
+        precision = len(data).bit_length() - 1
+        if len(data) != 1 << precision:
+            raise ValueError(f"Invalid sketch size: {len(data)} bytes.")
+        return cls(precision, data)
+
+    def __bytes__(self):
+        return bytes(self.registers)
+
+    @property
+    def standard_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, value) -> bool:
+        """
+        Add a value; return whether the sketch changed.
+        """
+        value_hash = int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), "big")
+        rank_bits = HASH_BITS - self.precision
+        index = value_hash >> rank_bits
+        rank = rank_bits - (value_hash & ((1 << rank_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def fold(self, precision: int):
+        """
+        Return a copy of the sketch at a lower (or the same) precision.
+        """
+        if precision > self.precision:
+            raise ValueError("A sketch cannot be folded to a higher precision.")
+        if precision == self.precision:
+            return HyperLogLog(precision, self.registers)
+        shift = self.precision - precision
+        folded = HyperLogLog(precision)
+        for index, rank in enumerate(self.registers):
+            if not rank:
+                continue
+            # The index bits dropped by folding become the leading bits of the rank.
+            dropped = index & ((1 << shift) - 1)
+            new_rank = shift - dropped.bit_length() + 1 if dropped else rank + shift
+            new_index = index >> shift
+            if new_rank > folded.registers[new_index]:
+                folded.registers[new_index] = new_rank
+        return folded
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """
+        Return the sketch of the union of both sketched sets.
+        """
+        precision = min(self.precision, other.precision)
+        merged, other = self.fold(precision), other.fold(precision)
+        merged.registers = bytearray(map(max, merged.registers, other.registers))
+        return merged
+
+    def estimate(self) -> int:
+        """
+        Estimated number of distinct values added.
+        """
+        size = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / sum(map(RANK_WEIGHTS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Small range correction: linear counting.
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
@@ -0,0 +1,179 @@
+"""
+Block-allocated, collision-free shortened url keys.
+
+Each worker reserves a block of numbers from a Postgres sequence in a single
+statement, then maps every number to a key locally, through a keyed bijective
+permutation of the keyspace (a Feistel network with cycle walking).
+Distinct numbers always give distinct keys, so no uniqueness query is needed
+when a key is issued, and consecutive numbers give unrelated, non-guessable keys.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from shortening.constants import KEY_ALPHABET, KEY_LENGTH, KEY_SEQUENCE_NAME
+from url_shortener.metrics import (
+    key_block_refill_seconds_total,
+    key_blocks_refilled_total,
+    key_collisions_skipped_total,
+    keys_available,
+    keys_issued_total,
+    registry,
+)
+
+FEISTEL_ROUNDS = 4
+
+
+class KeyPermutation:
+    """
+    Keyed bijection of `range(len(KEY_ALPHABET) ** length)` onto itself.
+    """
+
+    def __init__(self, secret: str, length: int = KEY_LENGTH):
+        self.length = length
+        self.keyspace_size = len(KEY_ALPHABET) ** length
+        half_bits = ((self.keyspace_size - 1).bit_length() + 1) // 2
+        self._half_bits = half_bits
+        self._half_mask = (1 << half_bits) - 1
+        self._half_bytes = (half_bits + 7) // 8
+        self._round_keys = [
+            hashlib.blake2b(f"{round_}:{secret}".encode(), digest_size=16).digest()
+            for round_ in range(FEISTEL_ROUNDS)
+        ]
+
+    def _round(self, value, round_key):
+        digest = hashlib.blake2b(value.to_bytes(self._half_bytes, "big"), key=round_key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") & self._half_mask
+
+    def _feistel(self, number):
+        left, right = number >> self._half_bits, number & self._half_mask
+        for round_key in self._round_keys:
+            left, right = right, left ^ self._round(right, round_key)
+        return (left << self._half_bits) | right
+
+    def permute(self, number: int) -> int:
+        """
+        Map a number of the keyspace to another number of the keyspace.
+
+        The Feistel network permutes a slightly larger power-of-two domain;
+        results falling outside the keyspace are fed back in ("cycle walking").
+        """
+        if not 0 <= number < self.keyspace_size:
+            raise ValueError(f"{number} is outside of the keyspace.")
+        number = self._feistel(number)
+        while number >= self.keyspace_size:
+            number = self._feistel(number)
+        return number
+
+    def key(self, number: int) -> str:
+        """
+        Shortened url key for a sequence number.
+
+        Example: "KLO7K9VV".
+        """
+        number = self.permute(number)
+        base = len(KEY_ALPHABET)
+        chars = []
+        for _ in range(self.length):
+            number, index = divmod(number, base)
+            chars.append(KEY_ALPHABET[index])
+        return "".join(reversed(chars))
+
+
+class KeyAllocator:
+    """
+    Thread-safe, per-process issuer of unique keys, refilled block by block.
+    """
+
+    def __init__(self, secret: str, block_size: int, length: int = KEY_LENGTH):
+        self.permutation = KeyPermutation(secret, length)
+        self.block_size = block_size
+        self._keys = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self.keys_issued = 0
+        self.blocks_refilled = 0
+        self.refill_seconds = 0.0
+        self.collisions_skipped = 0
+        self.last_sequence_value = 0
+
+    def allocate(self) -> str:
+        """
+        Issue a key, reserving a new block of sequence numbers if needed.
+        """
+        with self._lock:
+            # A block reserved before a fork must not be shared by the forked workers.
+            if not self._keys or self._pid != os.getpid():
+                self._refill()
+            self.keys_issued += 1
+            return self._keys.pop()
+
+    def _refill(self):
+        from shortening.models import ShortenedUrlData  # NOQA: avoid a circular import
+
+        started_at = time.perf_counter()
+        keys = []
+        while not keys:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(%s) FROM generate_series(1, %s)",
+                    [KEY_SEQUENCE_NAME, self.block_size],
+                )
+                numbers = [row[0] for row in cursor.fetchall()]
+            keys = [self.permutation.key(number) for number in numbers]
+
+            # Keys issued randomly before block allocation was introduced
+            # may coincide with permuted ones; skip those, once per block.
+            taken = set(ShortenedUrlData.objects.filter(key__in=keys).values_list("key", flat=True))
+            if taken:
+                available = [key for key in keys if key not in taken]
+                self.collisions_skipped += len(keys) - len(available)
+                keys = available
+            self.last_sequence_value = max(numbers)
+
+        # Issue keys in sequence order.
+        keys.reverse()
+        self._keys = keys
+        self._pid = os.getpid()
+        self.blocks_refilled += 1
+        self.refill_seconds += time.perf_counter() - started_at
+
+    def stats(self) -> dict:
+        """
+        Allocation counters, e.g. for logging or monitoring (see `collect_metrics`).
+        """
+        with self._lock:
+            return {
+                "keys_issued": self.keys_issued,
+                "keys_available": len(self._keys),
+                "blocks_refilled": self.blocks_refilled,
+                "refill_seconds": self.refill_seconds,
+                "collisions_skipped": self.collisions_skipped,
+                "keyspace_utilisation": self.last_sequence_value / self.permutation.keyspace_size,
+            }
+
+
+key_allocator = KeyAllocator(
+    secret=settings.KEY_PERMUTATION_SECRET,
+    block_size=settings.KEY_ALLOCATION_BLOCK_SIZE,
+)
+
+
+@registry.collector
+def collect_metrics():
+    """
+    Publish counters of the key allocator of this process.
+
+    The keyspace utilisation is left out: it is global, not to be summed up across processes.
+    """
+    stats = key_allocator.stats()
+    keys_issued_total.set(stats["keys_issued"])
+    keys_available.set(stats["keys_available"])
+    key_blocks_refilled_total.set(stats["blocks_refilled"])
+    key_block_refill_seconds_total.set(stats["refill_seconds"])
+    key_collisions_skipped_total.set(stats["collisions_skipped"])
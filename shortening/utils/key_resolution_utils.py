@@ -0,0 +1,327 @@
+"""
+Utilities to resolve shortened url keys to original urls.
+"""
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from shortening.models import ShortenedUrlData
+from shortening.utils.bloom_filter_utils import BloomFilter, BloomFilterFormatError
+from shortening.utils.cache_utils import NOT_CACHED, KeyResolutionCache
+from shortening.utils.snapshot_utils import RedirectSnapshot
+from url_shortener.db_routers import replica_reads, replica_reads_enabled
+from url_shortener.metrics import (
+    key_cache_entries,
+    key_cache_evictions_total,
+    key_cache_lookups_total,
+    key_cache_rejections_total,
+    registry,
+)
+
+# Rows younger than this may still be followed by rows with lower ids (committed later),
+# so the Bloom filter watermark never moves past them.
+BLOOM_FILTER_WATERMARK_LAG = timedelta(seconds=10)
+
+CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class KeyBloomFilter:
+    """
+    Per-process Bloom filter of all existing shortened url keys.
+
+    Built on first use from a file written by `manage.py build_key_bloom_filter`
+    (if configured) or from a streaming scan of keys, then kept up to date:
+    keys created by this process are added at once, keys created by other
+    processes are caught up with when a key is not found, at most once per
+    `catch_up_interval` seconds: misses in the meantime are answered from the filter,
+    so a flood of unknown keys costs one query per interval. Keys created by other
+    processes less than `catch_up_interval` seconds ago may thus be reported as missing.
+
+    A catch-up reads the keys of rows after the latest one it added (an index range scan,
+    usually empty); rows following the filter watermark are read again at most once per
+    `BLOOM_FILTER_WATERMARK_LAG`, for those with lower ids committed later.
+
+    While the database is unavailable, keys are answered from the filter alone.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float, path: str = "", catch_up_interval: float = 1):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.path = path
+        self.catch_up_interval = catch_up_interval
+        self._filter = None
+        # When the latest catch-up, and the latest one reading rows after the watermark, started (monotonic time).
+        self._caught_up_at = None
+        self._rescanned_at = None
+        # Id of the latest row added by a catch-up.
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def filter(self) -> BloomFilter:
+        if self._filter is None:
+            with self._lock:
+                if self._filter is None:
+                    self._filter = self._build()
+        return self._filter
+
+    def might_exist(self, key: str) -> bool:
+        """
+        `False` if the key definitely does not exist, `True` if it probably does.
+        """
+        answer = self.check(key)
+        if answer is None:
+            answer = self.refresh_and_check(key)
+        return answer
+
+    def check(self, key: str):
+        """
+        Like `might_exist`, without database queries: return `None` instead
+        when the filter must be built or caught up with the database first.
+        """
+        bloom_filter = self._filter
+        if bloom_filter is not None and key in bloom_filter:
+            return True
+        return None
+
+    def refresh_and_check(self, key: str) -> bool:
+        """
+        Build the filter or catch it up with the database (unless it was lately), then check the key.
+        """
+        bloom_filter = self.filter
+        if key in bloom_filter:
+            return True
+        if self._catch_up_due():
+            with self._lock:
+                # Concurrent misses share a catch-up.
+                if self._catch_up_due():
+                    try:
+                        self._catch_up(bloom_filter)
+                    except DatabaseError:
+                        logger.warning("Catching the key Bloom filter up failed.", exc_info=True)
+                        # Retried after the interval, rather than on every miss.
+                        self._caught_up_at = time.monotonic()
+        return key in bloom_filter
+
+    def add(self, key: str):
+        """
+        Add a created key to the filter, if it is built already.
+        """
+        if self._filter is not None:
+            self._filter.add(key)
+
+    def rebuild(self) -> BloomFilter:
+        """
+        Build the filter from a full scan of keys.
+        """
+        bloom_filter = BloomFilter(
+            capacity=max(self.capacity, ShortenedUrlData.objects.count()),
+            false_positive_rate=self.false_positive_rate,
+        )
+        self._catch_up(bloom_filter)
+        self._filter = bloom_filter
+        return bloom_filter
+
+    def stats(self) -> dict:
+        """
+        Filter properties, e.g. for logging or monitoring.
+        """
+        return self._filter.stats() if self._filter is not None else {}
+
+    def _catch_up_due(self) -> bool:
+        return self._caught_up_at is None or time.monotonic() - self._caught_up_at >= self.catch_up_interval
+
+    def _build(self):
+        if self.path:
+            try:
+                bloom_filter = BloomFilter.load(self.path)
+            except (OSError, BloomFilterFormatError):
+                pass
+            else:
+                try:
+                    self._catch_up(bloom_filter)
+                except DatabaseError:
+                    # Caught up with on the next miss; known keys are served meanwhile.
+                    logger.warning("Catching the key Bloom filter up failed.", exc_info=True)
+                return bloom_filter
+        return self.rebuild()
+
+    def _catch_up(self, bloom_filter):
+        """
+        Add keys of rows created after the latest one added, or after the filter watermark
+        (at most once per `BLOOM_FILTER_WATERMARK_LAG`, or for another filter).
+
+        Always reads from the primary: rows missing from a lagging replica would never be added.
+        """
+        started_at = time.monotonic()
+        rescan = (
+            bloom_filter is not self._filter
+            or self._rescanned_at is None
+            or started_at - self._rescanned_at >= BLOOM_FILTER_WATERMARK_LAG.total_seconds()
+        )
+        after_id = bloom_filter.watermark if rescan else max(bloom_filter.watermark, self._last_id)
+        cutoff = timezone.now() - BLOOM_FILTER_WATERMARK_LAG
+        watermark_final = False
+        last_id = after_id
+        with replica_reads(False):
+            rows = ShortenedUrlData.objects.filter(id__gt=after_id).order_by("id").values_list(
+                "id", "key", "created_at",
+            ).iterator(chunk_size=CHUNK_SIZE)
+            for id_, key, created_at in rows:
+                bloom_filter.add(key)
+                last_id = id_
+                if created_at > cutoff:
+                    watermark_final = True
+                if not watermark_final:
+                    bloom_filter.watermark = id_
+        self._last_id = last_id
+        self._caught_up_at = started_at
+        if rescan:
+            self._rescanned_at = started_at
+
+
+key_resolution_cache = KeyResolutionCache(
+    max_size=settings.KEY_CACHE_MAX_SIZE,
+    ttl=settings.KEY_CACHE_TTL,
+    negative_ttl=settings.KEY_CACHE_NEGATIVE_TTL,
+)
+
+key_bloom_filter = KeyBloomFilter(
+    capacity=settings.KEY_BLOOM_FILTER_CAPACITY,
+    false_positive_rate=settings.KEY_BLOOM_FILTER_FALSE_POSITIVE_RATE,
+    path=settings.KEY_BLOOM_FILTER_PATH,
+    catch_up_interval=settings.KEY_BLOOM_FILTER_CATCH_UP_INTERVAL,
+) if settings.KEY_BLOOM_FILTER_ENABLED else None
+
+redirect_snapshot = RedirectSnapshot(
+    path=settings.REDIRECT_SNAPSHOT_PATH,
+    check_interval=settings.REDIRECT_SNAPSHOT_CHECK_INTERVAL,
+) if settings.REDIRECT_SNAPSHOT_PATH else None
+
+
+def resolve_original_url(key: str):
+    """
+    Get the original url for a shortened url key, or `None` if the key does not exist.
+
+    Lookup order: in-process cache, Bloom filter of existing keys (if enabled),
+    memory-mapped redirect snapshot (if configured), then the database (a single query,
+    or two if a replica does not have the key yet and the primary is asked too).
+    Keys found in the snapshot resolve without touching the database, e.g. while it is unavailable;
+    so do keys rejected by the Bloom filter then (otherwise, after a catch-up with recent keys).
+    """
+    url = key_resolution_cache.get(key)
+    if url is not NOT_CACHED:
+        return url
+
+    if key_bloom_filter is not None and not key_bloom_filter.might_exist(key):
+        return None
+
+    if redirect_snapshot is not None:
+        url = redirect_snapshot.get(key)
+        if url is not None:
+            key_resolution_cache.set(key, url)
+            return url
+
+    url = _original_urls(key).first()
+    if url is None and replica_reads_enabled():
+        # Not cached as missing before the primary confirms it.
+        with replica_reads(False):
+            url = _original_urls(key).first()
+    key_resolution_cache.set(key, url)
+    return url
+
+
+async def aresolve_original_url(key: str):
+    """
+    Async version of `resolve_original_url`.
+
+    In-process lookups run on the event loop; only the database fallback
+    (and Bloom filter catch-ups) is handed over to a thread.
+    """
+    url = key_resolution_cache.get(key)
+    if url is not NOT_CACHED:
+        return url
+
+    if key_bloom_filter is not None:
+        might_exist = key_bloom_filter.check(key)
+        if might_exist is None:
+            might_exist = await sync_to_async(key_bloom_filter.refresh_and_check)(key)
+        if not might_exist:
+            return None
+
+    if redirect_snapshot is not None:
+        url = redirect_snapshot.get(key)
+        if url is not None:
+            key_resolution_cache.set(key, url)
+            return url
+
+    url = await _original_urls(key).afirst()
+    if url is None and replica_reads_enabled():
+        with replica_reads(False):
+            url = await _original_urls(key).afirst()
+    key_resolution_cache.set(key, url)
+    return url
+
+
+def _original_urls(key: str):
+    return ShortenedUrlData.objects.filter(key=key).values_list("original_url_data__url", flat=True)
+
+
+def register_key(key: str):
+    """
+    Make a created key resolvable in this process at once.
+
+    Call it whenever a `ShortenedUrlData` row is created.
+    """
+    key_resolution_cache.invalidate(key)
+    if key_bloom_filter is not None:
+        key_bloom_filter.add(key)
+
+
+def invalidate_key(key: str):
+    """
+    Forget whatever is known about the key in this process.
+
+    Call it whenever a `ShortenedUrlData` row is deleted, or its original url changes.
+    """
+    key_resolution_cache.invalidate(key)
+    if redirect_snapshot is not None:
+        redirect_snapshot.invalidate(key)
+
+
+def invalidate_original_urls(original_url_data_ids):
+    """
+    Forget whatever is known about the keys of original urls in this process.
+
+    Call it (once committed) whenever original urls change, e.g. when upgraded to https.
+    Other processes still serve the previous urls from their caches (for up to `KEY_CACHE_TTL` seconds)
+    and from the redirect snapshot (until the next full export).
+    """
+    with replica_reads(False):
+        keys = ShortenedUrlData.objects.filter(original_url_data_id__in=original_url_data_ids).values_list(
+            "key", flat=True,
+        )
+        for key in keys.iterator(chunk_size=CHUNK_SIZE):
+            invalidate_key(key)
+
+
+@registry.collector
+def collect_metrics():
+    """
+    Publish counters of the key resolution cache of this process.
+    """
+    stats = key_resolution_cache.stats()
+    key_cache_lookups_total.set(stats["hits"], result="hit")
+    key_cache_lookups_total.set(stats["misses"], result="miss")
+    key_cache_evictions_total.set(stats["evictions"])
+    key_cache_rejections_total.set(stats["rejections"])
+    key_cache_entries.set(stats["size"])
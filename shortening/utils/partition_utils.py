@@ -0,0 +1,106 @@
+"""
+Utilities to maintain monthly range partitions of `url_shortening_request` (by `created_at`).
+"""
+
+import re
+from datetime import datetime, timezone
+
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+PARTITIONED_TABLE = "url_shortening_request"
+
+# The table as it was before partitioning: attached as the partition of everything
+# created before the first monthly partition.
+LEGACY_PARTITION = f"{PARTITIONED_TABLE}_legacy"
+
+# Requests of months without a partition (e.g. when maintenance did not run), moved out
+# into their partition once it is created.
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+
+PARTITIONS_SQL = """
+    SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+    FROM pg_inherits
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = %s::regclass
+"""
+
+DEFAULT_PARTITION_SQL = """
+    SELECT NULLIF(partdefid, 0)::regclass::text FROM pg_partitioned_table WHERE partrelid = %s::regclass
+"""
+
+PARTITION_BOUNDS_REGEX = re.compile(r"FOR VALUES FROM \((?P<lower>[^)]+)\) TO \((?P<upper>[^)]+)\)")
+
+
+def month_start(moment: datetime, months: int = 0) -> datetime:
+    """
+    Start (in UTC) of the month of a moment, shifted by a number of months.
+    """
+    moment = moment.astimezone(timezone.utc)
+    month_index = moment.year * 12 + moment.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARTITIONED_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def get_partitions(cursor) -> list:
+    """
+    Partitions as (name, lower bound, upper bound) tuples ordered by bounds,
+    `None` standing for an unbounded side. The default partition is left out.
+    """
+    cursor.execute(PARTITIONS_SQL, [PARTITIONED_TABLE])
+    partitions = []
+    for name, bounds in cursor.fetchall():
+        if bounds == "DEFAULT":
+            continue
+        match = PARTITION_BOUNDS_REGEX.match(bounds)
+        partitions.append((name, *(
+            None if bound == "MINVALUE" else parse_datetime(bound.strip("'"))
+            for bound in (match["lower"], match["upper"])
+        )))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+def create_partition(cursor, month: datetime) -> str:
+    """
+    Create the partition of a month.
+
+    The partition is created empty, then attached, which only takes a share update exclusive
+    lock on the partitioned table: concurrent inserts and reads go on. Requests of the month
+    in the default partition are moved into it first; the default partition stays locked
+    until the partition is attached (which checks it has no requests of the month left).
+    """
+    name = partition_name(month)
+    bounds = [month, month_start(month, 1)]
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(
+            f"CREATE TABLE {name} (LIKE {PARTITIONED_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        cursor.execute(DEFAULT_PARTITION_SQL, [PARTITIONED_TABLE])
+        default_partition = cursor.fetchone()[0]
+        if default_partition:
+            cursor.execute(f"LOCK TABLE {default_partition} IN ACCESS EXCLUSIVE MODE")
+            cursor.execute(
+                f"WITH moved AS (DELETE FROM {default_partition} WHERE created_at >= %s AND created_at < %s "
+                f"RETURNING *) INSERT INTO {name} SELECT * FROM moved",
+                bounds,
+            )
+        cursor.execute(
+            f"ALTER TABLE {PARTITIONED_TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            bounds,
+        )
+    return name
+
+
+def detach_partition(cursor, name: str, concurrently: bool = True):
+    """
+    Detach a partition, keeping it as a standalone table.
+
+    Detaching concurrently does not block queries of the partitioned table,
+    but cannot be done in a transaction.
+    """
+    cursor.execute(
+        f"ALTER TABLE {PARTITIONED_TABLE} DETACH PARTITION {name}{' CONCURRENTLY' if concurrently else ''}"
+    )
@@ -0,0 +1,219 @@
+"""
+Memory-mapped redirect snapshots.
+
+A snapshot is a compact, sorted binary file of shortened url key -> original url pairs:
+
+    header | index: `count` fixed-width entries sorted by key | heap: original urls
+
+Header: magic, format version, key width, entries count,
+the highest `ShortenedUrlData.id` exported ("watermark") and the heap offset.
+Index entry: NUL-padded key, offset of the url in the heap, url length.
+
+Every worker maps the file read-only, so all workers share a single copy
+through the OS page cache, and resolves keys by binary search.
+A small "delta" snapshot (`<path>.delta`) of keys created after the full export
+is overlaid on top of the full snapshot.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+SNAPSHOT_MAGIC = b"USNP"
+SNAPSHOT_VERSION = 1
+
+# Max length of a key in the snapshot, in bytes; longer keys are left to the database.
+SNAPSHOT_KEY_WIDTH = 16
+
+HEADER_FORMAT = struct.Struct("<4sHHQQQ")
+INDEX_FORMAT = struct.Struct(f"<{SNAPSHOT_KEY_WIDTH}sQI")
+
+DELTA_SUFFIX = ".delta"
+
+
+class SnapshotFormatError(Exception):
+    """
+    Raised when a file is not a valid redirect snapshot.
+    """
+
+
+def encode_key(key: str):
+    """
+    Encode a key for the snapshot index, or return `None` if it does not fit.
+    """
+    try:
+        encoded = key.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    if len(encoded) > SNAPSHOT_KEY_WIDTH:
+        return None
+    return encoded.ljust(SNAPSHOT_KEY_WIDTH, b"\0")
+
+
+def write_snapshot(path: str, rows, watermark: int) -> int:
+    """
+    Write (key, url) rows, sorted by key in bytewise order, into a snapshot file.
+
+    The file is written next to `path` and atomically moved into place,
+    so readers never see a partially written snapshot.
+
+    Return the number of exported entries.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    count = 0
+    heap_size = 0
+    with tempfile.TemporaryFile(dir=directory) as heap, \
+            tempfile.NamedTemporaryFile(dir=directory, delete=False) as snapshot:
+        try:
+            snapshot.write(bytes(HEADER_FORMAT.size))
+            for key, url in rows:
+                encoded_key = encode_key(key)
+                if encoded_key is None:
+                    continue
+                encoded_url = url.encode("utf-8")
+                snapshot.write(INDEX_FORMAT.pack(encoded_key, heap_size, len(encoded_url)))
+                heap.write(encoded_url)
+                heap_size += len(encoded_url)
+                count += 1
+
+            heap_offset = snapshot.tell()
+            heap.seek(0)
+            while chunk := heap.read(1024 * 1024):
+                snapshot.write(chunk)
+
+            snapshot.seek(0)
+            snapshot.write(HEADER_FORMAT.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_KEY_WIDTH, count, watermark, heap_offset,
+            ))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        except BaseException:
+            os.unlink(snapshot.name)
+            raise
+    os.chmod(snapshot.name, 0o644)
+    os.replace(snapshot.name, path)
+    return count
+
+
+class SnapshotFile:
+    """
+    Read-only, memory-mapped snapshot file.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self.mtime = os.fstat(file.fileno()).st_mtime_ns
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < HEADER_FORMAT.size:
+            raise SnapshotFormatError(f"'{path}' is too short to be a redirect snapshot.")
+
+        magic, version, key_width, self.count, self.watermark, self._heap_offset = HEADER_FORMAT.unpack_from(self._mm)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or key_width != SNAPSHOT_KEY_WIDTH:
+            raise SnapshotFormatError(f"'{path}' is not a compatible redirect snapshot.")
+
+    def get(self, key: str):
+        """
+        Binary search the index for the key; return its original url or `None`.
+        """
+        encoded_key = encode_key(key)
+        if encoded_key is None:
+            return None
+
+        mm = self._mm
+        entry_size = INDEX_FORMAT.size
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER_FORMAT.size + middle * entry_size
+            candidate = mm[start:start + SNAPSHOT_KEY_WIDTH]
+            if candidate < encoded_key:
+                low = middle + 1
+            elif candidate > encoded_key:
+                high = middle
+            else:
+                _, offset, length = INDEX_FORMAT.unpack_from(mm, start)
+                start = self._heap_offset + offset
+                return mm[start:start + length].decode("utf-8")
+        return None
+
+    def close(self):
+        self._mm.close()
+
+
+class RedirectSnapshot:
+    """
+    Full snapshot plus its delta overlay, reloaded whenever the files are replaced.
+
+    Reload checks (a `stat` per file) happen at most every `check_interval` seconds.
+    Keys invalidated in this process (e.g. as their original url changed) are left to the database
+    from then on, as the files may still hold their previous urls.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5.0):
+        self.path = path
+        self.delta_path = path + DELTA_SUFFIX
+        self.check_interval = check_interval
+        self._base = None
+        self._delta = None
+        self._checked_at = None
+        self._invalidated = set()
+        self._lock = threading.Lock()
+
+    @property
+    def watermark(self) -> int:
+        """
+        Highest `ShortenedUrlData.id` covered by the snapshot and its delta.
+        """
+        self._refresh()
+        return max(
+            self._base.watermark if self._base else 0,
+            self._delta.watermark if self._delta else 0,
+        )
+
+    def get(self, key: str):
+        """
+        Original url for the key, or `None` if the snapshot does not know the key (or it is invalidated).
+        """
+        if key in self._invalidated:
+            return None
+        self._refresh()
+        base, delta = self._base, self._delta
+        url = delta.get(key) if delta else None
+        if url is None and base:
+            url = base.get(key)
+        return url
+
+    def invalidate(self, key: str):
+        """
+        Stop serving the key from the snapshot in this process.
+        """
+        with self._lock:
+            self._invalidated.add(key)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            self._checked_at = now
+            self._base = self._reopen(self.path, self._base)
+            self._delta = self._reopen(self.delta_path, self._delta)
+            # A delta written against an older full snapshot is stale.
+            if self._base and self._delta and self._delta.watermark <= self._base.watermark:
+                self._delta = None
+
+    @staticmethod
+    def _reopen(path, current):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if current is not None and current.mtime == mtime:
+            return current
+        try:
+            return SnapshotFile(path)
+        except (OSError, SnapshotFormatError):
+            return current
@@ -3,12 +3,16 @@ URL shortening utilities.
 """
 
 import secrets
-import string
-from urllib.parse import urlunsplit
+import uuid
+from hashlib import blake2b
+from urllib.parse import urlsplit, urlunsplit
 
 from django.conf import settings
 
-from shortening.constants import KEY_LENGTH
+from shortening.constants import KEY_ALPHABET, KEY_LENGTH
+
+# Schemes not distinguished by canonical urls, with their default ports.
+WEB_SCHEME_PORTS = {"http": "80", "https": "443"}
 
 
 def create_random_key(length: int = KEY_LENGTH) -> str:
@@ -18,8 +22,53 @@ def create_random_key(length: int = KEY_LENGTH) -> str:
     Example: "KLO7K9VV".
     """
     # NOTE: consider not limiting the algo to uppercase, e.g. "ouoYFY48"
-    chars = string.ascii_uppercase + string.digits
-    return "".join(secrets.choice(chars) for _ in range(length))
+    return "".join(secrets.choice(KEY_ALPHABET) for _ in range(length))
+
+
+def add_default_scheme(url: str, scheme: str = "http") -> str:
+    """
+    Prefix a url with a scheme, unless it has one already.
+
+    Example: "www.google.com" -> "http://www.google.com".
+    """
+    if "://" not in url:
+        url = f"{scheme}://{url}"
+    return url
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Canonical form of a url: urls with the same canonical form are considered the same.
+
+    The web scheme ("http" or "https"), host case, default ports and trailing slashes
+    are not significant, e.g. "https://Google.com:443/" and "http://google.com" are the same.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    userinfo, at, host = parts.netloc.rpartition("@")
+    host = host.lower()
+    if scheme in WEB_SCHEME_PORTS:
+        host = host.removesuffix(f":{WEB_SCHEME_PORTS[scheme]}")
+        scheme = ""
+    return urlunsplit((scheme, f"{userinfo}{at}{host}", parts.path.rstrip("/"), parts.query, parts.fragment))
+
+
+def url_digest(url: str) -> uuid.UUID:
+    """
+    Fixed-width (16-byte BLAKE2) digest of the canonical form of a url.
+
+    Stored as a UUID, for a compact, fixed-width database column and index.
+    """
+    return uuid.UUID(bytes=blake2b(canonicalize_url(url).encode(), digest_size=16).digest())
+
+
+def is_https_url(url: str) -> bool:
+    """
+    Whether a url uses the https scheme.
+
+    Of urls considered the same, an https variant is stored, so redirects are never downgraded to http.
+    """
+    return url.lower().startswith("https:")
 
 
 def create_shortened_url(key: str,
@@ -0,0 +1,433 @@
+"""
+Write-behind buffering of database writes.
+"""
+
+import abc
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from shortening.utils.hyperloglog_utils import HyperLogLog, precision_for_error_rate
+from url_shortener.metrics import (
+    audit_queue_depth,
+    audit_records_total,
+    clicks_pending,
+    clicks_total,
+    registry,
+    unique_ip_sketch_clients_total,
+    unique_ip_sketch_merges_total,
+    unique_ip_sketch_pending_urls,
+    write_behind_flush_seconds_total,
+    write_behind_flushes_total,
+)
+
+logger = logging.getLogger(__name__)
+
+# Inserts audit records, keeping the time they were enqueued at (`updated_at` is the time they are written at).
+FLUSH_REQUESTS_SQL = """
+    INSERT INTO url_shortening_request (
+        client_data_id, original_url_data_id, shortened_url_data_id, created_at, updated_at
+    )
+    SELECT client_data_id, original_url_data_id, shortened_url_data_id, created_at, now()
+    FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[], %s::timestamptz[])
+        AS records (client_data_id, original_url_data_id, shortened_url_data_id, created_at)
+"""
+
+# Adds buffered clicks to shortened urls. Rows are locked in a stable order,
+# so concurrent flushes of several workers do not deadlock.
+FLUSH_CLICKS_SQL = """
+    WITH counted AS (
+        SELECT shortened_url_data.id, counts.clicks
+        FROM unnest(%s::text[], %s::bigint[]) AS counts (key, clicks)
+        JOIN shortened_url_data ON shortened_url_data.key = counts.key
+        ORDER BY shortened_url_data.id
+        FOR UPDATE OF shortened_url_data
+    )
+    UPDATE shortened_url_data SET clicks = shortened_url_data.clicks + counted.clicks
+    FROM counted
+    WHERE shortened_url_data.id = counted.id
+"""
+
+
+class BackgroundFlusher(abc.ABC):
+    """
+    Base class of per-process buffers flushed by a background thread.
+
+    A flush happens every `flush_interval` seconds, when `should_flush` says so
+    (checked by `notify`), and on interpreter shutdown (e.g. a graceful worker exit).
+    With `background=False`, no thread is started and `flush` must be called explicitly.
+    """
+
+    def __init__(self, flush_interval: float, background: bool = True):
+        self.flush_interval = flush_interval
+        self.background = background
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._close_at_exit = False
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+
+    @abc.abstractmethod
+    def should_flush(self) -> bool:
+        """
+        Whether enough data is buffered for a flush to be due before the next interval.
+        """
+
+    @abc.abstractmethod
+    def _flush(self):
+        """
+        Write buffered data; return the number of written items.
+        """
+
+    def notify(self):
+        """
+        Start the flusher thread if needed, and wake it up if a flush is due.
+        """
+        if not self.background or self._closed:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            with self._thread_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                    self._thread.start()
+                    # Once, even though the thread is started again after forks.
+                    if not self._close_at_exit:
+                        atexit.register(self.close)
+                        self._close_at_exit = True
+        if self.should_flush():
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """
+        Write buffered data now; return the number of written items.
+        """
+        with self._flush_lock:
+            started_at = time.perf_counter()
+            count = self._flush()
+            if count:
+                self.last_flush_seconds = time.perf_counter() - started_at
+                self.flush_seconds += self.last_flush_seconds
+                self.flushes += 1
+            return count
+
+    def close(self):
+        """
+        Stop the flusher thread and flush whatever is left.
+        """
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self._flush_safely()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_safely()
+
+    def _flush_safely(self):
+        close_old_connections()
+        try:
+            self.flush()
+        except Exception:  # NOQA: the flusher thread must survive database errors
+            logger.exception("%s flush failed.", type(self).__name__)
+        finally:
+            close_old_connections()
+
+
+class AuditRecordBuffer(BackgroundFlusher):
+    """
+    Bounded queue of `UrlShorteningRequest` records, written in batches.
+
+    Unique-ip accounting of buffered records happens at flush time,
+    so counts are up to a flush interval late.
+    When the queue is full, producers wait up to `enqueue_timeout` seconds for room
+    (backpressure); if there is still none, the record is written synchronously.
+    Records of a batch failing to be written twice are dropped (and counted).
+    """
+
+    def __init__(self, max_size: int, flush_size: int, flush_interval: float,
+                 enqueue_timeout: float, background: bool = True):
+        super().__init__(flush_interval=flush_interval, background=background)
+        self.flush_size = flush_size
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        # Guards the counters, updated by request threads and the flusher thread.
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.synchronous_writes = 0
+
+    def put(self, client_data_id, original_url_data_id, shortened_url_data_id):
+        """
+        Buffer an audit record of a client request to shorten an url.
+        """
+        record = (client_data_id, original_url_data_id, shortened_url_data_id, timezone.now())
+        try:
+            self._queue.put(record, timeout=self.enqueue_timeout if self.background else 0)
+        except queue.Full:
+            with self._lock:
+                self.synchronous_writes += 1
+            self._write([record])
+            return
+        with self._lock:
+            self.enqueued += 1
+        self.notify()
+
+    def should_flush(self) -> bool:
+        return self._queue.qsize() >= self.flush_size
+
+    def _flush(self) -> int:
+        written = 0
+        while True:
+            records = []
+            while len(records) < self.flush_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not records:
+                return written
+            try:
+                self._write(records)
+            except Exception:  # NOQA: retry once, e.g. after a dropped connection
+                logger.warning("Writing %s audit records failed; retrying.", len(records), exc_info=True)
+                close_old_connections()
+                try:
+                    self._write(records)
+                except Exception:  # NOQA
+                    with self._lock:
+                        self.dropped += len(records)
+                    raise
+            written += len(records)
+            with self._lock:
+                self.written += len(records)
+
+    @staticmethod
+    def _write(records):
+        from shortening.models import OriginalUrlData  # NOQA: avoid a circular import
+
+        client_data_ids, original_url_data_ids, shortened_url_data_ids, created_ats = zip(*records)
+        with transaction.atomic(), connection.cursor() as cursor:
+            OriginalUrlData.increment_unique_ip_counts(original_url_data_ids, client_data_ids)
+            cursor.execute(FLUSH_REQUESTS_SQL, [
+                list(client_data_ids), list(original_url_data_ids), list(shortened_url_data_ids), list(created_ats),
+            ])
+
+    def stats(self) -> dict:
+        """
+        Buffer counters, e.g. for logging or monitoring (see `collect_metrics`).
+        """
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_max_size": self._queue.maxsize,
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "synchronous_writes": self.synchronous_writes,
+                "flushes": self.flushes,
+                "flush_seconds": self.flush_seconds,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+
+class ClickCounter(BackgroundFlusher):
+    """
+    Per-process counts of redirects per shortened url key, added to `ShortenedUrlData.clicks` in batches.
+
+    Counting a click only increments a dict entry. Counts of a failed flush
+    are kept for the next one.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float, background: bool = True):
+        super().__init__(flush_interval=flush_interval, background=background)
+        self.flush_size = flush_size
+        self._counts = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.counted = 0
+        self.written = 0
+
+    def add(self, key: str):
+        """
+        Count a redirect via the key.
+        """
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+            self._pending += 1
+            self.counted += 1
+        self.notify()
+
+    def should_flush(self) -> bool:
+        return self._pending >= self.flush_size
+
+    def _flush(self) -> int:
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._pending = 0
+        if not counts:
+            return 0
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(FLUSH_CLICKS_SQL, [list(counts), list(counts.values())])
+        except Exception:  # NOQA: keep the counts, e.g. while the database is unavailable
+            with self._lock:
+                for key, clicks in counts.items():
+                    self._counts[key] = self._counts.get(key, 0) + clicks
+                    self._pending += clicks
+            raise
+
+        clicks = sum(counts.values())
+        with self._lock:
+            self.written += clicks
+        return clicks
+
+    def stats(self) -> dict:
+        """
+        Click counting counters, e.g. for logging or monitoring (see `collect_metrics`).
+        """
+        with self._lock:
+            return {
+                "pending_clicks": self._pending,
+                "pending_keys": len(self._counts),
+                "counted": self.counted,
+                "written": self.written,
+                "flushes": self.flushes,
+                "flush_seconds": self.flush_seconds,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+
+class UniqueIpSketchBuffer(BackgroundFlusher):
+    """
+    Per-process HyperLogLog sketches of the clients of original urls, merged into the stored ones in batches.
+
+    In the 'approximate' unique-ip counting mode, shortening only adds the client to an in-memory sketch,
+    so requests for a popular url do not queue up on its row lock; a flush locks and updates the row
+    of each buffered url once. Unique-ip counts are up to a flush interval late.
+    Sketches of a failed flush are kept for the next one.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float, background: bool = True):
+        super().__init__(flush_interval=flush_interval, background=background)
+        self.flush_size = flush_size
+        self._sketches = {}
+        self._lock = threading.Lock()
+        self.added = 0
+        self.merged = 0
+
+    def add(self, original_url_data_ids, client_data_ids):
+        """
+        Add clients to the sketches of the original urls they request.
+        """
+        precision = precision_for_error_rate(settings.UNIQUE_IP_SKETCH_ERROR_RATE)
+        with self._lock:
+            for original_url_data_id, client_data_id in zip(original_url_data_ids, client_data_ids):
+                sketch = self._sketches.get(original_url_data_id)
+                if sketch is None:
+                    sketch = self._sketches[original_url_data_id] = HyperLogLog(precision)
+                sketch.add(client_data_id)
+                self.added += 1
+        self.notify()
+
+    def should_flush(self) -> bool:
+        return len(self._sketches) >= self.flush_size
+
+    def _flush(self) -> int:
+        from shortening.models import OriginalUrlData  # NOQA: avoid a circular import
+
+        with self._lock:
+            sketches, self._sketches = self._sketches, {}
+        if not sketches:
+            return 0
+
+        try:
+            OriginalUrlData.merge_unique_ip_sketches(sketches)
+        except Exception:  # NOQA: keep the sketches, e.g. while the database is unavailable
+            with self._lock:
+                for original_url_data_id, sketch in sketches.items():
+                    newer = self._sketches.get(original_url_data_id)
+                    self._sketches[original_url_data_id] = sketch if newer is None else sketch.merge(newer)
+            raise
+
+        with self._lock:
+            self.merged += len(sketches)
+        return len(sketches)
+
+    def stats(self) -> dict:
+        """
+        Sketch buffering counters, e.g. for logging or monitoring (see `collect_metrics`).
+        """
+        with self._lock:
+            return {
+                "pending_urls": len(self._sketches),
+                "added": self.added,
+                "merged": self.merged,
+                "flushes": self.flushes,
+                "flush_seconds": self.flush_seconds,
+                "last_flush_seconds": self.last_flush_seconds,
+            }
+
+
+audit_record_buffer = AuditRecordBuffer(
+    max_size=settings.AUDIT_WRITE_BEHIND_QUEUE_SIZE,
+    flush_size=settings.AUDIT_WRITE_BEHIND_FLUSH_SIZE,
+    flush_interval=settings.AUDIT_WRITE_BEHIND_FLUSH_INTERVAL,
+    enqueue_timeout=settings.AUDIT_WRITE_BEHIND_ENQUEUE_TIMEOUT,
+) if settings.AUDIT_WRITE_BEHIND_ENABLED else None
+
+click_counter = ClickCounter(
+    flush_size=settings.CLICK_COUNTING_FLUSH_SIZE,
+    flush_interval=settings.CLICK_COUNTING_FLUSH_INTERVAL,
+) if settings.CLICK_COUNTING_ENABLED else None
+
+unique_ip_sketch_buffer = UniqueIpSketchBuffer(
+    flush_size=settings.UNIQUE_IP_SKETCH_FLUSH_SIZE,
+    flush_interval=settings.UNIQUE_IP_SKETCH_FLUSH_INTERVAL,
+)
+
+
+@registry.collector
+def collect_metrics():
+    """
+    Publish counters of the write-behind buffers of this process.
+    """
+    if audit_record_buffer is not None:
+        stats = audit_record_buffer.stats()
+        for outcome in ("enqueued", "written", "dropped"):
+            audit_records_total.set(stats[outcome], outcome=outcome)
+        audit_records_total.set(stats["synchronous_writes"], outcome="synchronous_write")
+        audit_queue_depth.set(stats["queue_depth"])
+        publish_flush_metrics("audit_records", stats)
+
+    if click_counter is not None:
+        stats = click_counter.stats()
+        clicks_total.set(stats["counted"], outcome="counted")
+        clicks_total.set(stats["written"], outcome="written")
+        clicks_pending.set(stats["pending_clicks"])
+        publish_flush_metrics("clicks", stats)
+
+    stats = unique_ip_sketch_buffer.stats()
+    unique_ip_sketch_clients_total.set(stats["added"])
+    unique_ip_sketch_merges_total.set(stats["merged"])
+    unique_ip_sketch_pending_urls.set(stats["pending_urls"])
+    publish_flush_metrics("unique_ip_sketches", stats)
+
+
+def publish_flush_metrics(buffer: str, stats: dict):
+    write_behind_flushes_total.set(stats["flushes"], buffer=buffer)
+    write_behind_flush_seconds_total.set(stats["flush_seconds"], buffer=buffer)
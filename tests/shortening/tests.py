@@ -0,0 +1,1021 @@
+"""
+Test url shortening layer utilities.
+"""
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mock import patch
+
+from shortening.constants import KEY_ALPHABET, KEY_LENGTH
+from shortening.management.commands.run_benchmarks import QUERY_ALLOWANCES, QUERY_BUDGETS
+from shortening.models import (
+    ClientData,
+    DailyUrlShorteningRollup,
+    HourlyUrlShorteningRollup,
+    ImportCheckpoint,
+    OriginalUrlClient,
+    OriginalUrlData,
+    RollupWatermark,
+    ShortenedUrlData,
+    UniqueIpHitsCounter,
+    UrlShorteningRequest,
+)
+from shortening.utils.bloom_filter_utils import BloomFilter
+from shortening.utils.bulk_shortening_utils import shorten_url
+from shortening.utils.cache_utils import NOT_CACHED, FrequencySketch, KeyResolutionCache
+from shortening.utils.key_allocation_utils import KeyAllocator, KeyPermutation, key_allocator
+from shortening.utils.hyperloglog_utils import HyperLogLog
+from shortening.utils.key_resolution_utils import KeyBloomFilter, key_resolution_cache, resolve_original_url
+from shortening.utils.partition_utils import (
+    DEFAULT_PARTITION,
+    LEGACY_PARTITION,
+    detach_partition,
+    get_partitions,
+    month_start,
+    partition_name,
+)
+from shortening.utils.snapshot_utils import RedirectSnapshot
+from shortening.utils.url_shortening_utils import canonicalize_url, url_digest
+from shortening.utils.write_behind_utils import AuditRecordBuffer, ClickCounter, UniqueIpSketchBuffer
+from url_shortener.metrics import registry
+
+from tests.factories import (
+    ClientDataFactory,
+    OriginalUrlDataFactory,
+    ShortenedUrlDataFactory,
+    UrlShorteningRequestFactory,
+)
+
+
+class CanonicalUrlTest(TestCase):
+    """
+    Test url canonicalization.
+    """
+
+    def test_same_urls(self):
+        for url in ("http://google.com", "https://Google.com/", "http://google.com:80//", "https://google.com:443"):
+            self.assertEqual(canonicalize_url(url), "//google.com")
+            self.assertEqual(url_digest(url), url_digest("http://google.com"))
+
+    def test_different_urls(self):
+        urls = [
+            "http://google.com/Search",
+            "http://google.com/search",
+            "http://google.com/search?q=1",
+            "http://google.com:8080",
+            "ftp://google.com",
+        ]
+        self.assertEqual(len({url_digest(url) for url in urls}), len(urls))
+
+
+class UniqueIpCountTest(TestCase):
+    """
+    Test unique-ip accounting of original urls.
+    """
+
+    def setUp(self):
+        self.example = OriginalUrlDataFactory()
+        self.other = OriginalUrlDataFactory(url="http://other.com/")
+        self.john = ClientDataFactory(client_ip="0.0.0.1")
+        self.alice = ClientDataFactory(client_ip="0.0.0.2")
+
+    def test_pairs_counted_once(self):
+        """
+        Each (url, client) pair is counted once, whether repeated within a call or across calls.
+        """
+        with self.assertNumQueries(1):
+            OriginalUrlData.increment_unique_ip_counts(
+                [self.example.id, self.example.id, self.other.id],
+                [self.john.id, self.john.id, self.john.id],
+            )
+        OriginalUrlData.increment_unique_ip_count(self.example, self.john)
+        OriginalUrlData.increment_unique_ip_count(self.example, self.alice)
+
+        self.example.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual(self.example.unique_ip_hits, 2)
+        self.assertEqual(self.other.unique_ip_hits, 1)
+        self.assertEqual(OriginalUrlClient.objects.count(), 3)
+        self.assertEqual(UniqueIpHitsCounter.total(), 3)
+
+    def test_reconcile_counter(self):
+        """
+        Drift of the global counter is reported, then repaired.
+        """
+        OriginalUrlData.increment_unique_ip_count(self.example, self.john)
+        OriginalUrlData.objects.filter(id=self.other.id).update(unique_ip_hits=2)
+
+        with self.assertRaises(CommandError):
+            call_command("reconcile_unique_ip_hits_counter", check=True, stdout=StringIO())
+        call_command("reconcile_unique_ip_hits_counter", stdout=StringIO())
+
+        self.assertEqual(UniqueIpHitsCounter.total(), 3)
+        call_command("reconcile_unique_ip_hits_counter", check=True, stdout=StringIO())
+
+
+class HyperLogLogTest(TestCase):
+    """
+    Test HyperLogLog sketches.
+    """
+
+    def test_estimate_within_error(self):
+        sketch = HyperLogLog(precision=12)
+        for value in range(20000):
+            sketch.add(value)
+        self.assertAlmostEqual(sketch.estimate(), 20000, delta=20000 * 3 * sketch.standard_error)
+        self.assertFalse(sketch.add(0))
+
+    def test_merge_is_union(self):
+        """
+        Merging sketches equals sketching the union, also across precisions.
+        """
+        first, second, union = HyperLogLog(12), HyperLogLog(10), HyperLogLog(10)
+        for value in range(3000):
+            (first if value % 2 else second).add(value)
+            union.add(value)
+
+        merged = first.merge(second)
+        self.assertEqual(merged.precision, 10)
+        self.assertEqual(bytes(merged), bytes(union))
+        self.assertEqual(HyperLogLog.from_bytes(bytes(merged)).estimate(), union.estimate())
+
+
+@override_settings(UNIQUE_IP_COUNTING_MODE="approximate", UNIQUE_IP_SKETCH_ERROR_RATE=0.05)
+class ApproximateUniqueIpCountTest(TestCase):
+    """
+    Test unique-ip accounting of original urls with HyperLogLog sketches.
+    """
+
+    def setUp(self):
+        self.example = OriginalUrlDataFactory()
+        self.john = ClientDataFactory(client_ip="0.0.0.1")
+        self.alice = ClientDataFactory(client_ip="0.0.0.2")
+        self.buffer = UniqueIpSketchBuffer(flush_size=10, flush_interval=60, background=False)
+        buffer_patcher = patch("shortening.models.unique_ip_sketch_buffer", self.buffer)
+        buffer_patcher.start()
+        self.addCleanup(buffer_patcher.stop)
+
+    def test_pairs_counted_once(self):
+        with self.assertNumQueries(0):
+            # Clients are sketched in memory, the url row is neither locked nor written.
+            OriginalUrlData.increment_unique_ip_counts([self.example.id] * 2, [self.john.id] * 2)
+        OriginalUrlData.increment_unique_ip_count(self.example, self.john)
+        self.assertEqual(self.buffer.flush(), 1)
+        OriginalUrlData.increment_unique_ip_count(self.example, self.john)
+        with self.assertNumQueries(1):
+            # The stored sketch is unchanged, so the row is not written.
+            self.buffer.flush()
+        OriginalUrlData.increment_unique_ip_count(self.example, self.alice)
+        self.buffer.flush()
+
+        self.example.refresh_from_db()
+        self.assertEqual(self.example.unique_ip_hits, 2)
+        self.assertEqual(OriginalUrlClient.objects.count(), 0)
+        self.assertEqual(UniqueIpHitsCounter.total(), 2)
+
+    def test_failed_flush_keeps_sketches(self):
+        OriginalUrlData.increment_unique_ip_count(self.example, self.john)
+        with patch.object(OriginalUrlData, "merge_unique_ip_sketches", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.buffer.flush()
+        OriginalUrlData.increment_unique_ip_count(self.example, self.alice)
+        self.buffer.flush()
+
+        self.example.refresh_from_db()
+        self.assertEqual(self.example.unique_ip_hits, 2)
+
+    def test_metrics(self):
+        with patch("shortening.utils.write_behind_utils.unique_ip_sketch_buffer", self.buffer):
+            OriginalUrlData.increment_unique_ip_counts([self.example.id] * 2, [self.john.id, self.alice.id])
+            self.assertEqual(registry.get_sample_value("url_shortener_unique_ip_sketch_pending_urls"), 1)
+            self.buffer.flush()
+
+            self.assertEqual(registry.get_sample_value("url_shortener_unique_ip_sketch_clients_total"), 2)
+            self.assertEqual(registry.get_sample_value("url_shortener_unique_ip_sketch_merges_total"), 1)
+            self.assertEqual(registry.get_sample_value("url_shortener_unique_ip_sketch_pending_urls"), 0)
+
+    def test_merge_worker_sketches(self):
+        worker_sketches = [HyperLogLog(8), HyperLogLog(8)]
+        for value in range(100):
+            worker_sketches[value % 2].add(value)
+        for sketch in worker_sketches:
+            OriginalUrlData.merge_unique_ip_sketches({self.example.id: sketch})
+
+        self.example.refresh_from_db()
+        self.assertEqual(self.example.unique_ip_hits, worker_sketches[0].merge(worker_sketches[1]).estimate())
+        self.assertAlmostEqual(self.example.unique_ip_hits, 100, delta=15)
+        self.assertEqual(UniqueIpHitsCounter.total(), self.example.unique_ip_hits)
+
+
+class ConcurrentShortenUrlTest(TransactionTestCase):
+    """
+    Test shortening the same url concurrently.
+    """
+
+    def test_no_conflicts(self):
+        """
+        John shortens the same url from several threads at once: all succeed, and his ip is counted once.
+        """
+        def shorten(_):
+            try:
+                return shorten_url("https://www.example-1.com", "0.0.0.1")
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            keys = list(executor.map(shorten, range(32)))
+
+        self.assertEqual(len(set(keys)), 32)
+        self.assertEqual(OriginalUrlData.objects.get().unique_ip_hits, 1)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 32)
+        self.assertEqual(UniqueIpHitsCounter.total(), 1)
+
+    def test_unknown_client_ip(self):
+        """
+        Urls shortened by clients of unknown ip are recorded under a single client.
+        """
+        shorten_url("https://www.example-1.com", None)
+        shorten_url("https://www.example-2.com", None)
+
+        self.assertEqual(ClientData.objects.get().client_ip, None)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 2)
+
+
+class KeyResolutionCacheTest(TestCase):
+    """
+    Test KeyResolutionCache logic.
+    """
+
+    def setUp(self):
+        self.cache = KeyResolutionCache(max_size=2, ttl=60, negative_ttl=60)
+
+    def test_hit_and_miss(self):
+        """
+        Cached values (including `None`) are hits, unknown keys are misses.
+        """
+        self.assertIs(self.cache.get("AAAAAAA1"), NOT_CACHED)
+        self.cache.set("AAAAAAA1", "http://example.com/")
+        self.cache.set("AAAAAAA2", None)
+
+        self.assertEqual(self.cache.get("AAAAAAA1"), "http://example.com/")
+        self.assertIsNone(self.cache.get("AAAAAAA2"))
+        self.assertEqual(self.cache.stats()["hits"], 2)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_expired_entry_is_a_miss(self):
+        """
+        Entries are not served after their TTL.
+        """
+        cache = KeyResolutionCache(max_size=2, ttl=0, negative_ttl=0)
+        cache.set("AAAAAAA1", "http://example.com/")
+        self.assertIs(cache.get("AAAAAAA1"), NOT_CACHED)
+
+    def test_admission_keeps_frequent_keys(self):
+        """
+        A one-off key does not evict a frequently requested one,
+        while a frequently requested key gets admitted.
+        """
+        for _ in range(5):
+            self.cache.get("HOT00001")
+            self.cache.get("HOT00002")
+        self.cache.set("HOT00001", "http://example-1.com/")
+        self.cache.set("HOT00002", "http://example-2.com/")
+
+        self.cache.get("COLD0001")
+        self.cache.set("COLD0001", None)
+        self.assertIs(self.cache.get("COLD0001"), NOT_CACHED)
+        self.assertEqual(self.cache.stats()["rejections"], 1)
+
+        for _ in range(10):
+            self.cache.get("HOT00003")
+        self.cache.set("HOT00003", "http://example-3.com/")
+        self.assertEqual(self.cache.get("HOT00003"), "http://example-3.com/")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_sketch_aging_halves_frequencies(self):
+        """
+        Once enough accesses are recorded, every counter of the sketch is halved.
+        """
+        sketch = FrequencySketch(capacity=64)
+        for _ in range(10):
+            sketch.increment("HOT00001")
+        sketch._reset()
+        self.assertEqual(sketch.frequency("HOT00001"), 5)
+        self.assertEqual(sketch.frequency("COLD0001"), 0)
+
+
+class ResolveOriginalUrlTest(TestCase):
+    """
+    Test resolve_original_url logic.
+    """
+
+    def setUp(self):
+        key_resolution_cache.clear()
+
+    def test_resolution_is_cached(self):
+        """
+        A resolved key is served from the cache on subsequent lookups.
+        """
+        shortened_url_data = ShortenedUrlDataFactory()
+        self.assertEqual(resolve_original_url(shortened_url_data.key), shortened_url_data.original_url_data.url)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_original_url(shortened_url_data.key), shortened_url_data.original_url_data.url)
+
+    def test_cache_metrics(self):
+        """
+        Cache counters are exported as metrics.
+        """
+        hits = registry.get_sample_value("url_shortener_key_cache_lookups_total", {"result": "hit"})
+        shortened_url_data = ShortenedUrlDataFactory()
+        for _ in range(3):
+            resolve_original_url(shortened_url_data.key)
+        self.assertEqual(registry.get_sample_value("url_shortener_key_cache_lookups_total", {"result": "hit"}), hits + 2)
+        self.assertEqual(
+            registry.get_sample_value("url_shortener_key_cache_entries"), key_resolution_cache.stats()["size"],
+        )
+
+    def test_created_key_invalidates_negative_entry(self):
+        """
+        Creating a shortened url makes a previously unknown key resolvable at once.
+        """
+        key = "NEWKEY01"
+        self.assertIsNone(resolve_original_url(key))
+        original_url_data = OriginalUrlDataFactory()
+        ShortenedUrlData.objects.create(key=key, original_url_data=original_url_data)
+        self.assertEqual(resolve_original_url(key), original_url_data.url)
+
+
+class RedirectSnapshotTest(TestCase):
+    """
+    Test redirect snapshot export and lookup logic.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "redirects.snapshot")
+        self.original_url_data = OriginalUrlDataFactory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_full_export_lookup(self):
+        """
+        Every exported key resolves to its original url; unknown keys resolve to `None`.
+        """
+        keys = ["ZZZZZZZ9", "AAAAAAA1", "0000000A", "MMMMMMM5"]
+        for key in keys:
+            ShortenedUrlData.objects.create(key=key, original_url_data=self.original_url_data)
+        call_command("export_redirect_snapshot", path=self.path, stdout=StringIO())
+
+        snapshot = RedirectSnapshot(self.path)
+        for key in keys:
+            self.assertEqual(snapshot.get(key), self.original_url_data.url)
+        self.assertIsNone(snapshot.get("NONEXIST"))
+
+    def test_upgraded_url_invalidates_keys(self):
+        """
+        Keys of an url upgraded to https stop being served from the snapshot (and cache) of the process.
+        """
+        original_url_data = OriginalUrlDataFactory(url="http://www.example-1.com")
+        ShortenedUrlData.objects.create(key="HTTPKEY1", original_url_data=original_url_data)
+        call_command("export_redirect_snapshot", path=self.path, stdout=StringIO())
+        key_resolution_cache.clear()
+
+        with patch("shortening.utils.key_resolution_utils.redirect_snapshot", RedirectSnapshot(self.path)):
+            with self.assertNumQueries(0):
+                self.assertEqual(resolve_original_url("HTTPKEY1"), "http://www.example-1.com")
+            shorten_url("https://www.example-1.com", "0.0.0.1")
+            self.assertEqual(resolve_original_url("HTTPKEY1"), "https://www.example-1.com")
+
+    def test_delta_export_lookup(self):
+        """
+        Keys created after the full export are served from the delta snapshot.
+        """
+        ShortenedUrlData.objects.create(key="AAAAAAA1", original_url_data=self.original_url_data)
+        call_command("export_redirect_snapshot", path=self.path, stdout=StringIO())
+        ShortenedUrlData.objects.create(key="BBBBBBB2", original_url_data=self.original_url_data)
+        call_command("export_redirect_snapshot", path=self.path, delta=True, stdout=StringIO())
+
+        snapshot = RedirectSnapshot(self.path)
+        self.assertEqual(snapshot.get("AAAAAAA1"), self.original_url_data.url)
+        self.assertEqual(snapshot.get("BBBBBBB2"), self.original_url_data.url)
+
+
+class KeyAllocationTest(TestCase):
+    """
+    Test block key allocation logic.
+    """
+
+    def test_permutation_is_injective(self):
+        """
+        Distinct sequence numbers give distinct, well-formed keys.
+        """
+        permutation = KeyPermutation(secret="test")
+        keys = {permutation.key(number) for number in range(5000)}
+        self.assertEqual(len(keys), 5000)
+        for key in keys:
+            self.assertEqual(len(key), KEY_LENGTH)
+            self.assertTrue(set(key) <= set(KEY_ALPHABET))
+
+    def test_block_refill(self):
+        """
+        Keys are unique, and the database is only queried once per block.
+        """
+        allocator = KeyAllocator(secret="test", block_size=10)
+        with self.assertNumQueries(2):
+            keys = {allocator.allocate() for _ in range(10)}
+        self.assertEqual(len(keys), 10)
+
+        allocator.allocate()
+        stats = allocator.stats()
+        self.assertEqual(stats["blocks_refilled"], 2)
+        self.assertEqual(stats["keys_issued"], 11)
+        self.assertGreater(stats["keyspace_utilisation"], 0)
+
+    def test_metrics(self):
+        allocator = KeyAllocator(secret="test", block_size=10)
+        allocator.allocate()
+        with patch("shortening.utils.key_allocation_utils.key_allocator", allocator):
+            self.assertEqual(registry.get_sample_value("url_shortener_keys_issued_total"), 1)
+            self.assertEqual(registry.get_sample_value("url_shortener_keys_available"), 9)
+            self.assertEqual(registry.get_sample_value("url_shortener_key_blocks_refilled_total"), 1)
+
+    def test_issued_keys_are_skipped(self):
+        """
+        Keys already taken (e.g. issued randomly) are never issued again.
+        """
+        allocator = KeyAllocator(secret="test", block_size=10)
+        key = allocator.allocate()
+        original_url_data = OriginalUrlDataFactory()
+        ShortenedUrlData.objects.create(key=key, original_url_data=original_url_data)
+
+        fresh_allocator = KeyAllocator(secret="test", block_size=10)
+        fresh_allocator.permutation.key = lambda number: key if number % 2 else f"FRESH{number % 1000:03d}"
+        keys = {fresh_allocator.allocate() for _ in range(5)}
+        self.assertNotIn(key, keys)
+        self.assertEqual(fresh_allocator.stats()["collisions_skipped"], 5)
+
+
+class KeyBloomFilterTest(TestCase):
+    """
+    Test Bloom filter logic.
+    """
+
+    def test_membership_and_serialization(self):
+        """
+        Added items are always found, also after a dump/load round trip.
+        """
+        bloom_filter = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        keys = [f"KEY{number:05d}" for number in range(1000)]
+        for key in keys:
+            bloom_filter.add(key)
+        self.assertTrue(all(key in bloom_filter for key in keys))
+        false_positives = sum(f"MISS{number:04d}" in bloom_filter for number in range(1000))
+        self.assertLess(false_positives, 50)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "keys.bloom")
+            bloom_filter.dump(path)
+            loaded = BloomFilter.load(path)
+        self.assertTrue(all(key in loaded for key in keys))
+        self.assertEqual(loaded.stats(), bloom_filter.stats())
+
+    def test_unknown_key_is_caught_up_with(self):
+        """
+        Keys missing from the filter are checked against keys created since it was last caught up with,
+        so without a catch-up interval a key just created by another process is never reported as missing.
+        """
+        key_bloom_filter = KeyBloomFilter(capacity=100, false_positive_rate=0.001, catch_up_interval=0)
+        shortened_url_data = ShortenedUrlDataFactory()
+        self.assertTrue(key_bloom_filter.might_exist(shortened_url_data.key))
+        with self.assertNumQueries(0):
+            self.assertTrue(key_bloom_filter.might_exist(shortened_url_data.key))
+        with self.assertNumQueries(1):
+            self.assertFalse(key_bloom_filter.might_exist("NONEXIST"))
+
+        # Created by another process: not added to this filter by the signal handler.
+        with patch("shortening.signals.register_key"):
+            ShortenedUrlData.objects.create(key="NEWKEY01", original_url_data=shortened_url_data.original_url_data)
+        self.assertTrue(key_bloom_filter.might_exist("NEWKEY01"))
+
+    def test_catch_ups_are_rate_limited(self):
+        """
+        Misses within the catch-up interval are answered from the filter; consecutive misses
+        after it share a single catch-up.
+        """
+        key_bloom_filter = KeyBloomFilter(capacity=100, false_positive_rate=0.001, catch_up_interval=60)
+        shortened_url_data = ShortenedUrlDataFactory()
+        key_bloom_filter.filter
+        with patch("shortening.signals.register_key"):
+            ShortenedUrlData.objects.create(key="NEWKEY01", original_url_data=shortened_url_data.original_url_data)
+
+        with self.assertNumQueries(0):
+            for number in range(5):
+                self.assertFalse(key_bloom_filter.might_exist(f"MISS{number:04d}"))
+            self.assertFalse(key_bloom_filter.might_exist("NEWKEY01"))
+
+        with patch("shortening.utils.key_resolution_utils.time.monotonic", return_value=time.monotonic() + 60):
+            with self.assertNumQueries(1):
+                for number in range(5):
+                    self.assertFalse(key_bloom_filter.might_exist(f"MISS{number:04d}"))
+                self.assertTrue(key_bloom_filter.might_exist("NEWKEY01"))
+
+    def test_unavailable_database(self):
+        """
+        While the database is unavailable, keys are answered from the filter.
+        """
+        key_bloom_filter = KeyBloomFilter(capacity=100, false_positive_rate=0.001)
+        shortened_url_data = ShortenedUrlDataFactory()
+        key_bloom_filter.filter
+
+        with patch.object(key_bloom_filter, "_catch_up", side_effect=DatabaseError):
+            self.assertTrue(key_bloom_filter.might_exist(shortened_url_data.key))
+            self.assertFalse(key_bloom_filter.might_exist("NONEXIST"))
+
+
+class ImportLinksCommandTest(TestCase):
+    """
+    Test import_links command logic.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def test_jsonl_import(self):
+        """
+        Valid records are imported, invalid ones are skipped, unique-ip counts are recomputed.
+        """
+        path = self.write("links.jsonl", "\n".join([
+            '{"url": "https://www.example-1.com", "key": "IMPORT01", "client_ip": "0.0.0.1"}',
+            '{"url": "https://www.example-1.com", "key": "IMPORT02", "client_ip": "0.0.0.2"}',
+            '{"url": "https://www.example-1.com", "client_ip": "0.0.0.2"}',
+            '{"url": "www.example-2.com", "created_at": "2022-10-04T14:24:00+00:00"}',
+            '{"url": "www.example_1111.com"}',
+            'not json',
+        ]))
+        call_command("import_links", path, batch_size=2, stdout=StringIO())
+
+        self.assertEqual(ShortenedUrlData.objects.count(), 4)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 3)
+        self.assertEqual(OriginalUrlData.objects.get(url="https://www.example-1.com").unique_ip_hits, 2)
+        self.assertEqual(UniqueIpHitsCounter.total(), 2)
+        self.assertTrue(ShortenedUrlData.objects.filter(key="IMPORT01").exists())
+
+        # The checkpoint makes a re-run a no-op.
+        call_command("import_links", path, stdout=StringIO())
+        self.assertEqual(ShortenedUrlData.objects.count(), 4)
+
+    def test_csv_import(self):
+        """
+        CSV records are imported the same way.
+        """
+        path = self.write("links.csv", "url,key,client_ip\nhttps://www.example-1.com,IMPORT01,0.0.0.1\nwww.example-2.com,,\n")
+        call_command("import_links", path, stdout=StringIO())
+        self.assertEqual(ShortenedUrlData.objects.count(), 2)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 1)
+
+    def test_https_variant_upgrades_url(self):
+        """
+        An https variant of an imported http url upgrades it, even in a later batch.
+        """
+        path = self.write("links.jsonl", "\n".join([
+            '{"url": "http://www.example-1.com", "key": "IMPORT01"}',
+            '{"url": "http://www.example-1.com/", "key": "IMPORT02"}',
+            '{"url": "https://www.example-1.com", "key": "IMPORT03"}',
+        ]))
+        call_command("import_links", path, batch_size=2, stdout=StringIO())
+        self.assertEqual(OriginalUrlData.objects.get().url, "https://www.example-1.com")
+
+    def test_csv_quoted_newlines(self):
+        """
+        Quoted CSV fields may span lines.
+        """
+        path = self.write("links.csv", 'url,key\n"https://www.example-1.com/a\nb",IMPORT01\nwww.example-2.com,IMPORT02\n')
+        call_command("import_links", path, stdout=StringIO())
+        self.assertEqual(set(ShortenedUrlData.objects.values_list("key", flat=True)), {"IMPORT02"})
+        self.assertEqual(ImportCheckpoint.objects.get().records, 2)
+
+    def test_non_string_fields_are_skipped(self):
+        """
+        Records with non-string fields are counted as skipped.
+        """
+        path = self.write("links.jsonl", "\n".join([
+            '{"url": 1}',
+            '{"url": "https://www.example-1.com", "key": 1}',
+            '{"url": "https://www.example-1.com", "key": ["IMPORT01"]}',
+            '{"url": "https://www.example-1.com", "created_at": 1664893440}',
+            '{"url": "https://www.example-1.com", "client_ip": 1}',
+            '{"url": "https://www.example-1.com", "key": "IMPORT01", "client_ip": null}',
+        ]))
+        call_command("import_links", path, stdout=StringIO())
+        self.assertEqual(list(ShortenedUrlData.objects.values_list("key", flat=True)), ["IMPORT01"])
+        self.assertEqual(ImportCheckpoint.objects.get().skipped, 5)
+
+    def test_key_conflicts_are_reported(self):
+        """
+        Records whose key exists already are not imported, but counted and reported.
+        """
+        shortened_url_data = ShortenedUrlDataFactory(key="IMPORT01")
+        path = self.write("links.jsonl", "\n".join([
+            '{"url": "https://www.example-1.com", "key": "IMPORT01"}',
+            '{"url": "https://www.example-2.com", "key": "IMPORT02"}',
+            '{"url": "https://www.example-3.com", "key": "IMPORT02"}',
+        ]))
+        stdout, stderr = StringIO(), StringIO()
+        call_command("import_links", path, stdout=stdout, stderr=stderr)
+
+        self.assertEqual(ShortenedUrlData.objects.get(key="IMPORT01"), shortened_url_data)
+        self.assertTrue(ShortenedUrlData.objects.filter(key="IMPORT02").exists())
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual((checkpoint.shortened, checkpoint.conflicts, checkpoint.skipped), (1, 2, 0))
+        self.assertIn("2 records not imported, their keys exist already: IMPORT01, ...", stderr.getvalue())
+        self.assertIn("2 with existing keys", stdout.getvalue())
+
+    def test_resume_does_not_duplicate_records_without_keys(self):
+        """
+        Batches are checkpointed in their transaction: a resumed import starts after the last committed batch.
+        """
+        path = self.write("links.jsonl", "\n".join(
+            f'{{"url": "https://www.example-{number}.com", "client_ip": "0.0.0.{number}"}}' for number in range(1, 6)
+        ))
+        save = ImportCheckpoint.save
+
+        def crashing_save(checkpoint, *args, **kwargs):
+            # The import crashes once its second batch is merged, before it is checkpointed.
+            if checkpoint.records == 4:
+                raise DatabaseError
+            save(checkpoint, *args, **kwargs)
+
+        with patch.object(ImportCheckpoint, "save", crashing_save), self.assertRaises(DatabaseError):
+            call_command("import_links", path, batch_size=2, stdout=StringIO())
+        self.assertEqual(ShortenedUrlData.objects.count(), 2)
+        self.assertEqual(ImportCheckpoint.objects.get().records, 2)
+
+        call_command("import_links", path, batch_size=2, stdout=StringIO())
+        self.assertEqual(ShortenedUrlData.objects.count(), 5)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 5)
+
+
+class RequestPartitionsTest(TestCase):
+    """
+    Test maintenance of shortening request partitions.
+    """
+
+    def setUp(self):
+        self.request = UrlShorteningRequestFactory()
+
+    def partition_of(self, request):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM url_shortening_request WHERE id = %s", [request.id])
+            return cursor.fetchone()[0]
+
+    def test_create_partitions(self):
+        """
+        Partitions are created ahead; queries of a time range only scan the partitions of that range.
+        """
+        self.assertEqual(self.partition_of(self.request), LEGACY_PARTITION)
+
+        call_command("maintain_request_partitions", months_ahead=12, stdout=StringIO())
+        month = month_start(timezone.now(), 12)
+        UrlShorteningRequest.objects.filter(id=self.request.id).update(created_at=month)
+        self.assertEqual(self.partition_of(self.request), partition_name(month))
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "EXPLAIN SELECT count(*) FROM url_shortening_request WHERE created_at >= %s AND created_at < %s",
+                [month, month_start(month, 1)],
+            )
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.assertIn(partition_name(month), plan)
+        self.assertNotIn(LEGACY_PARTITION, plan)
+
+    def test_create_partitions_without_any(self):
+        """
+        Without any partition, partitions are created from the current month.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")  # Tables with pending trigger events cannot be dropped.
+            for name, _, _ in get_partitions(cursor):
+                detach_partition(cursor, name, concurrently=False)
+                cursor.execute(f"DROP TABLE {name}")
+
+        call_command("maintain_request_partitions", months_ahead=2, stdout=StringIO())
+        with connection.cursor() as cursor:
+            partitions = get_partitions(cursor)
+        self.assertEqual(
+            [lower for _, lower, _ in partitions],
+            [month_start(timezone.now(), months) for months in range(3)],
+        )
+
+    def test_requests_past_partitions(self):
+        """
+        Requests of months without a partition are kept in the default partition,
+        then moved into their partition once it is created.
+        """
+        month = month_start(timezone.now(), 24)
+        UrlShorteningRequest.objects.filter(id=self.request.id).update(created_at=month)
+        self.assertEqual(self.partition_of(self.request), DEFAULT_PARTITION)
+
+        call_command("maintain_request_partitions", months_ahead=24, stdout=StringIO())
+        self.assertEqual(self.partition_of(self.request), partition_name(month))
+        self.assertEqual(UrlShorteningRequest.objects.count(), 1)
+
+    def test_too_few_months_ahead(self):
+        with self.assertRaises(CommandError):
+            call_command("maintain_request_partitions", months_ahead=1, stdout=StringIO())
+
+    def test_retention(self):
+        """
+        Partitions older than the retention are dropped along with their requests, or only detached.
+        """
+        later = month_start(timezone.now(), 24)
+        with patch("shortening.management.commands.maintain_request_partitions.timezone.now", return_value=later):
+            call_command("maintain_request_partitions", retention_months=12, detach_only=True, stdout=StringIO())
+            with connection.cursor() as cursor:
+                partitions = get_partitions(cursor)
+            self.assertEqual(partitions[0][1], month_start(later, -12))
+            self.assertEqual(UrlShorteningRequest.objects.count(), 0)
+            self.assertIn(LEGACY_PARTITION, connection.introspection.table_names())
+
+            call_command("maintain_request_partitions", retention_months=6, stdout=StringIO())
+            with connection.cursor() as cursor:
+                partitions = get_partitions(cursor)
+            self.assertEqual(partitions[0][1], month_start(later, -6))
+            self.assertNotIn(partition_name(month_start(later, -7)), connection.introspection.table_names())
+
+
+class RollupsTest(TestCase):
+    """
+    Test incremental rollups of shortening requests.
+    """
+
+    def setUp(self):
+        self.shortened_url_data = ShortenedUrlDataFactory()
+        self.example = self.shortened_url_data.original_url_data
+        self.john = ClientDataFactory(client_ip="0.0.0.1")
+        self.alice = ClientDataFactory(client_ip="0.0.0.2")
+        self.now = datetime(2022, 10, 5, 1, tzinfo=dt_timezone.utc)
+
+    def add_request(self, client_data, hour, minute, written_at=None, **fields):
+        request = UrlShorteningRequest.objects.create(
+            client_data=client_data, original_url_data=self.example, shortened_url_data=self.shortened_url_data,
+            **fields,
+        )
+        created_at = datetime(2022, 10, 4, hour, minute, tzinfo=dt_timezone.utc)
+        UrlShorteningRequest.objects.filter(id=request.id).update(
+            created_at=created_at, updated_at=written_at or created_at,
+        )
+        return request.id
+
+    def update_rollups(self):
+        with patch("shortening.management.commands.update_rollups.timezone.now", return_value=self.now):
+            call_command("update_rollups", stdout=StringIO())
+
+    def rollups(self, rollup):
+        return list(rollup.objects.order_by("bucket").values_list("bucket__hour", "requests", "unique_clients"))
+
+    def test_rollups(self):
+        """
+        John shortens the url twice at 9h and once at 10h, Alice once at 9h, then once at 10h, written late.
+        """
+        self.add_request(self.john, 9, 10)
+        self.add_request(self.john, 9, 20)
+        self.add_request(self.alice, 9, 30)
+        self.add_request(self.john, 10, 5)
+        self.update_rollups()
+
+        self.assertEqual(self.rollups(HourlyUrlShorteningRollup), [(9, 3, 2), (10, 1, 1)])
+        self.assertEqual(self.rollups(DailyUrlShorteningRollup), [(0, 4, 2)])
+        self.assertEqual(
+            RollupWatermark.objects.get(granularity="hour").closed_until,
+            datetime(2022, 10, 5, 0, tzinfo=dt_timezone.utc),
+        )
+
+        self.add_request(self.alice, 10, 30)
+        self.update_rollups()
+        self.assertEqual(self.rollups(HourlyUrlShorteningRollup), [(9, 3, 2), (10, 2, 2)])
+        self.assertEqual(self.rollups(DailyUrlShorteningRollup), [(0, 5, 2)])
+
+    def test_lower_id_committed_late(self):
+        """
+        Alice's request gets an id before John's second one, written just now, but is committed after the rollups.
+        """
+        self.add_request(self.john, 9, 10)
+        alice_request_id = self.add_request(self.alice, 9, 20)
+        UrlShorteningRequest.objects.filter(id=alice_request_id).delete()  # Not committed yet.
+        self.add_request(self.john, 9, 30, written_at=self.now)
+        self.update_rollups()
+        self.assertEqual(self.rollups(HourlyUrlShorteningRollup), [(9, 2, 1)])
+
+        self.add_request(self.alice, 9, 20, written_at=self.now, id=alice_request_id)
+        self.update_rollups()
+        self.assertEqual(self.rollups(HourlyUrlShorteningRollup), [(9, 3, 2)])
+        self.assertEqual(self.rollups(DailyUrlShorteningRollup), [(0, 3, 2)])
+
+
+class AuditRecordBufferTest(TestCase):
+    """
+    Test write-behind buffering of audit records.
+    """
+
+    def setUp(self):
+        self.buffer = AuditRecordBuffer(
+            max_size=2, flush_size=10, flush_interval=60, enqueue_timeout=0, background=False,
+        )
+        self.shortened_url_data = ShortenedUrlDataFactory()
+        self.original_url_data = self.shortened_url_data.original_url_data
+        self.john = ClientDataFactory(client_ip="0.0.0.1")
+        self.alice = ClientDataFactory(client_ip="0.0.0.2")
+
+    def test_flush_counts_unique_ips(self):
+        """
+        John's request is written and counted once, even when buffered twice or written again later.
+        """
+        self.buffer.put(self.john.id, self.original_url_data.id, self.shortened_url_data.id)
+        self.buffer.put(self.john.id, self.original_url_data.id, self.shortened_url_data.id)
+        self.assertEqual(UrlShorteningRequest.objects.count(), 0)
+        self.assertEqual(self.buffer.stats()["queue_depth"], 2)
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.buffer.put(self.john.id, self.original_url_data.id, self.shortened_url_data.id)
+        self.buffer.put(self.alice.id, self.original_url_data.id, self.shortened_url_data.id)
+        self.buffer.flush()
+
+        self.assertEqual(UrlShorteningRequest.objects.count(), 4)
+        self.original_url_data.refresh_from_db()
+        self.assertEqual(self.original_url_data.unique_ip_hits, 2)
+        self.assertEqual(UniqueIpHitsCounter.total(), 2)
+        self.assertEqual(self.buffer.stats()["written"], 4)
+
+    def test_full_queue_writes_synchronously(self):
+        """
+        Records not fitting into the queue are written at once rather than dropped.
+        """
+        for client_data in (self.john, self.alice, self.john):
+            self.buffer.put(client_data.id, self.original_url_data.id, self.shortened_url_data.id)
+
+        self.assertEqual(UrlShorteningRequest.objects.count(), 1)
+        stats = self.buffer.stats()
+        self.assertEqual(stats["synchronous_writes"], 1)
+        self.assertEqual(stats["dropped"], 0)
+
+    def test_metrics(self):
+        """
+        Buffer counters are exported as metrics.
+        """
+        with patch("shortening.utils.write_behind_utils.audit_record_buffer", self.buffer):
+            for client_data in (self.john, self.alice, self.john):
+                self.buffer.put(client_data.id, self.original_url_data.id, self.shortened_url_data.id)
+            self.assertEqual(registry.get_sample_value("url_shortener_audit_queue_depth"), 2)
+            self.buffer.flush()
+
+            self.assertEqual(registry.get_sample_value("url_shortener_audit_records_total", {"outcome": "written"}), 2)
+            self.assertEqual(
+                registry.get_sample_value("url_shortener_audit_records_total", {"outcome": "synchronous_write"}), 1,
+            )
+            self.assertEqual(registry.get_sample_value("url_shortener_audit_queue_depth"), 0)
+            self.assertEqual(
+                registry.get_sample_value("url_shortener_write_behind_flushes_total", {"buffer": "audit_records"}), 1,
+            )
+
+    def test_closed_at_exit_once(self):
+        """
+        Restarting the flusher thread (e.g. after a fork) does not register another exit handler.
+        """
+        buffer = AuditRecordBuffer(max_size=10, flush_size=10, flush_interval=60, enqueue_timeout=0)
+        with patch("shortening.utils.write_behind_utils.atexit.register") as register_mock, \
+                patch("shortening.utils.write_behind_utils.threading.Thread"):
+            buffer.notify()
+            buffer._thread.is_alive.return_value = False
+            buffer.notify()
+        self.assertEqual(buffer._thread.start.call_count, 2)
+        register_mock.assert_called_once_with(buffer.close)
+
+
+class ClickCounterTest(TestCase):
+    """
+    Test buffered counting of redirects.
+    """
+
+    def setUp(self):
+        self.counter = ClickCounter(flush_size=10, flush_interval=60, background=False)
+        self.shortened_url_data = ShortenedUrlDataFactory(key="CLICKS01")
+
+    def test_flush(self):
+        """
+        Clicks are written on flush only, all at once.
+        """
+        for _ in range(3):
+            self.counter.add("CLICKS01")
+        self.counter.add("NONEXIST")
+        self.shortened_url_data.refresh_from_db()
+        self.assertEqual(self.shortened_url_data.clicks, 0)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.counter.flush(), 4)
+        self.shortened_url_data.refresh_from_db()
+        self.assertEqual(self.shortened_url_data.clicks, 3)
+        self.assertEqual(self.counter.stats()["pending_clicks"], 0)
+
+    def test_failed_flush_keeps_counts(self):
+        """
+        Counts of a failed flush are written by the next one.
+        """
+        self.counter.add("CLICKS01")
+        with patch.object(connection, "cursor", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.counter.flush()
+        self.counter.add("CLICKS01")
+
+        self.assertEqual(self.counter.flush(), 2)
+        self.shortened_url_data.refresh_from_db()
+        self.assertEqual(self.shortened_url_data.clicks, 2)
+
+    def test_metrics(self):
+        with patch("shortening.utils.write_behind_utils.click_counter", self.counter):
+            for _ in range(3):
+                self.counter.add("CLICKS01")
+            self.assertEqual(registry.get_sample_value("url_shortener_clicks_pending"), 3)
+            self.counter.flush()
+
+            self.assertEqual(registry.get_sample_value("url_shortener_clicks_total", {"outcome": "written"}), 3)
+            self.assertEqual(registry.get_sample_value("url_shortener_clicks_pending"), 0)
+            self.assertEqual(
+                registry.get_sample_value("url_shortener_write_behind_flushes_total", {"buffer": "clicks"}), 1,
+            )
+
+
+class RunBenchmarksCommandTest(TestCase):
+    """
+    Test the benchmark suite writes results, within query budgets, and flags regressions.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.directory.name, "results.json")
+        self.baseline = os.path.join(self.directory.name, "baseline.json")
+        self.options = {
+            "urls": 20,
+            "micro_iterations": 2,
+            "view_iterations": 2,
+            "rounds": 1,
+            "output": self.output,
+            "baseline": self.baseline,
+            "stdout": StringIO(),
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_results_within_budgets(self):
+        call_command("run_benchmarks", save_baseline=True, **self.options)
+
+        with open(self.output) as output:
+            results = json.load(output)["results"]
+        for name, budget in QUERY_BUDGETS.items():
+            self.assertLessEqual(results[name]["queries"], budget)
+            self.assertLessEqual(results[name]["max_queries"], budget + sum(QUERY_ALLOWANCES.get(name, {}).values()))
+        self.assertIn("create_random_key", results)
+        self.assertTrue(os.path.exists(self.baseline))
+
+    def test_occasional_extra_queries_flagged(self):
+        """
+        Requests over the budget fail the run even when they are few, unless a known path allows for them.
+        """
+        # Every other key allocation reserves a block: queries of the timed requests are 1 and 3.
+        with patch.object(key_allocator, "block_size", 2), patch.object(key_allocator, "_keys", []):
+            call_command("run_benchmarks", **self.options)
+            with patch.dict(QUERY_ALLOWANCES, clear=True), self.assertRaisesMessage(
+                CommandError, "shorten_url ran up to 3 queries, over its budget of 1.",
+            ):
+                call_command("run_benchmarks", **self.options)
+
+    def test_regressions_flagged(self):
+        call_command("run_benchmarks", save_baseline=True, **self.options)
+        with open(self.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        baseline["results"]["fetch_content"]["queries"] = 0
+        with open(self.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file)
+
+        with self.assertRaisesMessage(CommandError, "fetch_content runs 1 queries, baseline 0."):
+            call_command("run_benchmarks", **self.options)
@@ -0,0 +1,118 @@
+"""
+Database routers of the URL Shortener project.
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Whether reads of the current request (or task) may be served by a replica.
+# Off by default: only read-only views opt in, see `api.mixins.ReplicaReadsMixin`.
+_replica_reads = ContextVar("replica_reads", default=False)
+
+# Seconds a replica is behind the primary; zero when it replayed everything it received.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+@contextmanager
+def replica_reads(enabled: bool = True):
+    """
+    Allow (or forbid) reads within the block to be served by a replica.
+    """
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_reads_enabled() -> bool:
+    """
+    Whether reads may currently be served by a replica.
+    """
+    return bool(settings.DATABASE_REPLICAS) and _replica_reads.get()
+
+
+class ReplicaRouter:
+    """
+    Route reads to replicas where allowed (see `replica_reads`), everything else to the primary.
+
+    Replicas are selected either round-robin or by least replication lag;
+    replicas lagging more than `max_lag` seconds (or unreachable) are skipped,
+    falling back to the primary if none is left.
+    """
+
+    def __init__(
+        self,
+        replicas=None,
+        selection: str = None,
+        max_lag: float = None,
+        lag_check_interval: float = None,
+    ):
+        self.replicas = list(settings.DATABASE_REPLICAS if replicas is None else replicas)
+        self.selection = selection or settings.DB_REPLICA_SELECTION
+        self.max_lag = settings.DB_REPLICA_MAX_LAG if max_lag is None else max_lag
+        self.lag_check_interval = (
+            settings.DB_REPLICA_LAG_CHECK_INTERVAL if lag_check_interval is None else lag_check_interval
+        )
+        self._round_robin = itertools.cycle(self.replicas)
+        self._lags = {}
+        self._lags_checked_at = None
+        self._lock = threading.Lock()
+
+    def db_for_read(self, model, **hints):
+        if self.replicas and _replica_reads.get():
+            return self.select_replica()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+    def select_replica(self) -> str:
+        if self.selection == "least_lag":
+            lags = self.get_lags()
+            healthy = [alias for alias in self.replicas if lags.get(alias, self.max_lag + 1) <= self.max_lag]
+            if not healthy:
+                return DEFAULT_DB_ALIAS
+            return min(healthy, key=lags.get)
+        with self._lock:
+            return next(self._round_robin)
+
+    def get_lags(self) -> dict:
+        """
+        Replication lag of each reachable replica, in seconds, checked at most every `lag_check_interval`.
+        """
+        with self._lock:
+            if self._lags_checked_at is None or time.monotonic() - self._lags_checked_at >= self.lag_check_interval:
+                self._lags = {}
+                for alias in self.replicas:
+                    lag = self.check_lag(alias)
+                    if lag is not None:
+                        self._lags[alias] = lag
+                self._lags_checked_at = time.monotonic()
+            return self._lags
+
+    @staticmethod
+    def check_lag(alias: str):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                return float(cursor.fetchone()[0])
+        except DatabaseError:
+            return None
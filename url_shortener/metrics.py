@@ -0,0 +1,471 @@
+"""
+Prometheus metrics of the URL Shortener, aggregated across worker processes.
+
+Each process keeps its values in its own memory-mapped file of the `METRICS_DIR` directory:
+
+    header: bytes used | entries: key length, key (JSON, padded to 8 bytes), value (double)
+
+Only the owner process writes its file; whichever worker serves `/metrics` reads all of them and sums
+values up. Counters and histograms of exited processes are kept (totals never decrease): on collection,
+they are merged into an archive file and the files of exited processes are removed, so the directory
+does not grow with worker restarts. Gauges only count for live processes.
+Without `METRICS_DIR`, each process reports its own values only.
+
+Counters kept by components themselves (e.g. cache hits) are published by collectors,
+run in each process at most every `COLLECTORS_INTERVAL` seconds while it serves requests,
+and in the process serving `/metrics` on collection.
+"""
+
+import bisect
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+HEADER_FORMAT = struct.Struct("<Q")
+KEY_LENGTH_FORMAT = struct.Struct("<I")
+VALUE_FORMAT = struct.Struct("<d")
+
+INITIAL_FILE_SIZE = 2 ** 16
+
+FILE_SUFFIX = ".metrics"
+
+# Values of exited processes, and markers of the files merged into it (removed right after).
+ARCHIVE_FILE_NAME = f"archive{FILE_SUFFIX}"
+MERGED_KIND = "merged"
+
+# Held by collections, so that a file is never merged twice or read along with its merged values.
+LOCK_FILE_NAME = ".lock"
+
+# Seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COLLECTORS_INTERVAL = 1.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+def padded(length: int) -> int:
+    return (length + 7) // 8 * 8
+
+
+class ValuesFile:
+    """
+    Values of a process in a memory-mapped file, by key.
+
+    Entries are appended (growing the file as needed), then the header is updated,
+    so that readers never see incomplete entries; values are updated in place.
+    """
+
+    def __init__(self, path: str):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = INITIAL_FILE_SIZE
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        if HEADER_FORMAT.unpack_from(self._mmap)[0] == 0:
+            HEADER_FORMAT.pack_into(self._mmap, 0, HEADER_FORMAT.size)
+        self._offsets = {key: offset for key, _, offset in self.entries(self._mmap)}
+
+    @staticmethod
+    def entries(data):
+        """
+        (key, value, value offset) of the entries of file data.
+        """
+        used = min(HEADER_FORMAT.unpack_from(data)[0], len(data))
+        position = HEADER_FORMAT.size
+        while position < used:
+            key_length = KEY_LENGTH_FORMAT.unpack_from(data, position)[0]
+            key_start = position + KEY_LENGTH_FORMAT.size
+            value_offset = position + padded(KEY_LENGTH_FORMAT.size + key_length)
+            key = bytes(data[key_start:key_start + key_length]).decode()
+            yield key, VALUE_FORMAT.unpack_from(data, value_offset)[0], value_offset
+            position = value_offset + VALUE_FORMAT.size
+
+    @classmethod
+    def read(cls, path: str) -> dict:
+        with open(path, "rb") as file:
+            data = file.read()
+        return {key: value for key, value, _ in cls.entries(data)} if data else {}
+
+    @staticmethod
+    def write(path: str, values: dict):
+        """
+        Write values into a new file, atomically replacing the file at the path (not to be mapped by owners).
+        """
+        data = bytearray(HEADER_FORMAT.size)
+        for key, value in values.items():
+            encoded = key.encode()
+            entry = KEY_LENGTH_FORMAT.pack(len(encoded)) + encoded
+            data += entry.ljust(padded(len(entry)), b"\0") + VALUE_FORMAT.pack(value)
+        HEADER_FORMAT.pack_into(data, 0, len(data))
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+    def get(self, key: str) -> float:
+        offset = self._offsets.get(key)
+        return VALUE_FORMAT.unpack_from(self._mmap, offset)[0] if offset is not None else 0.0
+
+    def set(self, key: str, value: float):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        VALUE_FORMAT.pack_into(self._mmap, offset, value)
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def _append(self, key: str) -> int:
+        encoded = key.encode()
+        used = HEADER_FORMAT.unpack_from(self._mmap)[0]
+        value_offset = used + padded(KEY_LENGTH_FORMAT.size + len(encoded))
+        end = value_offset + VALUE_FORMAT.size
+        if end > len(self._mmap):
+            size = len(self._mmap)
+            while size < end:
+                size *= 2
+            os.ftruncate(self._fd, size)
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._fd, size)
+        KEY_LENGTH_FORMAT.pack_into(self._mmap, used, len(encoded))
+        self._mmap[used + KEY_LENGTH_FORMAT.size:used + KEY_LENGTH_FORMAT.size + len(encoded)] = encoded
+        VALUE_FORMAT.pack_into(self._mmap, value_offset, 0.0)
+        HEADER_FORMAT.pack_into(self._mmap, 0, end)
+        self._offsets[key] = value_offset
+        return value_offset
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sample_key(kind: str, name: str, labels: dict) -> str:
+    return json.dumps([kind, name, labels], sort_keys=True)
+
+
+class MetricsRegistry:
+    """
+    Metrics of the application, and their values in this process (or in a metrics directory).
+    """
+
+    def __init__(self, directory: str = ""):
+        self.directory = directory
+        self.metrics = []
+        self.collectors = []
+        # Keys of samples, by kind, name and labels: encoding them takes longer than updating values.
+        self._keys = {}
+        self._values = {}
+        # Counter values of a previous process with the same pid, which `set` values add to.
+        self._bases = {}
+        self._file = None
+        self._pid = None
+        self._collected_at = None
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, name: str, labels: dict, amount: float):
+        key = self._key(kind, name, labels)
+        with self._lock:
+            if not self.directory:
+                self._values[key] = self._values.get(key, 0.0) + amount
+                return
+            values = self._own_file()
+            values.set(key, values.get(key) + amount)
+
+    def set(self, kind: str, name: str, labels: dict, value: float):
+        """
+        Set the value of this process, e.g. a total counted by a component itself.
+        """
+        key = self._key(kind, name, labels)
+        with self._lock:
+            if not self.directory:
+                self._values[key] = value
+                return
+            values = self._own_file()
+            values.set(key, self._bases.get(key, 0.0) + value)
+
+    def collector(self, function):
+        """
+        Register a function publishing values of this process (with `set`), see `run_collectors`.
+        """
+        self.collectors.append(function)
+        return function
+
+    def run_collectors(self, interval: float = 0):
+        """
+        Run the collectors, unless they ran less than `interval` seconds ago.
+        """
+        now = time.monotonic()
+        if self._collected_at is not None and now - self._collected_at < interval:
+            return
+        self._collected_at = now
+        for function in self.collectors:
+            try:
+                function()
+            except Exception:  # NOQA: metrics must not fail requests
+                logger.exception("Metrics collector %s failed.", function.__name__)
+
+    def _key(self, kind: str, name: str, labels: dict) -> str:
+        cache_key = (kind, name, *labels.items())
+        key = self._keys.get(cache_key)
+        if key is None:
+            key = self._keys[cache_key] = sample_key(kind, name, labels)
+        return key
+
+    def _own_file(self) -> ValuesFile:
+        # (Re)opened after forks, e.g. of gunicorn workers from a preloaded master.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._file = ValuesFile(os.path.join(self.directory, f"{pid}{FILE_SUFFIX}"))
+            self._pid = pid
+            self._bases = {}
+            # A previous process with the same pid is not in flight anymore.
+            for key in list(self._file.keys()):
+                if json.loads(key)[0] == Gauge.kind:
+                    self._file.set(key, 0.0)
+                else:
+                    self._bases[key] = self._file.get(key)
+        return self._file
+
+    def collect(self) -> dict:
+        """
+        Values by key, summed up across processes (after running the collectors of this one).
+        """
+        self.run_collectors()
+        if not self.directory:
+            with self._lock:
+                return dict(self._values)
+
+        with open(os.path.join(self.directory, LOCK_FILE_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when closed.
+            files = self._compact()
+            totals = defaultdict(float)
+            for file_name, alive in files.items():
+                for key, value in ValuesFile.read(os.path.join(self.directory, file_name)).items():
+                    kind = json.loads(key)[0]
+                    if kind != MERGED_KIND and (alive or kind != Gauge.kind):
+                        totals[key] += value
+        return totals
+
+    def _compact(self) -> dict:
+        """
+        Merge counters and histograms of exited processes into the archive file, and remove their files.
+
+        Return the names of the files left, telling whether their process is alive.
+        """
+        files = {}
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(FILE_SUFFIX) and file_name != ARCHIVE_FILE_NAME:
+                files[file_name] = process_alive(int(file_name[:-len(FILE_SUFFIX)]))
+        exited = [file_name for file_name, alive in files.items() if not alive]
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE_NAME)
+        if not exited:
+            return {**files, ARCHIVE_FILE_NAME: False} if os.path.exists(archive_path) else files
+
+        archive = ValuesFile.read(archive_path) if os.path.exists(archive_path) else {}
+        # Markers of files removed since they were merged are dropped; files merged already
+        # (if removing them failed) are not merged again.
+        archive = {
+            key: value for key, value in archive.items()
+            if json.loads(key)[0] != MERGED_KIND or json.loads(key)[1] in files
+        }
+        for file_name in exited:
+            marker = sample_key(MERGED_KIND, file_name, {})
+            if marker in archive:
+                continue
+            for key, value in ValuesFile.read(os.path.join(self.directory, file_name)).items():
+                if json.loads(key)[0] != Gauge.kind:
+                    archive[key] = archive.get(key, 0.0) + value
+            archive[marker] = 1.0
+        ValuesFile.write(archive_path, archive)
+
+        for file_name in exited:
+            os.unlink(os.path.join(self.directory, file_name))
+            del files[file_name]
+        return {**files, ARCHIVE_FILE_NAME: False}
+
+    def get_sample_value(self, name: str, labels: dict = None) -> float:
+        """
+        Value of a sample, e.g. `url_shortener_requests_total` or `<histogram>_count`, `None` if missing.
+        """
+        labels = labels or {}
+        for key, value in self.collect().items():
+            _, sample_name, sample_labels = json.loads(key)
+            if sample_name == name and sample_labels == labels:
+                return value
+        return None
+
+    def exposition(self) -> str:
+        """
+        Metrics in the Prometheus text format.
+        """
+        samples = defaultdict(list)
+        for key, value in sorted(self.collect().items()):
+            _, name, labels = json.loads(key)
+            samples[name].append((labels, value))
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.sample_lines(samples)
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"'))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, registry: MetricsRegistry, name: str, documentation: str):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        registry.metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        self.registry.add(self.kind, self.name, labels, amount)
+
+    def set(self, value: float, **labels):
+        """
+        Set the value of this process, for totals counted by a component itself (from a collector).
+        """
+        self.registry.set(self.kind, self.name, labels, value)
+
+    def sample_lines(self, samples: dict) -> list:
+        return [f"{self.name}{format_labels(labels)} {value!r}" for labels, value in samples[self.name]]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.registry.add(self.kind, self.name, labels, -amount)
+
+
+class Histogram(Counter):
+    """
+    Observations counted in buckets (stored per bucket, exposed cumulatively), with their count and sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, registry: MetricsRegistry, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation)
+        self.buckets = tuple(buckets)
+        self._bounds = [repr(bound) for bound in self.buckets]
+        self._sample_names = (f"{name}_bucket", f"{name}_count", f"{name}_sum")
+
+    def observe(self, value: float, **labels):
+        bucket_name, count_name, sum_name = self._sample_names
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.registry.add(self.kind, bucket_name, {**labels, "le": self._bounds[index]}, 1)
+        self.registry.add(self.kind, count_name, labels, 1)
+        self.registry.add(self.kind, sum_name, labels, value)
+
+    def sample_lines(self, samples: dict) -> list:
+        bucket_counts = defaultdict(dict)
+        for labels, value in samples[f"{self.name}_bucket"]:
+            bound = labels.pop("le")
+            bucket_counts[json.dumps(labels, sort_keys=True)][bound] = value
+
+        lines = []
+        sums = {json.dumps(labels, sort_keys=True): value for labels, value in samples[f"{self.name}_sum"]}
+        for labels, count in samples[f"{self.name}_count"]:
+            counts = bucket_counts[json.dumps(labels, sort_keys=True)]
+            cumulative = 0.0
+            for bound in self.buckets:
+                cumulative += counts.get(repr(bound), 0.0)
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': repr(bound)})} {cumulative!r}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {count!r}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count!r}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {sums[json.dumps(labels, sort_keys=True)]!r}")
+        return lines
+
+
+registry = MetricsRegistry(directory=settings.METRICS_DIR)
+
+requests_total = Counter(registry, "url_shortener_requests_total", "Requests by view, method and status code.")
+request_duration_seconds = Histogram(
+    registry, "url_shortener_request_duration_seconds", "Request latency by view, in seconds.",
+)
+requests_in_flight = Gauge(registry, "url_shortener_requests_in_flight", "Requests being served, by view.")
+key_generation_retries_total = Counter(
+    registry, "url_shortener_key_generation_retries_total", "Random keys generated again, being taken already.",
+)
+integrity_errors_total = Counter(
+    registry, "url_shortener_integrity_errors_total", "Database integrity errors handled by API views, by view.",
+)
+keys_issued_total = Counter(registry, "url_shortener_keys_issued_total", "Keys issued from allocated blocks.")
+keys_available = Gauge(registry, "url_shortener_keys_available", "Keys left in the allocated blocks of workers.")
+key_blocks_refilled_total = Counter(
+    registry, "url_shortener_key_blocks_refilled_total", "Key blocks allocated from the database sequence.",
+)
+key_block_refill_seconds_total = Counter(
+    registry, "url_shortener_key_block_refill_seconds_total", "Time spent allocating key blocks, in seconds.",
+)
+key_collisions_skipped_total = Counter(
+    registry, "url_shortener_key_collisions_skipped_total", "Allocated keys skipped, being taken already.",
+)
+key_cache_lookups_total = Counter(
+    registry, "url_shortener_key_cache_lookups_total", "Key resolution cache lookups, by result (hit, miss).",
+)
+key_cache_evictions_total = Counter(
+    registry, "url_shortener_key_cache_evictions_total", "Key resolution cache entries evicted for admitted ones.",
+)
+key_cache_rejections_total = Counter(
+    registry, "url_shortener_key_cache_rejections_total",
+    "Key resolution cache entries not admitted, being requested less often than the least recently used one.",
+)
+key_cache_entries = Gauge(registry, "url_shortener_key_cache_entries", "Key resolution cache entries.")
+write_behind_flushes_total = Counter(
+    registry, "url_shortener_write_behind_flushes_total", "Flushes of write-behind buffers writing data, by buffer.",
+)
+write_behind_flush_seconds_total = Counter(
+    registry, "url_shortener_write_behind_flush_seconds_total",
+    "Time spent in flushes of write-behind buffers writing data, by buffer, in seconds.",
+)
+audit_records_total = Counter(
+    registry, "url_shortener_audit_records_total",
+    "Write-behind audit records, by outcome (enqueued, written, dropped, synchronous_write).",
+)
+audit_queue_depth = Gauge(registry, "url_shortener_audit_queue_depth", "Audit records waiting to be written.")
+clicks_total = Counter(
+    registry, "url_shortener_clicks_total", "Redirects counted per key, by outcome (counted, written).",
+)
+clicks_pending = Gauge(registry, "url_shortener_clicks_pending", "Counted redirects waiting to be written.")
+unique_ip_sketch_clients_total = Counter(
+    registry, "url_shortener_unique_ip_sketch_clients_total", "Clients added to buffered unique-ip sketches.",
+)
+unique_ip_sketch_merges_total = Counter(
+    registry, "url_shortener_unique_ip_sketch_merges_total", "Buffered unique-ip sketches merged into stored ones.",
+)
+unique_ip_sketch_pending_urls = Gauge(
+    registry, "url_shortener_unique_ip_sketch_pending_urls", "Original urls with buffered unique-ip sketches.",
+)
@@ -0,0 +1,269 @@
+"""
+Middleware of the URL Shortener project.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+
+from url_shortener.metrics import (
+    COLLECTORS_INTERVAL,
+    registry,
+    request_duration_seconds,
+    requests_in_flight,
+    requests_total,
+)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# SQL statements logged per slow request, at most.
+SLOW_REQUEST_MAX_STATEMENTS = 50
+
+timing_logger = logging.getLogger("url_shortener.timing")
+
+
+def is_pinned_to_primary(request) -> bool:
+    """
+    Whether the client wrote recently, so its reads must go to the primary.
+    """
+    return settings.READ_YOUR_WRITES_COOKIE_NAME in request.COOKIES
+
+
+def pin_to_primary(request, response):
+    """
+    Pin the client to the primary after a successful write, see `READ_YOUR_WRITES_WINDOW`.
+    """
+    if (
+        settings.DATABASE_REPLICAS
+        and settings.READ_YOUR_WRITES_WINDOW
+        and request.method not in SAFE_METHODS
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            settings.READ_YOUR_WRITES_COOKIE_NAME,
+            "1",
+            max_age=settings.READ_YOUR_WRITES_WINDOW,
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+@sync_and_async_middleware
+def read_your_writes_middleware(get_response):
+    """
+    Pin clients to the primary database for a short window after they write.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            return pin_to_primary(request, await get_response(request))
+    else:
+        def middleware(request):
+            return pin_to_primary(request, get_response(request))
+    return middleware
+
+
+class RequestTimings:
+    """
+    Timings of a request, with its database queries.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.view_started_at = None
+        self.view_ended_at = None
+        self.queries = []  # (sql, seconds)
+
+    def track_query(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper timing queries.
+        """
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started_at))
+
+    def durations(self, ended_at: float) -> dict:
+        """
+        Durations (milliseconds): database, view (database included), rendering and total.
+        """
+        durations = {"db": sum(seconds for _, seconds in self.queries)}
+        if self.view_started_at is not None:
+            durations["view"] = (self.view_ended_at or ended_at) - self.view_started_at
+        if self.view_ended_at is not None:
+            durations["render"] = ended_at - self.view_ended_at
+        durations["total"] = ended_at - self.started_at
+        return {name: seconds * 1000 for name, seconds in durations.items()}
+
+
+def view_name(request) -> str:
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return ""
+    return getattr(match.func, "view_class", match.func).__name__
+
+
+class ServerTimingMiddleware:
+    """
+    Measure database queries and time, view time and serialization (rendering) time of requests,
+    and report them as a `Server-Timing` header and a JSON log line (logger `url_shortener.timing`).
+
+    Requests are reported with the sample rate of their view; requests slower than
+    `SERVER_TIMING_SLOW_REQUEST_THRESHOLD` are always reported, with their SQL statements.
+
+    A class rather than a function, for the view hooks; sync and async capable, like Django's
+    `MiddlewareMixin`. Not used at all unless `SERVER_TIMING_ENABLED`.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.SERVER_TIMING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Makes Django await calls, see `MiddlewareMixin._async_check`.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        with self.track_queries(request):
+            response = self.get_response(request)
+        return self.report(request, response)
+
+    async def __acall__(self, request):
+        # Database connections are per thread: queries of an async request (sync views and the async ORM alike)
+        # run in its thread-sensitive thread, so they are tracked from there.
+        tracking = await sync_to_async(self.track_queries)(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(tracking.close)()
+        return self.report(request, response)
+
+    @staticmethod
+    def track_queries(request) -> ExitStack:
+        """
+        Start timing the request, and its queries on all database connections of the current thread.
+        """
+        request.timings = timings = RequestTimings()
+        tracking = ExitStack()
+        for connection in connections.all():
+            tracking.enter_context(connection.execute_wrapper(timings.track_query))
+        return tracking
+
+    @staticmethod
+    def report(request, response):
+        """
+        Report timings of the request, if sampled or slow.
+        """
+        timings = request.timings
+        durations = timings.durations(time.perf_counter())
+
+        view = view_name(request)
+        slow = (
+            settings.SERVER_TIMING_SLOW_REQUEST_THRESHOLD
+            and durations["total"] >= settings.SERVER_TIMING_SLOW_REQUEST_THRESHOLD * 1000
+        )
+        sample_rate = settings.SERVER_TIMING_VIEW_SAMPLE_RATES.get(view, settings.SERVER_TIMING_SAMPLE_RATE)
+        if not slow and random.random() >= sample_rate:
+            return response
+
+        response["Server-Timing"] = ", ".join(
+            f'db;dur={durations["db"]:.1f};desc="{len(timings.queries)} queries"' if name == "db"
+            else f"{name};dur={duration:.1f}"
+            for name, duration in durations.items()
+        )
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "view": view,
+            "status": response.status_code,
+            "queries": len(timings.queries),
+            **{f"{name}_ms": round(duration, 2) for name, duration in durations.items()},
+        }
+        if slow:
+            record["sql"] = [
+                {"sql": sql, "ms": round(seconds * 1000, 2)}
+                for sql, seconds in timings.queries[:SLOW_REQUEST_MAX_STATEMENTS]
+            ]
+            timing_logger.warning(json.dumps(record))
+        else:
+            timing_logger.info(json.dumps(record))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.timings.view_started_at = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # Called once the view returned a response to render (e.g. a DRF `Response`), before rendering.
+        request.timings.view_ended_at = time.perf_counter()
+        return response
+
+
+def resolve_view_name(request) -> str:
+    """
+    Name of the view of a request, "none" if no view.
+
+    Resolved ahead of the view, to label requests in flight. The redirect fast path reuses
+    the match set on the request, but Django resolves the url again for requests reaching
+    a view: metrics cost an extra resolution (some 25 µs with the few url patterns of the project).
+    """
+    try:
+        request.resolver_match = resolve(request.path_info)
+    except Resolver404:
+        return "none"
+    return view_name(request)
+
+
+def record_request(request, view: str, response, started_at: float):
+    request_duration_seconds.observe(time.perf_counter() - started_at, view=view)
+    requests_total.inc(view=view, method=request.method, status=str(response.status_code))
+    registry.run_collectors(COLLECTORS_INTERVAL)
+    return response
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Count requests by view and status code, and measure their latency and concurrency (see `/metrics`);
+    publish counters of components of this process every `COLLECTORS_INTERVAL` seconds.
+
+    Not used at all unless `METRICS_ENABLED`.
+    """
+    if not settings.METRICS_ENABLED:
+        raise MiddlewareNotUsed
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            view = resolve_view_name(request)
+            started_at = time.perf_counter()
+            requests_in_flight.inc(view=view)
+            try:
+                response = await get_response(request)
+            finally:
+                requests_in_flight.dec(view=view)
+            return record_request(request, view, response, started_at)
+    else:
+        def middleware(request):
+            view = resolve_view_name(request)
+            started_at = time.perf_counter()
+            requests_in_flight.inc(view=view)
+            try:
+                response = get_response(request)
+            finally:
+                requests_in_flight.dec(view=view)
+            return record_request(request, view, response, started_at)
+    return middleware
@@ -13,6 +13,8 @@ import os
 from os import getenv
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -33,13 +35,146 @@ ALLOWED_HOSTS = getenv("DJANGO_ALLOWED_HOSTS", "*").split(" ")
 SCHEME = getenv("API_SCHEME", "http")
 NETLOC = getenv("API_NETLOC", "0.0.0.0:8000")
 
+# Shortened url keys allocation strategy:
+# - 'block': collision-free keys issued from per-worker blocks of a database sequence;
+# - 'random': random keys, checked for uniqueness one by one.
+KEY_ALLOCATION_STRATEGY = getenv("KEY_ALLOCATION_STRATEGY", "block")
+KEY_ALLOCATION_BLOCK_SIZE = int(getenv("KEY_ALLOCATION_BLOCK_SIZE", "1000"))
+# SECURITY WARNING: changing the secret (or the secret key) changes the order keys are issued in.
+KEY_PERMUTATION_SECRET = getenv("KEY_PERMUTATION_SECRET", SECRET_KEY)
+
+# Redirects of shortened urls: status code (301, 302, 307 or 308) and how long browsers and CDNs
+# may cache them (0 to let them decide). NOTE: redirects served from caches are not counted as clicks.
+REDIRECT_STATUS_CODE = int(getenv("REDIRECT_STATUS_CODE", "302"))
+if REDIRECT_STATUS_CODE not in (301, 302, 307, 308):
+    raise ImproperlyConfigured(f"REDIRECT_STATUS_CODE must be 301, 302, 307 or 308, not {REDIRECT_STATUS_CODE}.")
+REDIRECT_CACHE_MAX_AGE = int(getenv("REDIRECT_CACHE_MAX_AGE", "0"))  # seconds
+
+# Serve redirects of shortened urls from an early middleware, without DRF and the rest of the middleware
+# (see `api.middleware`), instead of `FetchContentView`. Opt-in: "true" to enable it.
+REDIRECT_FAST_PATH_ENABLED = getenv("REDIRECT_FAST_PATH_ENABLED") == "true"
+
+# Stats endpoints (`/shortened_urls_count/`, `/most_popular_urls/`) are computed at most once per
+# this many seconds per worker, and may be cached as long by clients; 0 to compute them on every request.
+# Clients pinned to the primary (see 'READ_YOUR_WRITES_WINDOW') bypass the cache, but a response
+# cached by a client before its write may still be reused by it for up to this long.
+STATS_CACHE_TTL = float(getenv("STATS_CACHE_TTL", "5"))  # seconds
+
+# Serve read-only endpoints (redirects and stats) with native async views;
+# enable it when running under ASGI, e.g. with uvicorn workers (see README).
+ASYNC_VIEWS_ENABLED = getenv("ASYNC_VIEWS_ENABLED") == "true"
+
+# Write-behind mode of `UrlShorteningRequest` audit records: records are queued per worker
+# and written in batches by a background thread, every flush interval or flush size records.
+AUDIT_WRITE_BEHIND_ENABLED = getenv("AUDIT_WRITE_BEHIND_ENABLED") == "true"
+AUDIT_WRITE_BEHIND_QUEUE_SIZE = int(getenv("AUDIT_WRITE_BEHIND_QUEUE_SIZE", "10000"))
+AUDIT_WRITE_BEHIND_FLUSH_SIZE = int(getenv("AUDIT_WRITE_BEHIND_FLUSH_SIZE", "500"))
+AUDIT_WRITE_BEHIND_FLUSH_INTERVAL = float(getenv("AUDIT_WRITE_BEHIND_FLUSH_INTERVAL", "1"))  # seconds
+# How long a request waits for room in a full queue before writing its record synchronously.
+AUDIT_WRITE_BEHIND_ENQUEUE_TIMEOUT = float(getenv("AUDIT_WRITE_BEHIND_ENQUEUE_TIMEOUT", "0.5"))  # seconds
+
+# Counting of redirects (clicks) per shortened url key: clicks are counted in memory per worker
+# and added to the database in batches by a background thread, every flush interval or flush size clicks.
+CLICK_COUNTING_ENABLED = getenv("CLICK_COUNTING_ENABLED") == "true"
+CLICK_COUNTING_FLUSH_SIZE = int(getenv("CLICK_COUNTING_FLUSH_SIZE", "1000"))
+CLICK_COUNTING_FLUSH_INTERVAL = float(getenv("CLICK_COUNTING_FLUSH_INTERVAL", "5"))  # seconds
+
+# Unique-ip counting of original urls: 'exact' records every (url, client) pair,
+# 'approximate' keeps a HyperLogLog sketch per url, with the given standard error.
+UNIQUE_IP_COUNTING_MODE = getenv("UNIQUE_IP_COUNTING_MODE", "exact")
+UNIQUE_IP_SKETCH_ERROR_RATE = float(getenv("UNIQUE_IP_SKETCH_ERROR_RATE", "0.02"))
+# Sketches are built per worker, and merged into the stored ones every interval or once enough urls are buffered.
+UNIQUE_IP_SKETCH_FLUSH_SIZE = int(getenv("UNIQUE_IP_SKETCH_FLUSH_SIZE", "1000"))  # urls
+UNIQUE_IP_SKETCH_FLUSH_INTERVAL = float(getenv("UNIQUE_IP_SKETCH_FLUSH_INTERVAL", "1"))  # seconds
+
+# Number of rows the global unique-ip hits counter is split across, to spread concurrent increments.
+UNIQUE_IP_HITS_COUNTER_SHARDS = int(getenv("UNIQUE_IP_HITS_COUNTER_SHARDS", "16"))
+
+# `url_shortening_request` is partitioned by month of `created_at` (see `manage.py maintain_request_partitions`):
+# partitions are created this many months ahead (at least 2; requests of later months go to a default partition),
+# and dropped once older than the retention.
+# Set 'REQUEST_RETENTION_MONTHS=0' to keep all requests.
+REQUEST_PARTITIONS_MONTHS_AHEAD = int(getenv("REQUEST_PARTITIONS_MONTHS_AHEAD", "3"))
+REQUEST_RETENTION_MONTHS = int(getenv("REQUEST_RETENTION_MONTHS", "0"))
+
+# Hourly and daily rollups of shortening requests (see `manage.py update_rollups`) cover buckets
+# which ended this long ago, leaving time for requests in flight to be written. Requests written
+# less than this long ago are scanned again by the next run, as ones with lower ids may be committed after them.
+ROLLUPS_LAG = float(getenv("ROLLUPS_LAG", "60"))  # seconds
+# Max number of buckets per `/stats/timeseries/` request.
+STATS_TIMESERIES_MAX_BUCKETS = int(getenv("STATS_TIMESERIES_MAX_BUCKETS", "1000"))
+
+# Max 'limit' query parameter of `/most_popular_urls/`.
+MOST_POPULAR_URLS_MAX_LIMIT = int(getenv("MOST_POPULAR_URLS_MAX_LIMIT", "100"))
+
+# Max number of urls per `/shorten_urls/bulk/` request.
+BULK_SHORTEN_MAX_URLS = int(getenv("BULK_SHORTEN_MAX_URLS", "10000"))
+
+# In-process cache of shortened url key -> original url (per worker).
+# Set 'KEY_CACHE_MAX_SIZE=0' to disable the cache.
+KEY_CACHE_MAX_SIZE = int(getenv("KEY_CACHE_MAX_SIZE", "10000"))
+KEY_CACHE_TTL = float(getenv("KEY_CACHE_TTL", "300"))  # seconds
+KEY_CACHE_NEGATIVE_TTL = float(getenv("KEY_CACHE_NEGATIVE_TTL", "30"))  # seconds, for non-existing keys
+
+# Per-worker Bloom filter of existing keys, answering unknown keys with 404 after a catch-up
+# with recently created keys (at most one per 'KEY_BLOOM_FILTER_CATCH_UP_INTERVAL' per worker)
+# rather than a lookup each: keys created by other workers within the interval may get 404.
+# Optionally loaded from a file written by `manage.py build_key_bloom_filter`.
+KEY_BLOOM_FILTER_ENABLED = getenv("KEY_BLOOM_FILTER_ENABLED") == "true"
+KEY_BLOOM_FILTER_CAPACITY = int(getenv("KEY_BLOOM_FILTER_CAPACITY", "1000000"))
+KEY_BLOOM_FILTER_FALSE_POSITIVE_RATE = float(getenv("KEY_BLOOM_FILTER_FALSE_POSITIVE_RATE", "0.01"))
+KEY_BLOOM_FILTER_PATH = getenv("KEY_BLOOM_FILTER_PATH", "")
+KEY_BLOOM_FILTER_CATCH_UP_INTERVAL = float(getenv("KEY_BLOOM_FILTER_CATCH_UP_INTERVAL", "1"))  # seconds
+
+# Memory-mapped redirect snapshot, see `manage.py export_redirect_snapshot`.
+# Leave 'REDIRECT_SNAPSHOT_PATH' empty to resolve keys via the database only.
+REDIRECT_SNAPSHOT_PATH = getenv("REDIRECT_SNAPSHOT_PATH", "")
+REDIRECT_SNAPSHOT_CHECK_INTERVAL = float(getenv("REDIRECT_SNAPSHOT_CHECK_INTERVAL", "5"))  # seconds
+
+# Per-request instrumentation: database queries and time, view and serialization time, reported as
+# a `Server-Timing` header and a JSON log line (logger 'url_shortener.timing'). Requests are sampled
+# per view: 'SERVER_TIMING_VIEW_SAMPLE_RATES' should be a single string of 'view=rate' with a space
+# between each, e.g. 'FetchContentView=0.01 ShortenUrlView=1'; other views use 'SERVER_TIMING_SAMPLE_RATE'.
+# Requests slower than the threshold are always reported, with their SQL statements (0 to disable).
+SERVER_TIMING_ENABLED = getenv("SERVER_TIMING_ENABLED") == "true"
+SERVER_TIMING_SAMPLE_RATE = float(getenv("SERVER_TIMING_SAMPLE_RATE", "1"))
+SERVER_TIMING_VIEW_SAMPLE_RATES = {
+    view: float(rate)
+    for view, rate in (view_rate.split("=") for view_rate in getenv("SERVER_TIMING_VIEW_SAMPLE_RATES", "").split())
+}
+SERVER_TIMING_SLOW_REQUEST_THRESHOLD = float(getenv("SERVER_TIMING_SLOW_REQUEST_THRESHOLD", "0.5"))  # seconds
+
+# Prometheus metrics at `/metrics` (requests, latency and requests in flight per view, key generation retries,
+# integrity errors, write-behind buffers, key resolution cache, key allocation). Workers of a host aggregate
+# them through files of 'METRICS_DIR' (preferably on tmpfs, emptied when the server starts);
+# without it, each process reports its own metrics only.
+METRICS_ENABLED = getenv("METRICS_ENABLED") == "true"
+METRICS_DIR = getenv("METRICS_DIR", "")
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'url_shortener.timing': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 # Application definition
 
 EXTERNAL_APPS = (
     'rest_framework',
 )
 
-DEFAULT_APPS = (
+# Settings profile: 'full', or 'api' to serve the API only, without the admin, auth, sessions, messages,
+# static files and templates it does not use, nor their middleware (cheaper worker boots and requests,
+# see `manage.py benchmark_startup`). NOTE: with 'api', the API accepts and renders JSON only.
+SETTINGS_PROFILE = getenv("SETTINGS_PROFILE", "full")
+API_ONLY = SETTINGS_PROFILE == "api"
+
+DEFAULT_APPS = () if API_ONLY else (
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -56,7 +191,11 @@ CUSTOM_APPS = (
 INSTALLED_APPS = EXTERNAL_APPS + DEFAULT_APPS + CUSTOM_APPS
 
 MIDDLEWARE = [
+    'url_shortener.middleware.metrics_middleware',
+    'url_shortener.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.redirect_fast_path_middleware',
+    'url_shortener.middleware.read_your_writes_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -65,6 +204,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+if API_ONLY:
+    MIDDLEWARE = [
+        'url_shortener.middleware.metrics_middleware',
+        'url_shortener.middleware.ServerTimingMiddleware',
+        'django.middleware.security.SecurityMiddleware',
+        'api.middleware.redirect_fast_path_middleware',
+        'url_shortener.middleware.read_your_writes_middleware',
+        'django.middleware.common.CommonMiddleware',
+    ]
+
 ROOT_URLCONF = 'url_shortener.urls'
 
 TEMPLATES = [
@@ -81,7 +230,19 @@ TEMPLATES = [
             ],
         },
     },
-]
+] if not API_ONLY else []
+
+# The API only: no browsable API (nor templates), no authentication (nor `django.contrib.auth`), no throttling.
+if API_ONLY:
+    REST_FRAMEWORK = {
+        'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+        'DEFAULT_PARSER_CLASSES': ['rest_framework.parsers.JSONParser'],
+        'DEFAULT_AUTHENTICATION_CLASSES': [],
+        'DEFAULT_PERMISSION_CLASSES': [],
+        'DEFAULT_THROTTLE_CLASSES': [],
+        'UNAUTHENTICATED_USER': None,
+        'TEST_REQUEST_DEFAULT_FORMAT': 'json',
+    }
 
 WSGI_APPLICATION = 'url_shortener.wsgi.application'
 
@@ -107,6 +268,38 @@ DATABASES = {
     }
 }
 
+# Read replicas, serving reads of read-only endpoints (redirects and stats).
+# 'DB_REPLICAS' should be a single string of replicas with a space between each, as 'host[:port][/name]',
+# the port and the database name defaulting to those of the primary.
+# For example: 'DB_REPLICAS=replica-1:5432 replica-2:5432', or 'DB_REPLICAS=localhost/replica'
+# to route reads to a second local database.
+DATABASE_REPLICAS = []
+for index, replica in enumerate(getenv("DB_REPLICAS", "").split(), start=1):
+    replica_address, _, replica_name = replica.partition("/")
+    replica_host, _, replica_port = replica_address.partition(":")
+    DATABASES[f'replica_{index}'] = {
+        **DATABASES['default'],
+        'HOST': replica_host or DB_HOST,
+        'PORT': replica_port or DB_PORT,
+        'NAME': replica_name or DB_NAME,
+        # Tests read from replicas what they write to the primary.
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{index}')
+
+DATABASE_ROUTERS = ['url_shortener.db_routers.ReplicaRouter']
+
+# Replica selection: 'round_robin', or 'least_lag' (replicas lagging more than the max lag are skipped,
+# lags are checked at most every check interval).
+DB_REPLICA_SELECTION = getenv("DB_REPLICA_SELECTION", "round_robin")
+DB_REPLICA_MAX_LAG = float(getenv("DB_REPLICA_MAX_LAG", "5"))  # seconds
+DB_REPLICA_LAG_CHECK_INTERVAL = float(getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "1"))  # seconds
+
+# Clients are pinned to the primary for this long after a write (e.g. shortening an url),
+# so that they read their own writes. Set 'READ_YOUR_WRITES_WINDOW=0' to disable pinning.
+READ_YOUR_WRITES_WINDOW = int(getenv("READ_YOUR_WRITES_WINDOW", "5"))  # seconds
+READ_YOUR_WRITES_COOKIE_NAME = "pinned_to_primary"
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
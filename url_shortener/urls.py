@@ -1,9 +1,12 @@
 """
 url_shortener URL Configuration
 """
-from django.urls import path, include
+from django.urls import path, include, re_path
 
+from url_shortener.views import metrics_view
 
 urlpatterns = [
+    # Before the API: "metrics" would be taken for a shortened url key otherwise.
+    re_path(r"^metrics/?$", metrics_view, name="metrics"),
     path("", include("api.urls")),
 ]
@@ -0,0 +1,16 @@
+"""
+Views of the URL Shortener project, besides the API.
+"""
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+from url_shortener.metrics import CONTENT_TYPE, registry
+
+
+def metrics_view(request):
+    """
+    Prometheus metrics of all workers, see `url_shortener.metrics`.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(registry.exposition(), content_type=CONTENT_TYPE)